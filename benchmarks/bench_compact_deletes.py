@@ -0,0 +1,98 @@
+#!/usr/bin/python
+"""
+Micro-benchmark for compact_deletes
+
+Simulates the deletion of large directory trees (e.g. a node_modules
+directory removed on one side) and compares compact_deletes with the
+previous implementation, that checked every delete against every deleted
+directory.
+
+Run from the repository root:
+    python -m benchmarks.bench_compact_deletes [--sizes 100000,1000000]
+"""
+
+import argparse
+import random
+import time
+
+from upback.operations import compact_deletes
+from upback.path_element import PathElement
+
+def reference_compact_deletes(delete_ops, path_elements):
+    """ The quadratic implementation compact_deletes replaced """
+    dir_elements = []
+    for del_op in delete_ops:
+        path, _ = del_op
+        path_element = path_elements[path]
+        if path_element.is_directory:
+            dir_elements.append(path_element)
+    paths_to_ignore = []
+    for del_op in delete_ops:
+        path, _ = del_op
+        path_element = path_elements[path]
+        for dir_element in dir_elements:
+            if dir_element.contains(path_element):
+                paths_to_ignore.append(path)
+    compacted_ops = []
+    for del_op in delete_ops:
+        path, _ = del_op
+        if not path in paths_to_ignore:
+            compacted_ops.append(del_op)
+    return compacted_ops
+
+def generate_deletes(size, fan_out=10, files_per_dir=10, seed=0):
+    """ Returns (delete_ops, path_elements) for size deleted paths:
+        a few deleted trees plus some isolated deleted files
+    """
+    rng = random.Random(seed)
+    path_elements = {}
+    delete_ops = []
+    def add(path, is_directory):
+        path_elements[path] = PathElement(path, is_directory=is_directory)
+        delete_ops.append((path, False))
+    tree = 0
+    while len(delete_ops) < size:
+        directories = ["tree%d/node_modules" % tree]
+        add(directories[0], True)
+        while directories and len(delete_ops) < size:
+            directory = directories.pop(0)
+            for index in range(files_per_dir):
+                add(directory+"/file%d.js" % index, False)
+            for index in range(fan_out):
+                subdirectory = directory+"/pkg%d" % index
+                add(subdirectory, True)
+                directories.append(subdirectory)
+        add("tree%d/lonely%d.txt" % (tree, rng.randrange(1000000)), False)
+        tree += 1
+    rng.shuffle(delete_ops)
+    return (delete_ops, path_elements)
+
+def measure(function, delete_ops, path_elements):
+    """ Returns (seconds, number of compacted operations) """
+    start = time.perf_counter()
+    compacted_ops = function(delete_ops, path_elements)
+    return (time.perf_counter()-start, len(compacted_ops))
+
+def main():
+    """ Benchmark entry point """
+    parser = argparse.ArgumentParser(description="compact_deletes micro-benchmark")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000",
+                        help="comma separated numbers of deleted paths")
+    parser.add_argument("--reference-max", type=int, default=10000,
+                        help="largest size the reference implementation is run on")
+    arguments = parser.parse_args()
+    print("%10s %12s %12s %10s" % ("deletes", "compact (s)", "reference (s)", "compacted"))
+    for size in [int(size) for size in arguments.sizes.split(",")]:
+        delete_ops, path_elements = generate_deletes(size)
+        elapsed, compacted = measure(compact_deletes, delete_ops, path_elements)
+        reference = "-"
+        if size <= arguments.reference_max:
+            reference_elapsed, reference_compacted = measure(reference_compact_deletes,
+                                                             delete_ops, path_elements)
+            if reference_compacted != compacted:
+                raise AssertionError("compact_deletes and reference results differ")
+            reference = "%.3f" % reference_elapsed
+        print("%10d %12.3f %12s %10d" % (len(delete_ops), elapsed, reference, compacted))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+"""
+Micro-benchmark for the diff engine
+
+Builds local, remote and remote backup listings of a branch where a
+small fraction of the paths changed and compares diff_operations with
+compute_operations, the reference implementation.
+
+Run from the repository root:
+    python -m benchmarks.bench_diff [--sizes 100000,1000000] [--reference-max 1000000] [--shuffle]
+"""
+
+import argparse
+import random
+import time
+
+from upback.upback import compute_operations
+from upback.diff import diff_operations
+from upback.path_element import PathElement
+from upback.path_listing import PathListing
+
+def generate_listings(size, changed=0.01, shuffle=False, seed=0):
+    """ Returns (paths_all, paths_a, paths_b_backup, paths_b) for size paths,
+        changed is the fraction of paths added, modified or deleted on each side.
+        a and b are in the order of the backup unless shuffle is set
+    """
+    rng = random.Random(seed)
+    paths_a, paths_b_backup, paths_b = PathListing(), PathListing(), PathListing()
+    for index in range(size):
+        if index % 100 == 0:
+            path = "dir%d" % (index//100)
+            element = PathElement(path, 1509618221000000000+index, 9, -1, True, False)
+        else:
+            path = "dir%d/file%d.txt" % (index//100, index)
+            element = PathElement(path, 1509618221000000000+index*1000, 9, index, False, False)
+        paths_b_backup[path] = element
+        for paths in [paths_a, paths_b]:
+            draw = rng.random()
+            if draw < changed/2:
+                continue
+            if draw < changed and not element.is_directory:
+                paths[path] = PathElement(path, element.time_stamp+10**9, 9, element.size+1,
+                                          False, paths is paths_a)
+            else:
+                paths[path] = PathElement(path, element.time_stamp, 9, element.size,
+                                          element.is_directory, paths is paths_a)
+    if shuffle:
+        elements_a, elements_b = list(paths_a.values()), list(paths_b.values())
+        rng.shuffle(elements_a)
+        rng.shuffle(elements_b)
+        paths_a, paths_b = PathListing(elements_a), PathListing(elements_b)
+    paths_all = set(paths_a) | set(paths_b)
+    return (paths_all, paths_a, paths_b_backup, paths_b)
+
+def measure(function, listings):
+    """ Returns (seconds, operations) """
+    start = time.perf_counter()
+    operations = function(*listings)
+    return (time.perf_counter()-start, operations)
+
+def main():
+    """ Benchmark entry point """
+    parser = argparse.ArgumentParser(description="diff engine micro-benchmark")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="comma separated numbers of paths")
+    parser.add_argument("--reference-max", type=int, default=1000000,
+                        help="largest size the reference implementation is run on")
+    parser.add_argument("--shuffle", action="store_true",
+                        help="list local and remote paths in random order")
+    arguments = parser.parse_args()
+    print("%10s %10s %14s %11s" % ("paths", "diff (s)", "reference (s)", "operations"))
+    for size in [int(size) for size in arguments.sizes.split(",")]:
+        listings = generate_listings(size, shuffle=arguments.shuffle)
+        elapsed, operations = measure(diff_operations, listings)
+        reference = "-"
+        if size <= arguments.reference_max:
+            reference_elapsed, reference_operations = measure(compute_operations, listings)
+            if any(sorted(getattr(reference_operations, name)) != sorted(getattr(operations, name))
+                   for name in ["copy_a_to_b", "copy_b_to_a", "delete_from_a", "delete_from_b", "conflicts"]):
+                raise AssertionError("diff_operations and compute_operations results differ")
+            reference = "%.3f" % reference_elapsed
+        count = (len(operations.copy_a_to_b)+len(operations.copy_b_to_a)+len(operations.delete_from_a)+
+                 len(operations.delete_from_b)+len(operations.conflicts))
+        print("%10d %10.3f %14s %11d" % (size, elapsed, reference, count))
+
+if __name__ == '__main__':
+    main()
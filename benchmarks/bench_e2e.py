@@ -0,0 +1,261 @@
+#!/usr/bin/python
+"""
+End-to-end benchmark on synthetic branches
+
+Generates a local branch (number of files, depth, fan-out, file sizes,
+directories with exclude files) and synchronizes it with a remote that
+is a local directory, running UpBack as a separate process for each
+scenario:
+    init-push   first synchronization, the remote is empty
+    no-op       nothing changed
+    small-delta --small-change percent of the files changed
+    large-delta --large-change percent of the files changed
+    init-pull   a new local branch is initialized from the remote
+For each scenario the wall time, the peak RSS of the UpBack process and
+the number of rclone invocations (counted by a shim placed in front of
+rclone) are recorded. Each run is appended to a JSON results file so
+that runs on different commits can be compared.
+
+rclone must be installed (or given with --rclone). Run from the
+repository root:
+    python -m benchmarks.bench_e2e [--files 10000] [--output results.json]
+    python -m benchmarks.bench_e2e --compare results.json
+"""
+
+import os
+import sys
+import json
+import time
+import stat
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ["init-push", "no-op", "small-delta", "large-delta", "init-pull"]
+
+SHIM = """#!{python}
+import os, sys
+with open({log!r}, "a") as log_fp:
+    log_fp.write(" ".join(sys.argv[1:2])+"\\n")
+os.execv({rclone!r}, [{rclone!r}]+sys.argv[1:])
+"""
+
+class SyntheticBranch(object):
+    """ A generated local branch """
+    def __init__(self, root, arguments, seed=0):
+        self.root = root
+        self.arguments = arguments
+        self.rng = random.Random(seed)
+        self.files = []
+        self.directories = [""]
+
+    def file_size(self):
+        """ Draws a file size from the configured distribution """
+        mean_size = self.arguments.mean_size
+        if self.arguments.size_distribution == "fixed":
+            return mean_size
+        if self.arguments.size_distribution == "uniform":
+            return self.rng.randrange(2*mean_size+1)
+        # lognormal with the given mean: a few large files, many small ones
+        sigma = 1.5
+        return int(self.rng.lognormvariate(0, sigma)*mean_size/2.718281828**(sigma*sigma/2))
+
+    def write_file(self, path, mtime_offset=0):
+        """ Writes path (relative to root) with a random size """
+        full_path = os.path.join(self.root, path)
+        with open(full_path, "wb") as file_fp:
+            file_fp.write(b"u"*self.file_size())
+        if mtime_offset:
+            mtime = os.stat(full_path).st_mtime+mtime_offset
+            os.utime(full_path, (mtime, mtime))
+
+    def generate(self):
+        """ Creates directories, files and exclude files """
+        level = [""]
+        for _ in range(self.arguments.depth):
+            next_level = []
+            for directory in level:
+                for index in range(self.arguments.fan_out):
+                    next_level.append(os.path.join(directory, "dir%d" % index))
+            self.directories += next_level
+            level = next_level
+        for directory in self.directories:
+            os.makedirs(os.path.join(self.root, directory), exist_ok=True)
+        for index in range(self.arguments.files):
+            path = os.path.join(self.rng.choice(self.directories), "file%d.dat" % index)
+            self.write_file(path)
+            self.files.append(path)
+        for directory in self.directories:
+            if self.rng.random() < self.arguments.exclude_density:
+                with open(os.path.join(self.root, directory, ".upback.exclude"), "w") as exclude_fp:
+                    exclude_fp.write("*.tmp\n")
+                for index in range(3):
+                    self.write_file(os.path.join(directory, "excluded%d.tmp" % index))
+
+    def change(self, percent):
+        """ Modifies, deletes and adds percent of the files
+            (in the proportion 3:1:1)
+        """
+        count = len(self.files)*percent//100
+        for path in self.rng.sample(self.files, count*3//5):
+            self.write_file(path, 2)
+        for path in self.rng.sample(self.files, count//5):
+            if os.path.exists(os.path.join(self.root, path)):
+                os.remove(os.path.join(self.root, path))
+                self.files.remove(path)
+        for index in range(count//5):
+            path = os.path.join(self.rng.choice(self.directories), "new%d_%d.dat" % (percent, index))
+            self.write_file(path)
+            self.files.append(path)
+
+def write_shim(directory, rclone, log_path):
+    """ Writes an rclone executable logging its invocations
+        in log_path, then running the real rclone
+    """
+    shim_path = os.path.join(directory, "rclone")
+    with open(shim_path, "w") as shim_fp:
+        shim_fp.write(SHIM.format(python=sys.executable, log=log_path, rclone=rclone))
+    os.chmod(shim_path, os.stat(shim_path).st_mode | stat.S_IXUSR)
+
+def run_upback(arguments, cwd, shim_directory, log_path, extra_arguments):
+    """ Runs UpBack, returns the measures of the run """
+    open(log_path, "w").close()
+    environment = dict(os.environ, PYTHONPATH=REPOSITORY)
+    args = [sys.executable, "-m", "upback", "--rclone-path", shim_directory]+arguments+extra_arguments
+    with tempfile.TemporaryFile() as stderr_fp:
+        start = time.perf_counter()
+        process = subprocess.Popen(args, cwd=cwd, env=environment, stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.DEVNULL, stderr=stderr_fp)
+        # wait4 gives the resources used by this process only
+        _, status, resources = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter()-start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        stderr_fp.seek(0)
+        error = stderr_fp.read().decode("UTF-8", "replace")
+    commands = {}
+    with open(log_path) as log_fp:
+        for line in log_fp:
+            command = line.strip()
+            commands[command] = commands.get(command, 0)+1
+    return {
+        "wall_time": round(elapsed, 3),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_kb": resources.ru_maxrss,
+        "rclone_invocations": sum(commands.values()),
+        "rclone_commands": commands,
+        "exit_status": process.returncode,
+        "error": error[-2000:] if process.returncode else ""
+    }
+
+def commit_id():
+    """ Commit of the benchmarked checkout, None outside git """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY,
+                                       stderr=subprocess.DEVNULL, encoding="UTF-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(arguments):
+    """ Runs the scenarios, returns the results of the run """
+    rclone = arguments.rclone or shutil.which("rclone")
+    if rclone is None:
+        sys.exit("rclone not found, use --rclone")
+    work_directory = tempfile.mkdtemp(prefix="upback_bench", dir=arguments.work_directory)
+    try:
+        local = os.path.join(work_directory, "local")
+        remote = os.path.join(work_directory, "remote")
+        pulled = os.path.join(work_directory, "pulled")
+        for directory in [local, remote, pulled]:
+            os.makedirs(directory)
+        log_path = os.path.join(work_directory, "rclone.log")
+        write_shim(work_directory, rclone, log_path)
+        branch = SyntheticBranch(local, arguments)
+        branch.generate()
+        upback_arguments = arguments.upback_arguments.split()
+        results = {}
+        for scenario in arguments.scenarios.split(","):
+            if scenario == "init-push":
+                results[scenario] = run_upback(upback_arguments, local, work_directory, log_path,
+                                               ["init-push", remote])
+            elif scenario == "no-op":
+                results[scenario] = run_upback(upback_arguments, local, work_directory, log_path, [])
+            elif scenario == "small-delta":
+                branch.change(arguments.small_change)
+                results[scenario] = run_upback(upback_arguments, local, work_directory, log_path, [])
+            elif scenario == "large-delta":
+                branch.change(arguments.large_change)
+                results[scenario] = run_upback(upback_arguments, local, work_directory, log_path, [])
+            elif scenario == "init-pull":
+                results[scenario] = run_upback(upback_arguments, pulled, work_directory, log_path,
+                                               ["init-pull", remote])
+            else:
+                sys.exit("Unknown scenario "+scenario)
+            print("%-12s %8.3fs %10d KB %6d rclone invocations%s" % (
+                scenario, results[scenario]["wall_time"], results[scenario]["peak_rss_kb"],
+                results[scenario]["rclone_invocations"],
+                " FAILED" if results[scenario]["exit_status"] else ""))
+    finally:
+        shutil.rmtree(work_directory)
+    parameters = dict((name, value) for name, value in vars(arguments).items()
+                      if name not in ["output", "compare", "work_directory", "rclone"])
+    return {
+        "label": arguments.label or commit_id(),
+        "commit": commit_id(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "parameters": parameters,
+        "results": results
+    }
+
+def compare(results_path):
+    """ Prints the runs stored in results_path side by side """
+    with open(results_path) as results_fp:
+        runs = json.load(results_fp)
+    print("%-12s %-19s" % ("scenario", "measure")+"".join("%14s" % str(run["label"])[:13] for run in runs))
+    for scenario in SCENARIOS:
+        for measure in ["wall_time", "peak_rss_kb", "rclone_invocations"]:
+            values = [run["results"].get(scenario, {}).get(measure) for run in runs]
+            if any(value is not None for value in values):
+                print("%-12s %-19s" % (scenario, measure)+
+                      "".join("%14s" % ("-" if value is None else value) for value in values))
+
+def main():
+    """ Benchmark entry point """
+    parser = argparse.ArgumentParser(description="UpBack end-to-end benchmark")
+    parser.add_argument("--files", type=int, default=10000, help="number of files")
+    parser.add_argument("--depth", type=int, default=3, help="depth of the directory tree")
+    parser.add_argument("--fan-out", type=int, default=5, help="subdirectories of each directory")
+    parser.add_argument("--size-distribution", choices=["fixed", "uniform", "lognormal"], default="lognormal",
+                        help="distribution of file sizes")
+    parser.add_argument("--mean-size", type=int, default=4096, help="mean file size in bytes")
+    parser.add_argument("--exclude-density", type=float, default=0.1,
+                        help="fraction of directories with an exclude file (excluding some files)")
+    parser.add_argument("--small-change", type=int, default=1, help="percent of files changed by small-delta")
+    parser.add_argument("--large-change", type=int, default=50, help="percent of files changed by large-delta")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated scenarios to run")
+    parser.add_argument("--upback-arguments", default="", help="additional UpBack arguments, e.g. \"--jobs 4\"")
+    parser.add_argument("--label", help="name of the run in the results (default: the current commit)")
+    parser.add_argument("--rclone", help="rclone executable (default: rclone in PATH)")
+    parser.add_argument("--work-directory", help="where branches are generated (default: the temporary directory)")
+    parser.add_argument("--output", default="bench_e2e_results.json",
+                        help="JSON file runs are appended to")
+    parser.add_argument("--compare", metavar="RESULTS", help="print the runs in RESULTS and exit")
+    arguments = parser.parse_args()
+    if arguments.compare:
+        compare(arguments.compare)
+        return
+    run = run_benchmark(arguments)
+    runs = []
+    if os.path.exists(arguments.output):
+        with open(arguments.output) as results_fp:
+            runs = json.load(results_fp)
+    runs.append(run)
+    with open(arguments.output, "w") as results_fp:
+        json.dump(runs, results_fp, indent=1)
+
+if __name__ == '__main__':
+    main()
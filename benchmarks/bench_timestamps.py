@@ -0,0 +1,104 @@
+#!/usr/bin/python
+"""
+Micro-benchmark for timestamp parsing and comparison
+
+Parses a listing worth of rclone timestamps (RFC3339Nano, many of them
+repeated as in real listings) with parse_rfc3339, with its uncached
+version and with the previous implementation, returning datetime objects,
+then compares the parsed timestamps with both representations.
+
+Run from the repository root:
+    python -m benchmarks.bench_timestamps [--count 1000000] [--distinct 100000]
+"""
+
+import argparse
+import datetime
+import random
+import time
+
+from upback.util import parse_rfc3339, parse_rfc3339_uncached, RFC3339_CACHE
+
+def reference_parse_rfc3339(datetime_string):
+    """ The datetime based implementation parse_rfc3339 replaced """
+    timezone = "+0000"
+    if datetime_string.endswith("Z"):
+        datetime_string = datetime_string[0:-1]
+    _, _, datetime_time_string = datetime_string.partition("T")
+    zone_sep = ""
+    if "+" in datetime_time_string:
+        zone_sep = "+"
+    elif "-" in datetime_time_string:
+        zone_sep = "-"
+    if not zone_sep == "":
+        datetime_string, _, datetime_offset = datetime_string.partition(zone_sep)
+        timezone = zone_sep+datetime_offset.replace(":", "")
+    microseconds = 0
+    precision = 0
+    if "." in datetime_time_string:
+        datetime_string, _, datetime_ns = datetime_string.partition(".")
+        microseconds = int(float("0."+datetime_ns)*1000)
+        precision = len(datetime_ns)
+    time_3339 = datetime.datetime.strptime(datetime_string, "%Y-%m-%dT%H:%M:%S")
+    timezone_delta = datetime.timedelta(hours=int(timezone[1:3]), minutes=int(timezone[3:5]))
+    if timezone[0] == '+':
+        time_3339 -= timezone_delta
+    else:
+        time_3339 += timezone_delta
+    return (time_3339.replace(microsecond=microseconds), precision)
+
+def generate_timestamps(count, distinct, seed=0):
+    """ Returns count timestamps drawn from distinct values,
+        with the precisions and zones found in rclone listings
+    """
+    rng = random.Random(seed)
+    base = datetime.datetime(2017, 11, 2)
+    values = []
+    for _ in range(distinct):
+        time_stamp = base+datetime.timedelta(seconds=rng.randrange(100000000))
+        fraction = rng.choice(["", ".%03d" % rng.randrange(1000), ".%09d" % rng.randrange(1000000000)])
+        # the reference implementation does not handle negative offsets
+        zone = rng.choice(["Z", "Z", "Z", "+01:00"])
+        values.append(time_stamp.strftime("%Y-%m-%dT%H:%M:%S")+fraction+zone)
+    return [rng.choice(values) for _ in range(count)]
+
+def measure(function, timestamps):
+    """ Returns (seconds, parsed timestamps) """
+    start = time.perf_counter()
+    parsed = [function(timestamp) for timestamp in timestamps]
+    return (time.perf_counter()-start, parsed)
+
+def measure_comparisons(parsed, tolerance):
+    """ Returns the seconds spent comparing consecutive timestamps """
+    start = time.perf_counter()
+    for index in range(1, len(parsed)):
+        _ = abs(parsed[index][0]-parsed[index-1][0]) < tolerance
+    return time.perf_counter()-start
+
+def main():
+    """ Benchmark entry point """
+    parser = argparse.ArgumentParser(description="timestamp parsing micro-benchmark")
+    parser.add_argument("--count", type=int, default=1000000, help="number of timestamps parsed")
+    parser.add_argument("--distinct", type=int, default=100000, help="number of distinct timestamps")
+    arguments = parser.parse_args()
+    timestamps = generate_timestamps(arguments.count, arguments.distinct)
+    RFC3339_CACHE.clear()
+    cached_elapsed, parsed = measure(parse_rfc3339, timestamps)
+    uncached_elapsed, uncached_parsed = measure(parse_rfc3339_uncached, timestamps)
+    reference_elapsed, reference_parsed = measure(reference_parse_rfc3339, timestamps)
+    if parsed != uncached_parsed:
+        raise AssertionError("cached and uncached results differ")
+    epoch = datetime.datetime(1970, 1, 1)
+    for (time_ns, precision), (time_stamp, reference_precision) in zip(parsed, reference_parsed):
+        if time_ns//1000000000 != int((time_stamp-epoch).total_seconds()) or precision != reference_precision:
+            raise AssertionError("parse_rfc3339 and reference results differ")
+    print("%-22s %10s %12s" % ("", "seconds", "ns/timestamp"))
+    for name, elapsed in [("parse_rfc3339", cached_elapsed),
+                          ("parse_rfc3339 uncached", uncached_elapsed),
+                          ("reference (datetime)", reference_elapsed),
+                          ("compare ns", measure_comparisons(parsed, 10000)),
+                          ("compare datetime", measure_comparisons(reference_parsed,
+                                                                   datetime.timedelta(microseconds=10)))]:
+        print("%-22s %10.3f %12.0f" % (name, elapsed, elapsed*1e9/len(timestamps)))
+
+if __name__ == '__main__':
+    main()
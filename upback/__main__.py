@@ -7,7 +7,12 @@ import logging
 import sys
 
 from .configuration import Configuration
+from .rclone import RClone
+from .profiling import Profiler
+from .metrics import write_metrics
 from .upback import upback
+from .watch import watch
+from .run_all import run_all
 from .const import *
 
 def main():
@@ -16,9 +21,20 @@ def main():
     # UpBack [{init-push|init-pull} remote [remote-backup-dir [remote-backup-suffix]]] [resume] [--rclone-path path] [--rclone-executable exec]
     #TODO improve this mess
     _parser = argparse.ArgumentParser(description="UpBack a file synchronization utility",
-                                      usage="%(prog)s {[{init-push|init-pull} remote [remote-backup-dir [remote-backup-suffix]]]|[resume]} [-i] [-v] [-vv] [--rclone-path path] [--rclone-executable exec]")
+                                      usage="%(prog)s {[{init-push|init-pull} remote [remote-backup-dir [remote-backup-suffix]]]|[resume]|[watch [--debounce s] [--remote-interval s]]|[run-all manifest [--branches n] [--rclone-processes n]]} [-i] [-v] [-vv] [--rclone-path path] [--rclone-executable exec] [--scan-threads n] [--batch-size n] [--jobs n] [--trust-directory-mtime] [--verify-snapshot] [--rcd] [--profile] [--profile-output file] [--metrics-file file] [--checksum] [--full]")
     _parser.add_argument("--rclone-path")
     _parser.add_argument("--rclone-executable")
+    _parser.add_argument("--scan-threads", type=int, help="number of threads used to list the local branch (useful on network filesystems)")
+    _parser.add_argument("--batch-size", type=int, help="maximum number of files transferred by a single rclone invocation, 0 to invoke rclone once per file (default: %d)" % BATCH_SIZE_DEFAULT)
+    _parser.add_argument("--jobs", "-j", type=int, help="number of synchronization operations performed in parallel (default: 1)")
+    _parser.add_argument("--trust-directory-mtime", action='store_true', help="do not check files in local directories that did not change since the last run (files modified in place are detected only when their directory changes)")
+    _parser.add_argument("--verify-snapshot", action='store_true', help="list the whole remote again after synchronizing to update the remote backup, instead of deriving it from the performed operations")
+    _parser.add_argument("--rcd", action='store_true', help="run a single rclone rcd process and send it all the operations through its remote control API, instead of invoking rclone each time")
+    _parser.add_argument("--profile", action='store_true', help="print the time spent in each phase of the synchronization, with paths, operations and rclone invocations counts")
+    _parser.add_argument("--profile-output", help="also write the profile to this file as JSON (implies --profile)")
+    _parser.add_argument("--checksum", action='store_true', help="compare files by checksum (the hashes the remote provides, local files are hashed) instead of modification time, when both sides have one")
+    _parser.add_argument("--full", action='store_true', help="always list the remote, even if its change token shows that nothing changed since the last synchronization")
+    _parser.add_argument("--metrics-file", help="write the metrics of the run to this file in the Prometheus textfile collector format (e.g. /var/lib/node_exporter/upback.prom)")
     _parser.add_argument("-i", action='store_true', help="interactive mode")
     _parser.add_argument("-v", action='store_true', help="verbose")
     _parser.add_argument("-vv", action='store_true', help="more verbose")
@@ -31,6 +47,17 @@ def main():
         _parser.add_argument("remote_backup_suffix", metavar="remote_backup_suffix", nargs="?", help="The suffix for the files moved in the backup directory, defaults to the current date")
         _arguments = _parser.parse_args(_other_arguments[1:], _arguments)
         _arguments.__setattr__(_other_arguments[0].replace("-", "_"), True)
+    elif _other_arguments and _other_arguments[0] == "watch":
+        _parser.add_argument("--debounce", type=float, help="seconds without local changes before they are synchronized (default: %g)" % WATCH_DEBOUNCE_DEFAULT)
+        _parser.add_argument("--remote-interval", type=float, help="seconds between full synchronizations picking up remote changes (default: %g)" % WATCH_REMOTE_INTERVAL_DEFAULT)
+        _arguments = _parser.parse_args(_other_arguments[1:], _arguments)
+        _arguments.__setattr__("watch", True)
+    elif _other_arguments and _other_arguments[0] == "run-all":
+        _parser.add_argument("manifest", help="file listing the directories of the branches to synchronize, one per line")
+        _parser.add_argument("--branches", type=int, help="number of branches synchronized in parallel (default: %d)" % RUN_ALL_BRANCHES_DEFAULT)
+        _parser.add_argument("--rclone-processes", type=int, help="maximum number of rclone processes (or remote control calls) running at the same time (default: %d)" % RUN_ALL_RCLONE_PROCESSES_DEFAULT)
+        _arguments = _parser.parse_args(_other_arguments[1:], _arguments)
+        _arguments.__setattr__("run_all", True)
     elif _other_arguments and _other_arguments[0] == "resume":
         _arguments = _parser.parse_args(_other_arguments[1:], _arguments)
         _arguments.__setattr__("resume", True)
@@ -43,8 +70,19 @@ def main():
     elif _configuration.verbose:
         _log_level = logging.INFO
     logging.basicConfig(format="%(message)s", level=_log_level)
+    _profiler = Profiler(_configuration.profile or _configuration.metrics_file is not None)
+    _rclone = None
+    exit_status = STATUS_OK
     try:
-        exit_status = upback()
+        if _configuration.rcd:
+            _rclone = RClone(_configuration.rclone_path, _configuration.rclone_executable)
+            _rclone.start_daemon()
+        if _configuration.watch:
+            exit_status = watch()
+        elif _configuration.run_all:
+            exit_status = run_all(_arguments)
+        else:
+            exit_status = upback()
     except KeyboardInterrupt:
         exit_status = STATUS_INTERRUPTED
     except SystemExit as e:
@@ -53,6 +91,22 @@ def main():
     except Exception as e:
         print(e)
         exit_status = STATUS_ERROR
+    finally:
+        if _rclone is not None:
+            _rclone.stop_daemon()
+        if _configuration.profile:
+            for command, count in sorted(RClone().invocations.items()):
+                _profiler.count("rclone "+command, count)
+            _profiler.count("rclone invocations", sum(RClone().invocations.values()))
+            print(_profiler.pretty_format(), end="")
+            if _configuration.profile_output:
+                _profiler.write(_configuration.profile_output)
+        if _configuration.metrics_file:
+            try:
+                write_metrics(_configuration.metrics_file, _profiler.summary(), RClone().invocations,
+                              exit_status or STATUS_OK)
+            except OSError as e:
+                print("Cannot write metrics: "+str(e))
     sys.exit(exit_status)
 
 if __name__ == '__main__':
@@ -0,0 +1,114 @@
+"""
+Change token (.upback.token): a small file written to the remote at
+the end of each successful synchronization, and kept in the branch.
+As long as the remote has the token the branch wrote, no other
+client synchronized with it and the backup still describes it:
+reading the token is enough to skip listing the remote
+"""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import subprocess
+
+from .rclone import RClone
+from .configuration import Configuration
+from .util import is_path_local, rebase
+from .const import * # pylint: disable=unused-wildcard-import
+
+READ_SIZE = 1048576
+
+def snapshot_digest(backup_path):
+    """ sha256 of the remote backup file, None if there is none """
+    digest = hashlib.sha256()
+    try:
+        with open(os.path.join(backup_path, UPBACK_REMOTE_BACKUP), "rb") as snapshot_fp:
+            for chunk in iter(lambda: snapshot_fp.read(READ_SIZE), b""):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+def parse_token(content):
+    """ Returns the token in content, None if it is not valid """
+    try:
+        token = json.loads(content)
+    except ValueError:
+        return None
+    if not isinstance(token, dict) or not all(key in token for key in ["sync_id", "timestamp", "snapshot"]):
+        return None
+    return token
+
+def read_local_token(token_path):
+    """ Reads a token from a local file, None if it cannot be read """
+    try:
+        with open(token_path, "r") as token_fp:
+            return parse_token(token_fp.read())
+    except (FileNotFoundError, UnicodeDecodeError):
+        return None
+
+def write_local_token(token_path, token):
+    """ Writes a token to a local file, replacing it atomically """
+    temporary_path = token_path+".tmp"
+    with open(temporary_path, "w") as token_fp:
+        token_fp.write(json.dumps(token))
+    os.replace(temporary_path, token_path)
+
+def remote_token_path(remote):
+    """ Path of the token in remote, local remotes are relative to the working directory """
+    token_path = rebase(UPBACK_TOKEN, remote)
+    if is_path_local(token_path):
+        token_path = os.path.join(Configuration().working_directory, token_path)
+    return token_path
+
+def read_remote_token(remote):
+    """ Reads the token in remote, None if there is none """
+    token_path = remote_token_path(remote)
+    if is_path_local(token_path):
+        return read_local_token(token_path)
+    try:
+        return parse_token(RClone().cat(token_path))
+    except subprocess.CalledProcessError:
+        return None
+
+def remote_unchanged(backup_path, remote):
+    """ True if remote has the token written by the last synchronization
+        of the branch in backup_path and the backup was not changed since
+    """
+    token = read_local_token(os.path.join(backup_path, UPBACK_TOKEN))
+    if token is None or token["snapshot"] != snapshot_digest(backup_path):
+        return False
+    return read_remote_token(remote) == token
+
+def invalidate_token(backup_path):
+    """ Removes the token of the branch, before the remote is modified """
+    try:
+        os.remove(os.path.join(backup_path, UPBACK_TOKEN))
+    except FileNotFoundError:
+        pass
+
+def update_token(backup_path, remote):
+    """ Writes a new token to remote and to the branch, at the end of
+        a successful synchronization. If the remote cannot be written
+        the branch is left without a token and the next run lists the
+        remote
+    """
+    invalidate_token(backup_path)
+    token = {
+        "sync_id": uuid.uuid4().hex,
+        "timestamp": round(time.time(), 3),
+        "snapshot": snapshot_digest(backup_path)
+    }
+    token_path = remote_token_path(remote)
+    try:
+        if is_path_local(token_path):
+            write_local_token(token_path, token)
+        else:
+            RClone().write_file(token_path, json.dumps(token))
+    except (subprocess.CalledProcessError, OSError) as error:
+        logging.warning("Cannot write the change token to the remote: "+str(error))
+        return
+    write_local_token(os.path.join(backup_path, UPBACK_TOKEN), token)
@@ -1,6 +1,7 @@
 """ UpBack configuration singleton """
 
 import json
+import contextvars
 import datetime
 
 from .const import *
@@ -22,6 +23,25 @@ class ConfigurationOptions:
     REMOTE = "remote"
     REMOTE_BACKUP_DIR = "remote_backup_dir"
     REMOTE_BACKUP_SUFFIX = "remote_backup_suffix"
+    SCAN_THREADS = "scan_threads"
+    BATCH_SIZE = "batch_size"
+    JOBS = "jobs"
+    TRUST_DIRECTORY_MTIME = "trust_directory_mtime"
+    WATCH = "watch"
+    DEBOUNCE = "debounce"
+    REMOTE_INTERVAL = "remote_interval"
+    VERIFY_SNAPSHOT = "verify_snapshot"
+    RCD = "rcd"
+    PROFILE = "profile"
+    PROFILE_OUTPUT = "profile_output"
+    METRICS_FILE = "metrics_file"
+    CHECKSUM = "checksum"
+    FULL = "full"
+    RUN_ALL = "run_all"
+    MANIFEST = "manifest"
+    BRANCHES = "branches"
+    RCLONE_PROCESSES = "rclone_processes"
+    WORKING_DIRECTORY = "working_directory"
     OPT_INTERACTIVE = "i"
     OPT_VERBOSE = "v"
     OPT_VERBOSE_L2 = "vv"
@@ -30,7 +50,13 @@ class Configuration(ConfigurationOptions):
     """ Configuration class
         Fields are read from json file
     """
+    # instance bound to the current context (see bind), overrides the singleton
+    context = contextvars.ContextVar("configuration", default=None)
+
     def __new__(cls, *args, **kwds):
+        singleton = cls.context.get()
+        if singleton is not None:
+            return singleton
         singleton = cls.__dict__.get("__it__")
         if singleton is not None:
             return singleton
@@ -38,15 +64,32 @@ class Configuration(ConfigurationOptions):
         singleton.setup(*args, **kwds)
         return singleton
 
+    @classmethod
+    def bind(cls, *args, **kwds):
+        """ Creates a new instance returned, instead of the singleton,
+            to the code running in the current context (e.g. the
+            branch synchronized by a run_all worker)
+        """
+        instance = object.__new__(cls)
+        instance.setup(*args, **kwds)
+        cls.context.set(instance)
+        return instance
+
     def setup(self, arguments):
         """ Initialization method, called on singleton instantiation """
         arguments_map = vars(arguments)
         self.nonpersistent_settings = [ # These are the settings that are not written to disk when calling write()
             self.INIT_PULL, self.INIT_PUSH, self.RESUME, self.FORCE, self.RCLONE_PATH, self.RCLONE_EXECUTABLE,
-            self.INTERACTIVE, self.VERBOSE, self.VERBOSE_L2, self.CONF_PATH] 
+            self.INTERACTIVE, self.VERBOSE, self.VERBOSE_L2, self.CONF_PATH, self.SCAN_THREADS,
+            self.BATCH_SIZE, self.JOBS, self.TRUST_DIRECTORY_MTIME, self.WATCH, self.DEBOUNCE,
+            self.REMOTE_INTERVAL, self.VERIFY_SNAPSHOT, self.RCD, self.PROFILE, self.PROFILE_OUTPUT,
+            self.METRICS_FILE, self.CHECKSUM, self.FULL, self.RUN_ALL, self.MANIFEST, self.BRANCHES, self.RCLONE_PROCESSES,
+            self.WORKING_DIRECTORY]
         self.init_pull = self.INIT_PULL in arguments_map
         self.init_push = self.INIT_PUSH in arguments_map
         self.resume = self.RESUME in arguments_map
+        self.watch = self.WATCH in arguments_map
+        self.run_all = self.RUN_ALL in arguments_map
         self.force = self.FORCE in arguments_map
         if self.RCLONE_PATH in arguments_map and arguments_map[self.RCLONE_PATH]:
             self.rclone_path = arguments_map[self.RCLONE_PATH]
@@ -81,6 +124,72 @@ class Configuration(ConfigurationOptions):
             self.verbose_l2 = True
         else:
             self.verbose_l2 = False
+        if self.SCAN_THREADS in arguments_map and arguments_map[self.SCAN_THREADS]:
+            self.scan_threads = arguments_map[self.SCAN_THREADS]
+        else:
+            self.scan_threads = 0
+        if self.BATCH_SIZE in arguments_map and arguments_map[self.BATCH_SIZE] is not None:
+            self.batch_size = arguments_map[self.BATCH_SIZE]
+        else:
+            self.batch_size = BATCH_SIZE_DEFAULT
+        if self.JOBS in arguments_map and arguments_map[self.JOBS]:
+            self.jobs = arguments_map[self.JOBS]
+        else:
+            self.jobs = 1
+        if self.TRUST_DIRECTORY_MTIME in arguments_map and arguments_map[self.TRUST_DIRECTORY_MTIME]:
+            self.trust_directory_mtime = True
+        else:
+            self.trust_directory_mtime = False
+        if self.VERIFY_SNAPSHOT in arguments_map and arguments_map[self.VERIFY_SNAPSHOT]:
+            self.verify_snapshot = True
+        else:
+            self.verify_snapshot = False
+        if self.RCD in arguments_map and arguments_map[self.RCD]:
+            self.rcd = True
+        else:
+            self.rcd = False
+        if self.PROFILE_OUTPUT in arguments_map and arguments_map[self.PROFILE_OUTPUT]:
+            self.profile_output = arguments_map[self.PROFILE_OUTPUT]
+        else:
+            self.profile_output = None
+        if (self.PROFILE in arguments_map and arguments_map[self.PROFILE]) or self.profile_output:
+            self.profile = True
+        else:
+            self.profile = False
+        if self.CHECKSUM in arguments_map and arguments_map[self.CHECKSUM]:
+            self.checksum = True
+        else:
+            self.checksum = False
+        if self.FULL in arguments_map and arguments_map[self.FULL]:
+            self.full = True
+        else:
+            self.full = False
+        if self.METRICS_FILE in arguments_map and arguments_map[self.METRICS_FILE]:
+            self.metrics_file = arguments_map[self.METRICS_FILE]
+        else:
+            self.metrics_file = None
+        if self.DEBOUNCE in arguments_map and arguments_map[self.DEBOUNCE] is not None:
+            self.debounce = arguments_map[self.DEBOUNCE]
+        else:
+            self.debounce = WATCH_DEBOUNCE_DEFAULT
+        if self.REMOTE_INTERVAL in arguments_map and arguments_map[self.REMOTE_INTERVAL]:
+            self.remote_interval = arguments_map[self.REMOTE_INTERVAL]
+        else:
+            self.remote_interval = WATCH_REMOTE_INTERVAL_DEFAULT
+        if self.MANIFEST in arguments_map and arguments_map[self.MANIFEST]:
+            self.manifest = arguments_map[self.MANIFEST]
+        else:
+            self.manifest = None
+        if self.BRANCHES in arguments_map and arguments_map[self.BRANCHES]:
+            self.branches = arguments_map[self.BRANCHES]
+        else:
+            self.branches = RUN_ALL_BRANCHES_DEFAULT
+        if self.RCLONE_PROCESSES in arguments_map and arguments_map[self.RCLONE_PROCESSES]:
+            self.rclone_processes = arguments_map[self.RCLONE_PROCESSES]
+        else:
+            self.rclone_processes = RUN_ALL_RCLONE_PROCESSES_DEFAULT
+        # local directory being synchronized, relative paths are relative to it
+        self.working_directory = "."
         self.conf_path = ""
         self.no_backup = False
         self.global_excludes = []
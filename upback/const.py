@@ -3,7 +3,15 @@
 UPBACK_EXCLUDE_FILE = ".upback.exclude"
 UPBACK_CONF_FILE = ".upback.config"
 UPBACK_REMOTE_BACKUP = ".upback.remote"
+UPBACK_EXCLUDE_CACHE = ".upback.exclude.cache"
+UPBACK_LOCAL_STATE = ".upback.local"
+UPBACK_HASH_CACHE = ".upback.hashes"
+UPBACK_JOURNAL = ".upback.journal"
+UPBACK_TOKEN = ".upback.token"
 UPBACK_CONFLICTS_FILE = "UPBACK_CONFLICTS"
+# files used by UpBack itself, never synchronized
+UPBACK_INTERNAL_FILES = [UPBACK_CONF_FILE+".lock", UPBACK_REMOTE_BACKUP, UPBACK_EXCLUDE_CACHE,
+                         UPBACK_LOCAL_STATE, UPBACK_HASH_CACHE, UPBACK_JOURNAL, UPBACK_TOKEN]
 NOOP = 0
 COPY_A_TO_B = 1
 COPY_B_TO_A = 2
@@ -16,6 +24,8 @@ OPERATION_COPY_B_TO_A = 2
 OPERATION_DELETE_FROM_A = 3
 OPERATION_DELETE_FROM_B = 4
 OPERATION_CONFLICT = 5
+OPERATION_MOVE_IN_A = 6
+OPERATION_MOVE_IN_B = 7
 
 CHANGE_NONE = 1
 CHANGE_DELETED = 2
@@ -24,6 +34,15 @@ CHANGE_SAME = 4
 CHANGE_UPDATED = 5
 
 BACKUP_SUFFIX_DEFAULT = "%Y%m%d_%H%M%S"
+BATCH_SIZE_DEFAULT = 1000
+WATCH_DEBOUNCE_DEFAULT = 2.0
+WATCH_REMOTE_INTERVAL_DEFAULT = 300.0
+RUN_ALL_BRANCHES_DEFAULT = 4
+RUN_ALL_RCLONE_PROCESSES_DEFAULT = 8
+# seconds between checkpoints of the backup while operations are performed
+JOURNAL_CHECKPOINT_INTERVAL = 60.0
+# rclone hash types that can be computed for local files, in order of preference
+HASH_TYPES = ["md5", "sha1", "sha256", "crc32"]
 
 STATUS_OK = 0
 STATUS_ERROR = 1
@@ -0,0 +1,178 @@
+"""
+Diff engine, computes the same Operations as compute_operations
+working on the columns of PathListings instead of PathElements
+"""
+
+import array
+import operator
+import itertools
+
+from .operations import Operations
+from .path_listing import PathListing, FLAG_DIRECTORY, PRECISION_SHIFT
+from .const import * # pylint: disable=unused-wildcard-import
+
+# maximum difference (in nanoseconds) between effectively equal
+# time stamps, indexed by the lower precision of the two
+TOLERANCES = tuple(10000 if precision >= 6 else 10**(9-precision) for precision in range(64))
+
+# kind of an element, from its flags: 0 file, 1 directory, 2 missing
+# (missing elements are never identical to the ones in the backup)
+MISSING = 0xff
+KINDS = bytes(FLAG_DIRECTORY & flags if flags != MISSING else 2 for flags in range(256))
+
+# operation to perform for each (a change, b change), see compute_operations.
+# NEW/NEW and UPDATED/UPDATED are conflicts unless a and b are effectively equal
+ACTIONS = {
+    (CHANGE_NEW, CHANGE_NEW): (OPERATION_CONFLICT, "has been changed in both local and remote"),
+    (CHANGE_NEW, CHANGE_NONE): (OPERATION_COPY_A_TO_B, False),
+    (CHANGE_DELETED, CHANGE_DELETED): None,
+    (CHANGE_DELETED, CHANGE_SAME): (OPERATION_DELETE_FROM_B, False),
+    (CHANGE_DELETED, CHANGE_UPDATED): (OPERATION_CONFLICT, "has been deleted in local and updated in remote"),
+    (CHANGE_SAME, CHANGE_DELETED): (OPERATION_DELETE_FROM_A, False),
+    (CHANGE_SAME, CHANGE_SAME): None,
+    (CHANGE_SAME, CHANGE_UPDATED): (OPERATION_COPY_B_TO_A, True),
+    (CHANGE_UPDATED, CHANGE_DELETED): (OPERATION_CONFLICT, "has been changed in local and delete in remote"),
+    (CHANGE_UPDATED, CHANGE_SAME): (OPERATION_COPY_A_TO_B, True),
+    (CHANGE_UPDATED, CHANGE_UPDATED): (OPERATION_CONFLICT, "has been changed in both local and remote"),
+    (CHANGE_NONE, CHANGE_NEW): (OPERATION_COPY_B_TO_A, False)
+}
+
+def as_listing(paths):
+    """ Returns paths as a PathListing """
+    if isinstance(paths, PathListing):
+        return paths
+    return PathListing(paths.values())
+
+def aligned_positions(paths, listing):
+    """ Returns the position in listing of each of paths, -1 if missing """
+    return list(map(listing.positions.get, paths, itertools.repeat(-1)))
+
+def gather(listing, positions):
+    """ Returns the time stamps, sizes, kinds (KINDS) and checksums (None
+        if listing has none) of the elements of listing at positions.
+        Missing elements (position -1) are gathered from a last element
+        of kind MISSING
+    """
+    time_stamps = listing.time_stamps+array.array("q", [0])
+    sizes = listing.sizes+array.array("q", [0])
+    flags = listing.flags+array.array("B", [MISSING])
+    checksums = None
+    if listing.checksums is not None:
+        checksums = list(map((listing.checksums+[None]).__getitem__, positions))
+    return (list(map(time_stamps.__getitem__, positions)),
+            list(map(sizes.__getitem__, positions)),
+            bytes(map(flags.__getitem__, positions)).translate(KINDS),
+            checksums)
+
+def identical(old_columns, new_columns):
+    """ Returns an iterator telling for each aligned path whether it is
+        in both listings with the same time stamp, size, kind and (if
+        both listings have checksums) checksum: such paths did not change.
+        Columns are compared by map, so that only the other paths need
+        to be compared one by one
+    """
+    old_time_stamps, old_sizes, old_kinds, old_checksums = old_columns
+    new_time_stamps, new_sizes, new_kinds, new_checksums = new_columns
+    same = map(operator.and_,
+               map(operator.and_, map(operator.eq, old_time_stamps, new_time_stamps),
+                   map(operator.eq, old_sizes, new_sizes)),
+               map(operator.eq, old_kinds, new_kinds))
+    if old_checksums is not None and new_checksums is not None:
+        same = map(operator.and_, same, map(operator.eq, old_checksums, new_checksums))
+    return same
+
+def effectively_equal(listing_x, position_x, listing_y, position_y):
+    """ PathElement.is_effectively_equal_to on the columns of two listings
+        (the elements are known to have the same path)
+    """
+    flags_x = listing_x.flags[position_x]
+    flags_y = listing_y.flags[position_y]
+    if flags_x & flags_y & FLAG_DIRECTORY:
+        return True
+    if((flags_x ^ flags_y) & FLAG_DIRECTORY or
+       listing_x.sizes[position_x] != listing_y.sizes[position_y]):
+        return False
+    if listing_x.checksums is not None and listing_y.checksums is not None:
+        checksum_x = listing_x.checksums[position_x]
+        checksum_y = listing_y.checksums[position_y]
+        if checksum_x is not None and checksum_y is not None:
+            return checksum_x == checksum_y
+    return (abs(listing_x.time_stamps[position_x]-listing_y.time_stamps[position_y]) <
+            TOLERANCES[min(flags_x, flags_y) >> PRECISION_SHIFT])
+
+def change_code(old_listing, old_position, new_listing, new_position):
+    """ Returns the change (CHANGE_*) of a path from old_listing to new_listing """
+    if old_position < 0:
+        return CHANGE_NONE if new_position < 0 else CHANGE_NEW
+    if new_position < 0:
+        return CHANGE_DELETED
+    if effectively_equal(old_listing, old_position, new_listing, new_position):
+        return CHANGE_SAME
+    return CHANGE_UPDATED
+
+def diff_operations(paths_all, paths_a, paths_b_backup, paths_b):
+    """ Same as compute_operations, paths_b_backup is walked in its
+        order (the remote backup is read in tree order) and a and b
+        are aligned on it. Paths identical in the three listings are
+        skipped comparing whole columns, the changes of a and b of the
+        others, and of the paths that are not in the backup, are
+        computed and looked up in ACTIONS.
+        Raises ValueError on changes that cannot happen
+    """
+    listing_a = as_listing(paths_a)
+    listing_b_backup = as_listing(paths_b_backup)
+    listing_b = as_listing(paths_b)
+    # removed entries of the backup are None, they are never identical
+    backup_paths = listing_b_backup.paths
+    positions_a = aligned_positions(backup_paths, listing_a)
+    positions_b = aligned_positions(backup_paths, listing_b)
+    backup_columns = (listing_b_backup.time_stamps, listing_b_backup.sizes,
+                      bytes(listing_b_backup.flags).translate(KINDS), listing_b_backup.checksums)
+    unchanged = map(operator.and_,
+                    identical(backup_columns, gather(listing_a, positions_a)),
+                    identical(backup_columns, gather(listing_b, positions_b)))
+    changed = [(path, position_a, position_b_backup, positions_b[position_b_backup])
+               for path, position_a, position_b_backup in
+               itertools.compress(zip(backup_paths, positions_a, itertools.count()),
+                                  map(operator.not_, unchanged))
+               if path is not None]
+    # paths of a and b that are not in the backup
+    in_backup = listing_b_backup.positions.__contains__
+    new_paths = {}
+    for listing, positions in [(listing_a, positions_a), (listing_b, positions_b)]:
+        if len(listing) > len(positions)-positions.count(-1):
+            new_paths.update(dict.fromkeys(itertools.filterfalse(in_backup, listing.positions)))
+    changed += [(path, listing_a.positions.get(path, -1), -1, listing_b.positions.get(path, -1))
+                for path in new_paths]
+    flags_a = listing_a.flags
+    flags_b = listing_b.flags
+    operations = Operations()
+    lists = {
+        OPERATION_COPY_A_TO_B: operations.copy_a_to_b,
+        OPERATION_COPY_B_TO_A: operations.copy_b_to_a,
+        OPERATION_DELETE_FROM_A: operations.delete_from_a,
+        OPERATION_DELETE_FROM_B: operations.delete_from_b,
+        OPERATION_CONFLICT: operations.conflicts
+    }
+    for path, position_a, position_b_backup, position_b in changed:
+        if not path in paths_all:
+            continue
+        change_a = change_code(listing_b_backup, position_b_backup, listing_a, position_a)
+        change_b = change_code(listing_b_backup, position_b_backup, listing_b, position_b)
+        if(position_a >= 0 and position_b >= 0 and
+           (flags_a[position_a] ^ flags_b[position_b]) & FLAG_DIRECTORY):
+            operations.add_conflict(path, "is a file on one side and a directory in the other")
+            continue
+        try:
+            action = ACTIONS[(change_a, change_b)]
+        except KeyError:
+            raise ValueError("Unsupported synchronization case for "+path)
+        if action is None:
+            continue
+        operation, argument = action
+        if(operation == OPERATION_CONFLICT and change_a == change_b and
+           effectively_equal(listing_a, position_a, listing_b, position_b)):
+            #same file and local and remote: backup is out of sync?
+            continue
+        lists[operation].append((path, argument))
+    return operations
@@ -0,0 +1,178 @@
+"""
+Exclude matchers, used to filter out paths
+that must not be synchronized
+"""
+
+import os
+import re
+import json
+import fnmatch
+import threading
+
+from .const import * # pylint: disable=unused-wildcard-import
+
+class GlobalExcludes(object):
+    """ Global excludes compiled into two regular expressions:
+        one for patterns matched against basenames (patterns
+        without a "/") and one for patterns matched against
+        the whole path. Each path is evaluated once.
+    """
+    def __init__(self, global_excludes, rel_path=None):
+        basename_patterns = []
+        path_patterns = []
+        for global_path_to_exclude in global_excludes:
+            if "/" in global_path_to_exclude and rel_path is not None and rel_path != "" and rel_path != ".":
+                path_to_exclude = os.path.relpath(global_path_to_exclude, rel_path)
+            else:
+                path_to_exclude = global_path_to_exclude
+            if "/" in path_to_exclude:
+                path_patterns.append(fnmatch.translate(path_to_exclude))
+            else:
+                basename_patterns.append(fnmatch.translate(path_to_exclude))
+        self.basename_regex = self.compile(basename_patterns)
+        self.path_regex = self.compile(path_patterns)
+
+    @staticmethod
+    def compile(patterns):
+        """ Compiles translated patterns into a single regular expression """
+        if not patterns:
+            return None
+        return re.compile("|".join(patterns))
+
+    def matches(self, path):
+        """ Returns True if path is excluded """
+        if self.path_regex is not None and self.path_regex.match(path):
+            return True
+        if self.basename_regex is not None and self.basename_regex.match(path.rpartition("/")[2]):
+            return True
+        return False
+
+    def filter(self, paths):
+        """ Returns the set of paths that are not excluded """
+        return set(path for path in paths if not self.matches(path))
+
+class LocalExcludes(object):
+    """ Compiled .upback.exclude files of a local branch.
+        Each line of an exclude file is a pattern matched against
+        the elements of the directory containing the file; patterns
+        starting with **/ are also matched against the elements of
+        all its subdirectories.
+        Exclude files are read and compiled once per run, compiled
+        patterns are cached across runs in cache_path, keyed by the
+        exclude file modification time and size.
+    """
+    CACHE_VERSION = 1
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.cache = {}
+        self.cache_changed = False
+        self.matchers = {}
+        self.directories = {}
+        self.lock = threading.Lock()
+        if cache_path is not None:
+            self.load()
+
+    def load(self):
+        """ Loads compiled patterns from the cache file """
+        try:
+            with open(self.cache_path, "r") as cache_fp:
+                cache_json = json.load(cache_fp)
+            if cache_json["version"] == self.CACHE_VERSION:
+                self.cache = cache_json["directories"]
+        except (IOError, ValueError, KeyError, TypeError):
+            self.cache = {}
+
+    def save(self):
+        """ Writes the cache file, if anything changed """
+        if self.cache_path is None or not self.cache_changed:
+            return
+        with open(self.cache_path, "w") as cache_fp:
+            json.dump({"version": self.CACHE_VERSION, "directories": self.cache}, cache_fp)
+        self.cache_changed = False
+
+    def patterns(self, directory_path, exclude_stat):
+        """ Returns the (plain, doublestar) translated patterns in
+            the exclude file of directory_path.
+            exclude_stat is the stat of the exclude file, None if absent
+        """
+        key = os.path.abspath(directory_path)
+        with self.lock:
+            cached = self.cache.get(key)
+            if exclude_stat is None:
+                if cached is not None:
+                    del self.cache[key]
+                    self.cache_changed = True
+                return ((), ())
+            if(cached is not None and cached[0] == exclude_stat.st_mtime_ns and
+               cached[1] == exclude_stat.st_size):
+                return (tuple(cached[2]), tuple(cached[3]))
+        plain_patterns = []
+        doublestar_patterns = []
+        for line in read_exclude_file(directory_path):
+            if line.startswith("**/"):
+                doublestar_patterns.append(fnmatch.translate(line[3:]))
+            else:
+                plain_patterns.append(fnmatch.translate(line))
+        with self.lock:
+            self.cache[key] = [exclude_stat.st_mtime_ns, exclude_stat.st_size,
+                               plain_patterns, doublestar_patterns]
+            self.cache_changed = True
+        return (tuple(plain_patterns), tuple(doublestar_patterns))
+
+    def directory_matcher(self, directory_path, exclude_stat, inherited_patterns=()):
+        """ Returns (matcher, doublestar_patterns) for directory_path.
+            matcher is a compiled regular expression matching the
+            names of the excluded elements of directory_path (None if
+            nothing is excluded), doublestar_patterns must be passed
+            as inherited_patterns for its subdirectories
+        """
+        plain_patterns, doublestar_patterns = self.patterns(directory_path, exclude_stat)
+        doublestar_patterns = inherited_patterns + doublestar_patterns
+        patterns = plain_patterns + doublestar_patterns
+        if not patterns:
+            return (None, doublestar_patterns)
+        matcher = self.matchers.get(patterns)
+        if matcher is None:
+            matcher = re.compile("|".join(patterns))
+            self.matchers[patterns] = matcher
+        return (matcher, doublestar_patterns)
+
+    def is_excluded(self, root, path):
+        """ Returns True if path (relative to root) is excluded by
+            the exclude files found in root or its subdirectories
+        """
+        components = path.split("/")
+        directory = ""
+        for component in components:
+            matcher, _ = self.matcher_for(root, directory)
+            if matcher is not None and matcher.match(component):
+                return True
+            directory = component if directory == "" else directory+"/"+component
+        return False
+
+    def matcher_for(self, root, directory):
+        """ Memoized directory_matcher for directory (relative to root) """
+        key = (root, directory)
+        if key not in self.directories:
+            inherited_patterns = ()
+            if directory != "":
+                _, inherited_patterns = self.matcher_for(root, directory.rpartition("/")[0])
+            directory_path = os.path.join(root, directory)
+            try:
+                exclude_stat = os.stat(os.path.join(directory_path, UPBACK_EXCLUDE_FILE))
+            except OSError:
+                exclude_stat = None
+            self.directories[key] = self.directory_matcher(directory_path, exclude_stat,
+                                                           inherited_patterns)
+        return self.directories[key]
+
+def read_exclude_file(directory_path):
+    """ Returns the lines of the exclude file in directory_path
+    """
+    lines = []
+    exclude_path = os.path.join(directory_path, UPBACK_EXCLUDE_FILE)
+    if os.path.exists(exclude_path):
+        with open(exclude_path, "r") as exclude_fp:
+            lines += exclude_fp.read().splitlines()
+    return lines
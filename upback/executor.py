@@ -0,0 +1,312 @@
+"""
+Operation executors, used to apply the synchronization
+operations computed by compute_operations
+"""
+
+import logging
+import threading
+import subprocess
+import contextvars
+import concurrent.futures
+
+from .rclone import RClone
+from .operations import ExecutionResult, compact_deletes
+from .util import rebase
+from .const import * # pylint: disable=unused-wildcard-import
+
+# copy operation creating elements in the same side as a move
+CREATING_OPERATION = {OPERATION_MOVE_IN_B: OPERATION_COPY_A_TO_B, OPERATION_MOVE_IN_A: OPERATION_COPY_B_TO_A}
+
+class OperationsExecutor(object):
+    """ Performs operations invoking rclone once per path.
+        Operations are organized in phases, each phase is a list
+        of tasks; a task is an (operation, paths, action) tuple
+        where action is a callable returning a dictionary of the
+        paths that failed with the corresponding error messages.
+        Phases are run in order, the tasks of a phase are run
+        by up to jobs concurrent workers.
+    """
+    def __init__(self, remote, rel_path, no_backup, remote_backup=None, backup_suffix=None, jobs=1):
+        self.rclone = RClone()
+        self.remote = remote
+        self.rel_path = rel_path
+        self.remote_root = rebase(rel_path, remote) if rel_path else remote
+        self.no_backup = no_backup
+        self.remote_backup = remote_backup
+        self.backup_suffix = backup_suffix
+        self.jobs = jobs
+
+    def remote_path(self, path):
+        """ Path in remote corresponding to a local (relative) path """
+        return rebase(rebase(path, self.rel_path), self.remote)
+
+    def backup_options(self, backup):
+        """ Backup arguments for rclone operations on the remote """
+        return (backup and not self.no_backup, self.remote_backup, self.backup_suffix)
+
+    def execute(self, operations, paths_a, paths_b, journal=None):
+        """ Performs operations, returns an ExecutionResult.
+            Completed operations are recorded in journal, if given
+        """
+        result = ExecutionResult(journal)
+        for source, dest, _ in operations.move_in_a+operations.move_in_b:
+            result.sources[dest] = source
+        for phase in self.plan(operations, paths_a, paths_b):
+            self.run_phase(phase, result)
+        return result
+
+    def plan(self, operations, paths_a, paths_b):
+        """ Returns the phases to perform operations
+        """
+        mkdir_tasks = []
+        copy_tasks = []
+        for path, backup in operations.copy_a_to_b:
+            if paths_a[path].is_directory:
+                action = self.action(self.rclone.mkdir, self.remote_path(path))
+                mkdir_tasks.append((OPERATION_COPY_A_TO_B, [path], action))
+            else:
+                action = self.action(self.rclone.copy, path, self.remote_path(path),
+                                     *self.backup_options(backup))
+                copy_tasks.append((OPERATION_COPY_A_TO_B, [path], action))
+        for path, _ in operations.copy_b_to_a:
+            if paths_b[path].is_directory:
+                action = self.action(self.rclone.mkdir, path)
+                mkdir_tasks.append((OPERATION_COPY_B_TO_A, [path], action))
+            else:
+                action = self.action(self.rclone.copy, self.remote_path(path), path)
+                copy_tasks.append((OPERATION_COPY_B_TO_A, [path], action))
+        delete_tasks = []
+        purge_tasks = []
+        for path, _ in compact_deletes(operations.delete_from_a, paths_a):
+            if paths_a[path].is_directory:
+                action = self.action(self.rclone.purge, path)
+                purge_tasks.append((OPERATION_DELETE_FROM_A, [path], action))
+            else:
+                action = self.action(self.rclone.delete, path)
+                delete_tasks.append((OPERATION_DELETE_FROM_A, [path], action))
+        for path, backup in compact_deletes(operations.delete_from_b, paths_b):
+            if paths_b[path].is_directory:
+                action = self.action(self.rclone.purge, self.remote_path(path),
+                                     *self.backup_options(backup))
+                purge_tasks.append((OPERATION_DELETE_FROM_B, [path], action))
+            else:
+                action = self.action(self.rclone.delete, self.remote_path(path),
+                                     *self.backup_options(backup))
+                delete_tasks.append((OPERATION_DELETE_FROM_B, [path], action))
+        copy_tasks += self.move_tasks(operations)
+        return self.phases(mkdir_tasks, copy_tasks, delete_tasks, purge_tasks)
+
+    def move_tasks(self, operations):
+        """ Tasks moving files, recorded by destination path.
+            Moves run with the copies, before the directories
+            they were moved from are deleted
+        """
+        tasks = []
+        for source, dest, _ in operations.move_in_a:
+            action = self.action(self.rclone.move, source, dest)
+            tasks.append((OPERATION_MOVE_IN_A, [dest], action))
+        for source, dest, backup in operations.move_in_b:
+            action = self.action(self.rclone.move, self.remote_path(source), self.remote_path(dest),
+                                 *self.backup_options(backup))
+            tasks.append((OPERATION_MOVE_IN_B, [dest], action))
+        return tasks
+
+    @staticmethod
+    def phases(mkdir_tasks, copy_tasks, delete_tasks, purge_tasks, check_tasks=()):
+        """ Orders tasks in phases so that tasks in the same phase
+            are independent and can be run concurrently:
+            directories are created one depth level at a time,
+            then files are copied (or moved), then the outcome of
+            the copies is checked (check_tasks), then files and
+            finally directories are deleted
+        """
+        mkdir_phases = {}
+        for task in mkdir_tasks:
+            _, paths, _ = task
+            mkdir_phases.setdefault(paths[0].count("/"), []).append(task)
+        phases = [mkdir_phases[depth] for depth in sorted(mkdir_phases)]
+        return phases + [copy_tasks, list(check_tasks), delete_tasks, purge_tasks]
+
+    @staticmethod
+    def action(function, *args):
+        """ Wraps a single-path rclone operation into a task action """
+        def run_action():
+            function(*args)
+            return {}
+        return run_action
+
+    def run_phase(self, tasks, result):
+        """ Runs the tasks of a phase, using up to jobs
+            concurrent workers
+        """
+        if self.jobs > 1 and len(tasks) > 1:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+            try:
+                #workers run in the context of the caller (e.g. a run_all branch)
+                futures = [executor.submit(contextvars.copy_context().run, self.run_task, task, result)
+                           for task in tasks]
+                for future in futures:
+                    future.result()
+            finally:
+                #on errors (e.g. KeyboardInterrupt) the tasks not started yet are dropped
+                executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            for task in tasks:
+                self.run_task(task, result)
+
+    @staticmethod
+    def run_task(task, result):
+        """ Runs a task recording the outcome for each of its paths """
+        operation, paths, action = task
+        try:
+            failures = action()
+        except subprocess.CalledProcessError as error:
+            failures = dict.fromkeys(paths, error.output.strip())
+        except Exception as error:
+            #e.g. an OSError writing the --files-from file
+            failures = dict.fromkeys(paths, str(error))
+        for path in paths:
+            if path in failures:
+                logging.warning(path+": "+failures[path])
+                result.add_failed(operation, path, failures[path])
+            else:
+                result.add_completed(operation, path)
+
+class BatchOperationsExecutor(OperationsExecutor):
+    """ Performs operations grouping them by direction and backup
+        settings, each group is transferred by a single rclone
+        invocation using --files-from (in chunks of batch_size paths)
+    """
+    def __init__(self, remote, rel_path, no_backup, remote_backup=None, backup_suffix=None, jobs=1,
+                 batch_size=BATCH_SIZE_DEFAULT):
+        super(BatchOperationsExecutor, self).__init__(remote, rel_path, no_backup,
+                                                      remote_backup, backup_suffix, jobs)
+        self.batch_size = batch_size
+        # paths created by the completed tasks, keyed by copy operation
+        self.created = {OPERATION_COPY_A_TO_B: set(), OPERATION_COPY_B_TO_A: set()}
+        self.created_lock = threading.Lock()
+
+    def plan(self, operations, paths_a, paths_b):
+        """ Returns the phases to perform operations
+        """
+        mkdir_tasks = []
+        check_tasks = []
+        for operation, copy_ops, path_elements, target_path in [
+                (OPERATION_COPY_A_TO_B, operations.copy_a_to_b, paths_a, self.remote_path),
+                (OPERATION_COPY_B_TO_A, operations.copy_b_to_a, paths_b, lambda path: path)]:
+            tasks, implicit_directories = self.mkdir_tasks(operation, copy_ops, path_elements, target_path)
+            mkdir_tasks += tasks
+            if implicit_directories:
+                check_tasks.append(self.implicit_directories_task(operation, implicit_directories))
+        copy_tasks = []
+        for backup, files in self.group_files(operations.copy_a_to_b, paths_a):
+            for chunk in self.chunks(files):
+                action = self.batch_action(self.rclone.copy_files, ".", self.remote_root, chunk,
+                                           *self.backup_options(backup))
+                copy_tasks.append((OPERATION_COPY_A_TO_B, chunk, action))
+        for _, files in self.group_files(operations.copy_b_to_a, paths_b):
+            for chunk in self.chunks(files):
+                action = self.batch_action(self.rclone.copy_files, self.remote_root, ".", chunk)
+                copy_tasks.append((OPERATION_COPY_B_TO_A, chunk, action))
+        delete_tasks = []
+        purge_tasks = []
+        deletes_a = compact_deletes(operations.delete_from_a, paths_a)
+        for path, _ in deletes_a:
+            if paths_a[path].is_directory:
+                purge_tasks.append((OPERATION_DELETE_FROM_A, [path],
+                                    self.action(self.rclone.purge, path)))
+        for _, files in self.group_files(deletes_a, paths_a):
+            for chunk in self.chunks(files):
+                action = self.batch_action(self.rclone.delete_files, ".", chunk)
+                delete_tasks.append((OPERATION_DELETE_FROM_A, chunk, action))
+        deletes_b = compact_deletes(operations.delete_from_b, paths_b)
+        for path, backup in deletes_b:
+            if paths_b[path].is_directory:
+                action = self.action(self.rclone.purge, self.remote_path(path),
+                                     *self.backup_options(backup))
+                purge_tasks.append((OPERATION_DELETE_FROM_B, [path], action))
+        for backup, files in self.group_files(deletes_b, paths_b):
+            for chunk in self.chunks(files):
+                action = self.batch_action(self.rclone.delete_files, self.remote_root, chunk,
+                                           *self.backup_options(backup))
+                delete_tasks.append((OPERATION_DELETE_FROM_B, chunk, action))
+        copy_tasks += self.move_tasks(operations)
+        return self.phases([self.recording_task(task) for task in mkdir_tasks],
+                           [self.recording_task(task) for task in copy_tasks],
+                           delete_tasks, purge_tasks, check_tasks)
+
+    def mkdir_tasks(self, operation, copy_ops, path_elements, target_path):
+        """ Tasks creating the directories in copy_ops.
+            Only directories that do not contain other copied elements
+            are explicitly created, the others are created along with
+            their contents.
+            Returns the tasks and the directories created implicitly
+        """
+        tasks = []
+        directories = []
+        implicit_directories = set()
+        for path, _ in copy_ops:
+            if path_elements[path].is_directory:
+                directories.append(path)
+            parent = path.rpartition("/")[0]
+            while parent and parent not in implicit_directories:
+                implicit_directories.add(parent)
+                parent = parent.rpartition("/")[0]
+        for path in directories:
+            if not path in implicit_directories:
+                tasks.append((operation, [path], self.action(self.rclone.mkdir, target_path(path))))
+        return tasks, [path for path in directories if path in implicit_directories]
+
+    def recording_task(self, task):
+        """ Wraps a task creating elements so that the paths it
+            completes are recorded, see implicit_directories_task
+        """
+        operation, paths, action = task
+        created = self.created[CREATING_OPERATION.get(operation, operation)]
+        def run_action():
+            failures = action()
+            with self.created_lock:
+                created.update(path for path in paths if not path in failures)
+            return failures
+        return (operation, paths, run_action)
+
+    def implicit_directories_task(self, operation, directories):
+        """ Task completing the directories created along with their
+            contents: a directory exists only if some element below
+            it was created, otherwise it is failed
+        """
+        created = self.created[operation]
+        def run_action():
+            parents = set()
+            with self.created_lock:
+                for path in created:
+                    parent = path.rpartition("/")[0]
+                    while parent and parent not in parents:
+                        parents.add(parent)
+                        parent = parent.rpartition("/")[0]
+            return dict((path, "no element was created in the directory")
+                        for path in directories if not path in parents)
+        return (operation, directories, run_action)
+
+    @staticmethod
+    def group_files(ops, path_elements):
+        """ Groups the files (directories are skipped) in ops by backup flag.
+            Returns a list of (backup, paths) tuples
+        """
+        groups = {}
+        for path, backup in ops:
+            if not path_elements[path].is_directory:
+                groups.setdefault(backup, []).append(path)
+        return sorted(groups.items())
+
+    def chunks(self, paths):
+        """ Splits paths in lists of at most batch_size elements """
+        for start in range(0, len(paths), self.batch_size):
+            yield paths[start:start+self.batch_size]
+
+    @staticmethod
+    def batch_action(function, *args):
+        """ Wraps a --files-from rclone operation into a task action """
+        def run_action():
+            return function(*args)
+        return run_action
@@ -0,0 +1,168 @@
+"""
+Checksums of local files, computed by a pool of processes
+and cached across runs
+"""
+
+import os
+import json
+import time
+import zlib
+import hashlib
+import logging
+import concurrent.futures
+
+READ_SIZE = 1048576
+# files are hashed in the calling process below this number
+POOL_MIN_FILES = 16
+
+class HashCache(object):
+    """ Persistent cache of the checksums of local files, keyed by
+        device and inode and valid as long as size and modification
+        time do not change, so that unchanged (or moved) files are
+        never hashed again.
+    """
+    VERSION = 1
+    # files modified less than this before being hashed are not cached:
+    # further changes in the same timestamp granularity would go unnoticed
+    RACY_INTERVAL_NS = 2000000000
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.checksums = {}
+        self.seen = set()
+        if cache_path is not None:
+            self.load()
+
+    def load(self):
+        """ Loads the cache from cache_path """
+        try:
+            with open(self.cache_path, "r") as cache_fp:
+                cache_json = json.load(cache_fp)
+            if cache_json["version"] == self.VERSION:
+                self.checksums = cache_json["checksums"]
+        except (IOError, ValueError, KeyError, TypeError):
+            self.checksums = {}
+
+    def save(self, prune=False):
+        """ Writes the cache to cache_path, if prune is set
+            dropping the files that were not looked up
+        """
+        if self.cache_path is None:
+            return
+        if prune:
+            self.checksums = dict((key, value) for key, value in self.checksums.items() if key in self.seen)
+        with open(self.cache_path, "w") as cache_fp:
+            json.dump({"version": self.VERSION, "checksums": self.checksums}, cache_fp,
+                      separators=(",", ":"))
+
+    @staticmethod
+    def key(file_stat):
+        """ Cache key of a file """
+        return str(file_stat.st_dev)+":"+str(file_stat.st_ino)
+
+    def get(self, file_stat, hash_type):
+        """ Returns the cached checksum of a file, None if not cached
+            or if the file changed since it was hashed
+        """
+        key = self.key(file_stat)
+        self.seen.add(key)
+        cached = self.checksums.get(key)
+        if(cached is None or cached[0] != file_stat.st_size or cached[1] != file_stat.st_mtime_ns or
+           not cached[2].startswith(hash_type+":")):
+            return None
+        return cached[2]
+
+    def update(self, file_stat, checksum, hash_time_ns):
+        """ Stores the checksum of a file hashed at hash_time_ns """
+        key = self.key(file_stat)
+        if hash_time_ns - file_stat.st_mtime_ns < self.RACY_INTERVAL_NS:
+            self.checksums.pop(key, None)
+            return
+        self.checksums[key] = [file_stat.st_size, file_stat.st_mtime_ns, checksum]
+
+def file_checksum(file_path, hash_type):
+    """ Returns the "type:hex digest" checksum of a file,
+        hex digests are the ones rclone hashsum prints
+    """
+    with open(file_path, "rb") as file_fp:
+        if hash_type == "crc32":
+            crc = 0
+            for chunk in iter(lambda: file_fp.read(READ_SIZE), b""):
+                crc = zlib.crc32(chunk, crc)
+            return hash_type+":"+"%08x" % crc
+        digest = hashlib.new(hash_type)
+        for chunk in iter(lambda: file_fp.read(READ_SIZE), b""):
+            digest.update(chunk)
+        return hash_type+":"+digest.hexdigest()
+
+def hash_files(root, paths, hash_type, cache=None, processes=0):
+    """ Sets the checksum of the files in paths (a dictionary of
+        PathElements relative to root) that do not have one.
+        Cached checksums are used when possible, the other files
+        are hashed by up to processes processes (0 for one per CPU).
+        Files that cannot be read keep no checksum.
+        Returns the number of files hashed
+    """
+    if cache is None:
+        cache = HashCache()
+    to_hash = []
+    cached = []
+    for path, path_element in paths.items():
+        if path_element.is_directory or path_element.checksum is not None:
+            continue
+        try:
+            file_stat = os.stat(os.path.join(root, path))
+        except OSError:
+            continue
+        if file_stat.st_size != path_element.size or file_stat.st_mtime_ns != path_element.time_stamp:
+            # changed after being listed: it will be compared again next time
+            continue
+        checksum = cache.get(file_stat, hash_type)
+        if checksum is None:
+            to_hash.append((path, file_stat))
+        else:
+            path_element.checksum = checksum
+            cached.append(path_element)
+    for path_element in cached:
+        paths[path_element.path] = path_element
+    if not to_hash:
+        return 0
+    logging.info("Hashing "+str(len(to_hash))+" files")
+    hash_time_ns = time.time_ns()
+    file_paths = [os.path.join(root, path) for path, _ in to_hash]
+    hash_types = [hash_type]*len(file_paths)
+    executor = None
+    if len(to_hash) < POOL_MIN_FILES or processes == 1:
+        checksums = map(checksum_or_none, file_paths, hash_types)
+    else:
+        processes = processes or os.cpu_count() or 1
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+        checksums = executor.map(checksum_or_none, file_paths, hash_types,
+                                 chunksize=max(1, len(file_paths)//(4*processes)))
+    try:
+        for (path, file_stat), checksum in zip(to_hash, checksums):
+            if checksum is None:
+                continue
+            cache.update(file_stat, checksum, hash_time_ns)
+            path_element = paths[path]
+            path_element.checksum = checksum
+            paths[path] = path_element
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return len(to_hash)
+
+def checksum_or_none(file_path, hash_type):
+    """ file_checksum, None if the file cannot be read """
+    try:
+        return file_checksum(file_path, hash_type)
+    except OSError as error:
+        logging.warning("Cannot hash "+file_path+": "+str(error))
+        return None
+
+def checksum_type(paths):
+    """ Type of the first checksum found in paths, None if there is none """
+    for path_element in paths.values():
+        if path_element.checksum is not None:
+            return path_element.checksum.partition(":")[0]
+    return None
@@ -0,0 +1,227 @@
+"""
+Journal class, write-ahead log of the operations of a
+synchronization, used to resume it when it is interrupted
+"""
+
+import os
+import json
+import time
+import threading
+
+from .path_element import PathElement
+from .path_listing import PathListing
+from .operations import Operations
+from .const import * # pylint: disable=unused-wildcard-import
+
+# operation lists of Operations and the operation their paths are recorded with
+OPERATION_LISTS = [(OPERATION_COPY_A_TO_B, "copy_a_to_b"), (OPERATION_COPY_B_TO_A, "copy_b_to_a"),
+                   (OPERATION_DELETE_FROM_A, "delete_from_a"), (OPERATION_DELETE_FROM_B, "delete_from_b"),
+                   (OPERATION_MOVE_IN_A, "move_in_a"), (OPERATION_MOVE_IN_B, "move_in_b")]
+MOVES = (OPERATION_MOVE_IN_A, OPERATION_MOVE_IN_B)
+
+class Journal(object):
+    """ Journal of a synchronization (.upback.journal), one JSON
+        document per line. The first line is the plan: the operations
+        to perform and the local, remote and backup elements of the
+        paths they involve. Each following line is an [operation, path]
+        pair recorded when the operation completes (moves are recorded
+        by destination, as in ExecutionResult).
+        Every checkpoint_interval seconds the journal is synced to disk
+        and checkpoint (a callable) is called with the journal and the
+        number of completed operations synced, to save the state reached
+        in the backup. Operations keep being recorded meanwhile.
+        A journal left by an interrupted run gives the operations still
+        to perform, without listing and comparing the branch again
+    """
+    VERSION = 1
+
+    def __init__(self, journal_path, checkpoint=None, checkpoint_interval=JOURNAL_CHECKPOINT_INTERVAL):
+        self.journal_path = journal_path
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.rel_path = ""
+        self.remote = None
+        self.operations = Operations()
+        # elements of the paths involved in the operations, as they were when planned
+        self.local_elements = PathListing()
+        self.remote_elements = PathListing()
+        self.backup_elements = PathListing()
+        self.completed = []
+        # completed operations already applied to the remote listing (see apply_journal)
+        self.applied = 0
+        self.lock = threading.RLock()
+        # held while a checkpoint is saved, checkpoints are saved one at a time
+        self.checkpoint_lock = threading.Lock()
+        self.journal_fp = None
+        self.last_checkpoint = time.monotonic()
+
+    def create(self, rel_path, remote, operations, paths_a, paths_b, paths_b_backup):
+        """ Writes the plan of a synchronization of rel_path with remote,
+            the journal is then ready to record completed operations
+        """
+        self.rel_path = rel_path
+        self.remote = remote
+        self.operations = operations
+        for path in self.paths(operations):
+            for elements, paths in [(self.local_elements, paths_a), (self.remote_elements, paths_b),
+                                    (self.backup_elements, paths_b_backup)]:
+                path_element = paths.get(path)
+                if path_element is not None:
+                    elements[path] = path_element
+        plan = {
+            "version": self.VERSION,
+            "rel_path": rel_path,
+            "remote": remote,
+            "operations": dict((name, getattr(operations, name)) for _, name in OPERATION_LISTS),
+            "local_elements": [path_element.as_tuple() for path_element in self.local_elements.values()],
+            "remote_elements": [path_element.as_tuple() for path_element in self.remote_elements.values()],
+            "backup_elements": [path_element.as_tuple() for path_element in self.backup_elements.values()]
+        }
+        self.journal_fp = open(self.journal_path, "w")
+        self.journal_fp.write(json.dumps(plan, separators=(",", ":"))+"\n")
+        self.sync()
+        self.last_checkpoint = time.monotonic()
+
+    def load(self):
+        """ Reads the journal left by an interrupted run, then the
+            journal is ready to record the operations completed by the
+            next one. Returns False if there is no journal (a journal
+            whose plan was not completely written is removed: none of
+            its operations was performed), raises ValueError if it is
+            not valid
+        """
+        try:
+            with open(self.journal_path, "rb") as journal_fp:
+                data = journal_fp.read()
+        except FileNotFoundError:
+            return False
+        # complete lines end with a newline, the last one is empty or incomplete
+        lines = data.split(b"\n")
+        if len(lines) < 2:
+            os.remove(self.journal_path)
+            return False
+        try:
+            plan = json.loads(lines[0])
+            if plan["version"] != self.VERSION:
+                raise ValueError("Unsupported journal version "+str(plan["version"]))
+            self.rel_path = plan["rel_path"]
+            self.remote = plan["remote"]
+            self.operations = Operations()
+            for _, name in OPERATION_LISTS:
+                setattr(self.operations, name, [tuple(op) for op in plan["operations"][name]])
+            self.local_elements = PathListing(PathElement(*values) for values in plan["local_elements"])
+            self.remote_elements = PathListing(PathElement(*values) for values in plan["remote_elements"])
+            self.backup_elements = PathListing(PathElement(*values) for values in plan["backup_elements"])
+        except (KeyError, TypeError) as error:
+            raise ValueError("Invalid journal: "+str(error))
+        length = len(lines[0])+1
+        for line in lines[1:-1]:
+            try:
+                operation, path = json.loads(line)
+            except (ValueError, TypeError):
+                #written when the run was interrupted, its operation is performed again
+                break
+            self.completed.append((operation, path))
+            length += len(line)+1
+        if length < len(data):
+            #new records must not follow a damaged one
+            os.truncate(self.journal_path, length)
+        self.journal_fp = open(self.journal_path, "a")
+        self.last_checkpoint = time.monotonic()
+        return True
+
+    def record(self, operation, path):
+        """ Records a completed operation, saving a checkpoint if
+            checkpoint_interval elapsed since the last one
+        """
+        with self.lock:
+            self.journal_fp.write(json.dumps([operation, path])+"\n")
+            self.journal_fp.flush()
+            self.completed.append((operation, path))
+            checkpoint_due = self.checkpoint is not None and \
+                time.monotonic()-self.last_checkpoint >= self.checkpoint_interval
+            if checkpoint_due:
+                #the other workers do not save it as well
+                self.last_checkpoint = time.monotonic()
+        if checkpoint_due:
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        """ Syncs the journal, so that the checkpoint never includes
+            operations the journal could lose, and saves a checkpoint
+            of the operations completed so far. The lock is held only
+            to take their number: the other workers keep recording
+            while the journal is synced and the checkpoint is saved
+        """
+        with self.checkpoint_lock:
+            with self.lock:
+                self.journal_fp.flush()
+                completed = len(self.completed)
+            os.fsync(self.journal_fp.fileno())
+            self.checkpoint(self, completed)
+            self.last_checkpoint = time.monotonic()
+
+    def sync(self):
+        """ Writes the journal to disk """
+        self.journal_fp.flush()
+        os.fsync(self.journal_fp.fileno())
+
+    def sources(self):
+        """ Source of each moved path, keyed by destination """
+        return dict((dest, source) for source, dest, _ in self.operations.move_in_a+self.operations.move_in_b)
+
+    def done(self, completed=None):
+        """ Set of the (operation, path) pairs completed (the first
+            completed ones, if given), including the deletions of the
+            contents of deleted directories
+        """
+        with self.lock:
+            done = set(self.completed[:completed])
+        for operation, name, elements in [(OPERATION_DELETE_FROM_A, "delete_from_a", self.local_elements),
+                                          (OPERATION_DELETE_FROM_B, "delete_from_b", self.remote_elements)]:
+            prefixes = tuple(path+"/" for done_operation, path in done
+                             if done_operation == operation and path in elements and elements[path].is_directory)
+            if prefixes:
+                for path, _ in getattr(self.operations, name):
+                    if path.startswith(prefixes):
+                        done.add((operation, path))
+        return done
+
+    def pending_operations(self, completed=None):
+        """ The operations of the plan not completed yet
+            (not among the first completed ones, if given)
+        """
+        done = self.done(completed)
+        operations = Operations()
+        for operation, name in OPERATION_LISTS:
+            setattr(operations, name, [op for op in getattr(self.operations, name)
+                                       if (operation, op[1] if operation in MOVES else op[0]) not in done])
+        return operations
+
+    def pending_paths(self, completed=None):
+        """ Paths involved in the operations not completed yet
+            (see pending_operations)
+        """
+        return self.paths(self.pending_operations(completed))
+
+    @staticmethod
+    def paths(operations):
+        """ Paths involved in operations (sources and destinations of moves) """
+        paths = set()
+        for operation, name in OPERATION_LISTS:
+            for op in getattr(operations, name):
+                paths.add(op[0])
+                if operation in MOVES:
+                    paths.add(op[1])
+        return paths
+
+    def close(self):
+        """ Closes the journal, leaving it to be resumed """
+        if self.journal_fp is not None:
+            self.journal_fp.close()
+            self.journal_fp = None
+
+    def remove(self):
+        """ Closes and removes the journal of a completed synchronization """
+        self.close()
+        os.remove(self.journal_path)
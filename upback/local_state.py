@@ -0,0 +1,114 @@
+"""
+LocalState class, a persistent index of the local branch
+used to avoid listing directories that did not change
+"""
+
+import os
+import json
+import time
+import stat
+import logging
+
+class LocalState(object):
+    """ Persistent index of the directories of a local branch.
+        For each directory the index stores its modification time,
+        its inode and its entries as (name, is_directory, size, mtime_ns).
+        A directory whose modification time and inode did not change
+        since the last run has the same entries, so it is not listed
+        again. Modifying a file in place does not change the directory
+        modification time: unless trust_directory_mtime is set the
+        entries of unchanged directories are still checked with lstat.
+    """
+    VERSION = 1
+    # directories modified less than this before a scan are not indexed:
+    # further changes in the same timestamp granularity would go unnoticed
+    RACY_INTERVAL_NS = 2000000000
+
+    def __init__(self, state_path=None, trust_directory_mtime=False):
+        self.state_path = state_path
+        self.trust_directory_mtime = trust_directory_mtime
+        self.directories = {}
+        self.scanned_roots = set()
+        self.seen = set()
+        self.scan_time_ns = time.time_ns()
+        if state_path is not None:
+            self.load()
+
+    def load(self):
+        """ Loads the index from state_path """
+        try:
+            with open(self.state_path, "r") as state_fp:
+                state_json = json.load(state_fp)
+            if state_json["version"] == self.VERSION:
+                self.directories = state_json["directories"]
+        except (IOError, ValueError, KeyError, TypeError):
+            self.directories = {}
+
+    def save(self):
+        """ Writes the index to state_path, dropping the directories
+            that were not found under the scanned roots
+        """
+        if self.state_path is None:
+            return
+        for directory_key in list(self.directories):
+            if directory_key not in self.seen and self.is_under_scanned_root(directory_key):
+                del self.directories[directory_key]
+        with open(self.state_path, "w") as state_fp:
+            json.dump({"version": self.VERSION, "directories": self.directories}, state_fp,
+                      separators=(",", ":"))
+
+    def is_under_scanned_root(self, directory_key):
+        """ Returns True if directory_key has been scanned in this run """
+        for root in self.scanned_roots:
+            if directory_key == root or directory_key.startswith(root+os.sep):
+                return True
+        return False
+
+    def add_scanned_root(self, root):
+        """ Records that root is being scanned """
+        self.scanned_roots.add(os.path.abspath(root))
+
+    def listing(self, directory_path, directory_stat):
+        """ Returns the indexed entries of directory_path if it did
+            not change, None otherwise
+        """
+        directory_key = os.path.abspath(directory_path)
+        self.seen.add(directory_key)
+        indexed = self.directories.get(directory_key)
+        if(indexed is None or indexed[0] != directory_stat.st_mtime_ns or
+           indexed[1] != directory_stat.st_ino):
+            return None
+        entries = [tuple(entry) for entry in indexed[2]]
+        if not self.trust_directory_mtime:
+            entries = self.revalidate(directory_path, entries)
+        return entries
+
+    @staticmethod
+    def revalidate(directory_path, entries):
+        """ Refreshes size and modification time of the entries,
+            returns None if some entry changed type or disappeared
+        """
+        revalidated = []
+        for (name, is_directory, size, mtime_ns) in entries:
+            try:
+                entry_stat = os.lstat(os.path.join(directory_path, name))
+            except OSError:
+                return None
+            if is_directory:
+                if not stat.S_ISDIR(entry_stat.st_mode):
+                    return None
+                revalidated.append((name, True, size, entry_stat.st_mtime_ns))
+            else:
+                if not stat.S_ISREG(entry_stat.st_mode):
+                    return None
+                revalidated.append((name, False, entry_stat.st_size, entry_stat.st_mtime_ns))
+        return revalidated
+
+    def update(self, directory_path, directory_stat, entries):
+        """ Stores the entries of directory_path """
+        directory_key = os.path.abspath(directory_path)
+        if self.scan_time_ns - directory_stat.st_mtime_ns < self.RACY_INTERVAL_NS:
+            logging.log(logging.INFO-1, "Not indexing recently modified "+directory_path)
+            self.directories.pop(directory_key, None)
+            return
+        self.directories[directory_key] = [directory_stat.st_mtime_ns, directory_stat.st_ino, entries]
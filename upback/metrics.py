@@ -0,0 +1,73 @@
+"""
+Run metrics in the Prometheus textfile collector format
+"""
+
+import os
+import time
+
+# profile counts exported as upback_paths{side=...}
+PATH_COUNTS = [("local paths", "local"), ("remote paths", "remote"),
+               ("remote backup paths", "remote_backup"), ("synchronized paths", "synchronized")]
+OPERATIONS = ["copy_a_to_b", "copy_b_to_a", "delete_from_a", "delete_from_b", "move_in_a", "move_in_b"]
+# profile counts exported as upback_transferred_bytes{direction=...}
+BYTE_COUNTS = [("bytes copy_a_to_b", "local_to_remote"), ("bytes copy_b_to_a", "remote_to_local")]
+
+def escape_label(value):
+    """ Escapes a label value """
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_metric(name, value, labels=None):
+    """ A sample line """
+    if labels:
+        name += "{"+",".join(label+"=\""+escape_label(str(label_value))+"\""
+                             for label, label_value in labels)+"}"
+    return name+" "+repr(value)+"\n"
+
+def format_metrics(summary, invocations, exit_status, timestamp=None):
+    """ Returns the metrics of a run in the textfile format.
+        summary is a Profiler summary, invocations a dictionary
+        of the rclone invocations of each command
+    """
+    counts = summary["counts"]
+    metrics = [
+        ("upback_last_run_timestamp_seconds", "gauge", "When the last run ended",
+         [(None, round(time.time() if timestamp is None else timestamp, 3))]),
+        ("upback_exit_status", "gauge", "Exit status of the last run",
+         [(None, exit_status)]),
+        ("upback_run_duration_seconds", "gauge", "Wall time of the last run",
+         [(None, summary["wall_time"])]),
+        ("upback_run_cpu_seconds", "gauge", "CPU time of the last run, rclone excluded",
+         [(None, summary["cpu_time"])]),
+        ("upback_phase_duration_seconds", "gauge", "Wall time of each phase of the last run",
+         [([("phase", name)], measures["wall_time"]) for name, measures in summary["phases"].items()]),
+        ("upback_phase_cpu_seconds", "gauge", "CPU time of each phase of the last run, rclone excluded",
+         [([("phase", name)], measures["cpu_time"]) for name, measures in summary["phases"].items()]),
+        ("upback_paths", "gauge", "Paths listed on each side by the last run",
+         [([("side", side)], counts[name]) for name, side in PATH_COUNTS if name in counts]),
+        ("upback_operations", "gauge", "Synchronization operations of each type computed by the last run",
+         [([("type", name)], counts.get(name, 0)) for name in OPERATIONS]),
+        ("upback_conflicts", "gauge", "Conflicts found by the last run",
+         [(None, counts.get("conflicts", 0))]),
+        ("upback_transferred_bytes", "gauge", "Bytes of the files copied by the last run",
+         [([("direction", direction)], counts.get(name, 0)) for name, direction in BYTE_COUNTS]),
+        ("upback_rclone_invocations", "gauge", "rclone invocations (or remote control calls) of the last run",
+         [([("command", command)], count) for command, count in sorted(invocations.items())])
+    ]
+    text = ""
+    for name, metric_type, description, samples in metrics:
+        if not samples:
+            continue
+        text += "# HELP "+name+" "+description+"\n"
+        text += "# TYPE "+name+" "+metric_type+"\n"
+        for labels, value in samples:
+            text += format_metric(name, value, labels)
+    return text
+
+def write_metrics(metrics_path, summary, invocations, exit_status):
+    """ Writes the metrics of a run to metrics_path, atomically
+        so that the collector never reads a partial file
+    """
+    temporary_path = metrics_path+".tmp"
+    with open(temporary_path, "w") as metrics_fp:
+        metrics_fp.write(format_metrics(summary, invocations, exit_status))
+    os.replace(temporary_path, metrics_path)
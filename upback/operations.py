@@ -2,6 +2,10 @@
 Operations class, use to represent synch operations to be performed
 """
 
+import threading
+
+from .util import path_sort_key
+
 class Operations(object):
     """ Operations to perform to achieve synchronization
     """
@@ -11,6 +15,9 @@ class Operations(object):
         self.delete_from_a = []
         self.delete_from_b = []
         self.conflicts = []
+        # (source, destination, backup): a file moved in one side is moved in the other
+        self.move_in_a = []
+        self.move_in_b = []
 
     def add_copy_a_to_b(self, path, backup=False):
         self.copy_a_to_b.append((path, backup))
@@ -27,12 +34,20 @@ class Operations(object):
     def add_conflict(self, path, explaination):
         self.conflicts.append((path, explaination))
 
+    def add_move_in_a(self, source, dest, backup=False):
+        self.move_in_a.append((source, dest, backup))
+
+    def add_move_in_b(self, source, dest, backup=False):
+        self.move_in_b.append((source, dest, backup))
+
     def is_empty(self):
         return len(self.copy_a_to_b) == 0 and \
                len(self.copy_b_to_a) == 0 and \
                len(self.delete_from_a) == 0 and \
                len(self.delete_from_b) == 0 and \
-               len(self.conflicts) == 0
+               len(self.conflicts) == 0 and \
+               len(self.move_in_a) == 0 and \
+               len(self.move_in_b) == 0
 
     def pretty_format_list(self, list):
         msg = ""
@@ -41,6 +56,12 @@ class Operations(object):
             msg += "  "+path+"\n"
         return msg
 
+    def pretty_format_moves(self, moves):
+        msg = ""
+        for source, dest, _ in moves:
+            msg += "  "+source+" -> "+dest+"\n"
+        return msg
+
     def pretty_format(self):
         msg = ""
         if self.conflicts:
@@ -59,6 +80,12 @@ class Operations(object):
             if self.delete_from_b:
                 msg += "delete from remote:\n"
                 msg += self.pretty_format_list(self.delete_from_b)
+            if self.move_in_a:
+                msg += "move in local:\n"
+                msg += self.pretty_format_moves(self.move_in_a)
+            if self.move_in_b:
+                msg += "move in remote:\n"
+                msg += self.pretty_format_moves(self.move_in_b)
         return msg
 
     def __str__(self):
@@ -66,4 +93,147 @@ class Operations(object):
                "\ncopy from remote to local:"+str(self.copy_b_to_a)+
                "\ndelete from local: "+str(self.delete_from_a)+
                "\ndelete from remote: "+str(self.delete_from_b)+
-               "\nconflicts: "+str(self.conflicts))
+               "\nconflicts: "+str(self.conflicts)+
+               "\nmove in local: "+str(self.move_in_a)+
+               "\nmove in remote: "+str(self.move_in_b))
+
+def compact_deletes(delete_ops, path_elements):
+    """ Compacts delete operations so that if a directory is to be deleted
+        deletion of contained elements is ignored.
+        Paths are visited in tree order, where the elements contained in
+        a directory immediately follow it, so that each path has to be
+        checked only against the last deleted directory.
+    """
+    paths_to_ignore = set()
+    deleted_directory = None
+    for path in sorted((path for path, _ in delete_ops), key=path_sort_key):
+        if deleted_directory is not None and path.startswith(deleted_directory):
+            paths_to_ignore.add(path)
+        elif path_elements[path].is_directory:
+            deleted_directory = path+"/"
+    compacted_ops = []
+    for del_op in delete_ops:
+        path, _ = del_op
+        if not path in paths_to_ignore:
+            compacted_ops.append(del_op)
+    return compacted_ops
+
+def common_suffix(path, other):
+    """ Number of trailing path components path and other have in common """
+    count = 0
+    for name, other_name in zip(reversed(path.split("/")), reversed(other.split("/"))):
+        if name != other_name:
+            break
+        count += 1
+    return count
+
+def closest(path, candidates):
+    """ The candidates sharing the most trailing path components with path """
+    if len(candidates) < 2:
+        return candidates
+    scores = [common_suffix(path, candidate) for candidate in candidates]
+    best = max(scores)
+    return [candidate for candidate, score in zip(candidates, scores) if score == best]
+
+def match_moves(deleted, created, key):
+    """ Pairs deleted and created elements (lists of PathElements)
+        with the same key and the same contents (checksum or time stamp).
+        Among several candidates the ones sharing the most trailing
+        path components are preferred; a pair is returned only if
+        each element is the only choice of the other.
+        Returns a list of (deleted path, created path) tuples
+    """
+    buckets = {}
+    for path_element in created:
+        buckets.setdefault(key(path_element), []).append(path_element)
+    forward = {}
+    backward = {}
+    for path_element in deleted:
+        candidates = [candidate.path for candidate in buckets.get(key(path_element), [])
+                      if candidate.has_same_contents(path_element)]
+        if candidates:
+            forward[path_element.path] = candidates
+            for candidate in candidates:
+                backward.setdefault(candidate, []).append(path_element.path)
+    pairs = []
+    for path, candidates in forward.items():
+        candidates = closest(path, candidates)
+        if len(candidates) == 1 and closest(candidates[0], backward[candidates[0]]) == [path]:
+            pairs.append((path, candidates[0]))
+    return pairs
+
+def find_moves(delete_ops, deleted_elements, copy_ops, copied_elements):
+    """ Finds the files that are deleted (delete_ops) and copied under a
+        new path (copy_ops) in the same side: the file was moved in the
+        other side. Files are paired by size and checksum (or time stamp), first among
+        the ones with the same name, then among the renamed ones.
+        Empty files and ambiguous matches are left alone.
+        Removes the paired operations from delete_ops and copy_ops,
+        returns the (source, destination, backup) moves; backup is
+        the one of the copy, as a move replaces nothing else
+    """
+    deleted = [deleted_elements[path] for path, _ in delete_ops]
+    deleted = [path_element for path_element in deleted
+               if not path_element.is_directory and path_element.size > 0]
+    created = [copied_elements[path] for path, _ in copy_ops if not path in deleted_elements]
+    created = [path_element for path_element in created
+               if not path_element.is_directory and path_element.size > 0]
+    if not deleted or not created:
+        return []
+    pairs = match_moves(deleted, created,
+                        lambda path_element: (path_element.size, path_element.path.rpartition("/")[2]))
+    moved_sources = set(source for source, _ in pairs)
+    moved_dests = set(dest for _, dest in pairs)
+    pairs += match_moves([path_element for path_element in deleted if not path_element.path in moved_sources],
+                         [path_element for path_element in created if not path_element.path in moved_dests],
+                         lambda path_element: path_element.size)
+    if not pairs:
+        return []
+    sources = dict(pairs)
+    dests = set(sources.values())
+    backups = dict((path, backup) for path, backup in copy_ops if path in dests)
+    delete_ops[:] = [delete_op for delete_op in delete_ops if not delete_op[0] in sources]
+    copy_ops[:] = [copy_op for copy_op in copy_ops if not copy_op[0] in dests]
+    return [(source, dest, backups[dest]) for source, dest in sorted(pairs)]
+
+def detect_moves(operations, paths_a, paths_b):
+    """ Replaces the deletions and copies of files moved in one side
+        with moves in the other side, so that moved files are not
+        transferred again. Returns operations
+    """
+    operations.move_in_b += find_moves(operations.delete_from_b, paths_b, operations.copy_a_to_b, paths_a)
+    operations.move_in_a += find_moves(operations.delete_from_a, paths_a, operations.copy_b_to_a, paths_b)
+    return operations
+
+class ExecutionResult(object):
+    """ Outcome of the execution of Operations,
+        can be updated by concurrent workers.
+        Completed operations are also recorded in journal, if given
+    """
+    def __init__(self, journal=None):
+        self.completed = []
+        self.failed = []
+        # source of each moved path (moves are recorded by destination)
+        self.sources = {}
+        self.lock = threading.Lock()
+        self.journal = journal
+
+    def add_completed(self, operation, path):
+        with self.lock:
+            self.completed.append((operation, path))
+        if self.journal is not None:
+            self.journal.record(operation, path)
+
+    def add_failed(self, operation, path, message):
+        with self.lock:
+            self.failed.append((operation, path, message))
+
+    def is_successful(self):
+        return len(self.failed) == 0
+
+    def pretty_format_failures(self):
+        msg = ""
+        for item in self.failed:
+            _, path, message = item
+            msg += "  "+path+": "+message+"\n"
+        return msg
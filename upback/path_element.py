@@ -2,7 +2,6 @@
 PathElement class, use to represent path entries
 """
 
-import datetime
 import os
 import logging
 
@@ -11,17 +10,32 @@ from .const import * # pylint: disable=unused-wildcard-import
 
 class PathElement(object):
     """ Path elements - we synchronize these
+        Listings hold millions of them: attributes are slots
+        and time stamps are integers to keep them small
     """
-    def __init__(self, path, time_stamp=0, time_precision=0, size=0, is_directory=False, is_local=True):
-        self.init(path, time_stamp, time_precision, size, is_directory, is_local)
+    __slots__ = ("path", "time_stamp", "time_precision", "size", "is_directory", "is_local", "checksum")
+
+    def __init__(self, path, time_stamp=0, time_precision=0, size=0, is_directory=False, is_local=True,
+                 checksum=None):
+        self.init(path, time_stamp, time_precision, size, is_directory, is_local, checksum)
 
     def __eq__(self, other):
         if type(other) is type(self):
-            return self.__dict__ == other.__dict__
+            return self.as_tuple() == other.as_tuple()
         return False
 
-    def init(self, path, time_stamp, time_precision, size, is_directory, is_local):
-        """ Initialize a PathElement
+    def __repr__(self):
+        return "PathElement"+repr(self.as_tuple())
+
+    def as_tuple(self):
+        """ Returns the attributes of the element as a tuple
+        """
+        return (self.path, self.time_stamp, self.time_precision, self.size, self.is_directory, self.is_local,
+                self.checksum)
+
+    def init(self, path, time_stamp, time_precision, size, is_directory, is_local, checksum=None):
+        """ Initialize a PathElement.
+            checksum is "type:hex digest" (e.g. "md5:..."), None if unknown
         """
         self.path = path
         self.time_stamp = time_stamp
@@ -29,6 +43,7 @@ class PathElement(object):
         self.size = size
         self.is_directory = is_directory
         self.is_local = is_local
+        self.checksum = checksum
 
     def contains(self, other):
         """ Returns true is self is a directory and other is a sub-element
@@ -39,28 +54,43 @@ class PathElement(object):
 
     def is_effectively_equal_to(self, other):
         """ Compares two paths. Paths are considered
-            effectively equals if their timestamps are
-            within 10 microseconds if both elements support 
-            at least microseconds precision. 
-            Otherwise if they are within 1 microsecond of 
-            the precision of the least precise.
+            effectively equals if their timestamps (integer
+            nanoseconds) are within 10 microseconds if both
+            elements support at least microseconds precision.
+            Otherwise if they are within one unit of the last
+            decimal digit of the least precise.
+            If both files have a checksum checksums are
+            compared instead of timestamps.
         """
         if type(other) is type(self):
             if(self.is_directory and other.is_directory and
                self.path == other.path):
                 return True
             if(self.path == other.path and
-               self.size == other.size and
                self.is_directory == other.is_directory):
-                #compare time stamps taking precision into account
-                if self.time_precision >= 6 and other.time_precision >= 6: #if at least microseconds precision -> effectively_equal if within 10 microseconds
-                    return abs(self.time_stamp-other.time_stamp) < datetime.timedelta(microseconds=10)
-                else: #precision is less than microseconds -> effectively_equal if equal within 1 microsecond of the precision of the least precise
-                    min_precision = self.time_precision if self.time_precision < other.time_precision else other.time_precision
-                    granularity = 10**(6-min_precision)-1
-                    return abs(self.time_stamp-other.time_stamp) < datetime.timedelta(microseconds=granularity)
+                return self.has_same_contents(other)
         return False
 
+    def has_same_contents(self, other):
+        """ Compares the contents of two files: their size and
+            their checksums if both have one, their time stamps otherwise
+        """
+        if self.size != other.size:
+            return False
+        if self.checksum is not None and other.checksum is not None:
+            return self.checksum == other.checksum
+        return self.has_effectively_equal_time_stamp(other)
+
+    def has_effectively_equal_time_stamp(self, other):
+        """ Compares the time stamps of two elements
+            taking their precision into account
+        """
+        min_precision = self.time_precision if self.time_precision < other.time_precision else other.time_precision
+        if min_precision >= 6: #if at least microseconds precision -> effectively_equal if within 10 microseconds
+            return abs(self.time_stamp-other.time_stamp) < 10000
+        else: #precision is less than microseconds -> effectively_equal if within the precision of the least precise
+            return abs(self.time_stamp-other.time_stamp) < 10**(9-min_precision)
+
     @classmethod
     def from_json(cls, path_json, is_local=True):
         """ Builds a PathElement from a JSON rclone entry
@@ -68,5 +98,18 @@ class PathElement(object):
         path_name = path_json["Path"]
         path_is_dir = True if path_json["IsDir"] else False
         path_size = path_json["Size"]
-        (path_datetime, path_time_precision) = parse_rfc3339(path_json["ModTime"], report_precision=True)
-        return cls(path_name, path_datetime, path_time_precision, path_size, path_is_dir, is_local)
+        (path_time_stamp, path_time_precision) = parse_rfc3339(path_json["ModTime"])
+        path_checksum = None
+        if "Hashes" in path_json:
+            path_checksum = checksum_from_json(path_json["Hashes"])
+        return cls(path_name, path_time_stamp, path_time_precision, path_size, path_is_dir, is_local,
+                   path_checksum)
+
+def checksum_from_json(hashes_json):
+    """ Returns the checksum of the preferred type (HASH_TYPES)
+        among the rclone Hashes of an entry, None if there is none
+    """
+    for hash_type in HASH_TYPES:
+        if hashes_json.get(hash_type):
+            return hash_type+":"+hashes_json[hash_type]
+    return None
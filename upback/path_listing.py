@@ -0,0 +1,125 @@
+"""
+PathListing class, a compact dictionary of PathElements
+"""
+
+import sys
+import array
+import collections.abc
+
+from .path_element import PathElement
+
+FLAG_DIRECTORY = 0x01
+FLAG_LOCAL = 0x02
+PRECISION_SHIFT = 2
+
+class PathListing(collections.abc.MutableMapping):
+    """ Dictionary of PathElements keyed by their path.
+        Elements are not kept as objects: their attributes are
+        stored in parallel arrays (interned path, time stamp, size,
+        flags and, once an element with a checksum is stored,
+        checksum) and a PathElement is built each time one is read,
+        so modifying it does not change the listing: store it again.
+        As with a dictionary, the listing must not be modified
+        while it is iterated.
+    """
+    # removed entries are left as holes, the arrays are compacted
+    # when holes are more than half of them
+    COMPACT_MIN = 1024
+
+    def __init__(self, path_elements=()):
+        self.paths = []
+        self.time_stamps = array.array("q")
+        self.sizes = array.array("q")
+        self.flags = array.array("B")
+        # None until an element with a checksum is stored
+        self.checksums = None
+        self.positions = {}
+        self.removed = 0
+        for path_element in path_elements:
+            self[path_element.path] = path_element
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, path):
+        return path in self.positions
+
+    def __iter__(self):
+        for path in self.paths:
+            if path is not None:
+                yield path
+
+    def __getitem__(self, path):
+        return self.element(self.positions[path])
+
+    def __setitem__(self, path, path_element):
+        if path_element.path != path:
+            raise ValueError("PathElement "+path_element.path+" stored as "+path)
+        flags = path_element.time_precision << PRECISION_SHIFT
+        if path_element.is_directory:
+            flags |= FLAG_DIRECTORY
+        if path_element.is_local:
+            flags |= FLAG_LOCAL
+        if path_element.checksum is not None and self.checksums is None:
+            self.checksums = [None]*len(self.paths)
+        position = self.positions.get(path)
+        if position is None:
+            path = sys.intern(path)
+            self.positions[path] = len(self.paths)
+            self.paths.append(path)
+            self.time_stamps.append(path_element.time_stamp)
+            self.sizes.append(path_element.size)
+            self.flags.append(flags)
+            if self.checksums is not None:
+                self.checksums.append(path_element.checksum)
+        else:
+            self.time_stamps[position] = path_element.time_stamp
+            self.sizes[position] = path_element.size
+            self.flags[position] = flags
+            if self.checksums is not None:
+                self.checksums[position] = path_element.checksum
+
+    def __delitem__(self, path):
+        position = self.positions.pop(path)
+        self.paths[position] = None
+        self.removed += 1
+        if self.removed >= self.COMPACT_MIN and self.removed*2 > len(self.paths):
+            self.compact()
+
+    def __repr__(self):
+        return "PathListing("+repr(list(self.values()))+")"
+
+    def get(self, path, default=None):
+        position = self.positions.get(path)
+        if position is None:
+            return default
+        return self.element(position)
+
+    def values(self):
+        for position, path in enumerate(self.paths):
+            if path is not None:
+                yield self.element(position)
+
+    def items(self):
+        for position, path in enumerate(self.paths):
+            if path is not None:
+                yield (path, self.element(position))
+
+    def element(self, position):
+        """ Builds the PathElement stored at position """
+        flags = self.flags[position]
+        return PathElement(self.paths[position], self.time_stamps[position], flags >> PRECISION_SHIFT,
+                           self.sizes[position], bool(flags & FLAG_DIRECTORY), bool(flags & FLAG_LOCAL),
+                           self.checksums[position] if self.checksums is not None else None)
+
+    def compact(self):
+        """ Drops the holes left by removed entries """
+        kept = [position for position, path in enumerate(self.paths) if path is not None]
+        self.paths = [self.paths[position] for position in kept]
+        self.time_stamps = array.array("q", (self.time_stamps[position] for position in kept))
+        self.sizes = array.array("q", (self.sizes[position] for position in kept))
+        self.flags = array.array("B", (self.flags[position] for position in kept))
+        if self.checksums is not None:
+            self.checksums = [self.checksums[position] for position in kept]
+        self.positions = dict((path, position) for position, path in enumerate(self.paths))
+        self.removed = 0
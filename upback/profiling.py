@@ -0,0 +1,138 @@
+"""
+Profiler class, per-phase timing of an UpBack run
+"""
+
+import os
+import json
+import time
+import threading
+import contextlib
+import contextvars
+import collections
+
+class Profiler(object):
+    """ Profiler singleton: records wall and CPU time of the
+        phases of a run and some counts (paths, operations,
+        rclone invocations). Phases run more than once (e.g. in
+        watch mode) are accumulated. When the profiler is not
+        enabled phases cost a function call
+    """
+    # instance bound to the current context (see bind), overrides the singleton
+    context = contextvars.ContextVar("profiler", default=None)
+
+    def __new__(cls, *args, **kwds):
+        singleton = cls.context.get()
+        if singleton is not None:
+            return singleton
+        singleton = cls.__dict__.get("__it__")
+        if singleton is not None:
+            return singleton
+        cls.__it__ = singleton = object.__new__(cls)
+        singleton.setup(*args, **kwds)
+        return singleton
+
+    @classmethod
+    def bind(cls, *args, **kwds):
+        """ Creates a new instance returned, instead of the singleton,
+            to the code running in the current context (e.g. the
+            branch synchronized by a run_all worker)
+        """
+        instance = object.__new__(cls)
+        instance.setup(*args, **kwds)
+        cls.context.set(instance)
+        return instance
+
+    def setup(self, enabled=False):
+        """ Initialization method, called on singleton instantiation """
+        self.enabled = enabled
+        # name -> [calls, wall time, cpu time, rclone cpu time], in order of first run
+        self.phases = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Context manager timing the enclosed block as phase name.
+            CPU time is the time of this process, rclone CPU time
+            the time of the rclone processes that ended in the phase
+        """
+        if not self.enabled:
+            yield
+            return
+        start_times = os.times()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter()-start_wall
+            cpu = time.process_time()-start_cpu
+            end_times = os.times()
+            children_cpu = (end_times.children_user-start_times.children_user+
+                            end_times.children_system-start_times.children_system)
+            with self.lock:
+                measures = self.phases.setdefault(name, [0, 0.0, 0.0, 0.0])
+                measures[0] += 1
+                measures[1] += wall
+                measures[2] += cpu
+                measures[3] += children_cpu
+
+    def count(self, name, value):
+        """ Sets the count name to value """
+        if self.enabled:
+            with self.lock:
+                self.counts[name] = value
+
+    def add(self, name, value=1):
+        """ Adds value to the count name """
+        if self.enabled:
+            with self.lock:
+                self.counts[name] = self.counts.get(name, 0)+value
+
+    def merge(self, summary):
+        """ Accumulates the phases and counts of the summary
+            of another profile (e.g. of a branch of run_all)
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            for name, measures in summary["phases"].items():
+                accumulated = self.phases.setdefault(name, [0, 0.0, 0.0, 0.0])
+                accumulated[0] += measures["calls"]
+                accumulated[1] += measures["wall_time"]
+                accumulated[2] += measures["cpu_time"]
+                accumulated[3] += measures["rclone_cpu_time"]
+            for name, value in summary["counts"].items():
+                self.counts[name] = self.counts.get(name, 0)+value
+
+    def summary(self):
+        """ The profile as a dictionary """
+        with self.lock:
+            return {
+                "wall_time": round(time.perf_counter()-self.start, 6),
+                "cpu_time": round(time.process_time()-self.start_cpu, 6),
+                "phases": collections.OrderedDict(
+                    (name, {"calls": calls, "wall_time": round(wall, 6), "cpu_time": round(cpu, 6),
+                            "rclone_cpu_time": round(children_cpu, 6)})
+                    for name, (calls, wall, cpu, children_cpu) in self.phases.items()),
+                "counts": collections.OrderedDict(self.counts)
+            }
+
+    def pretty_format(self):
+        """ The profile as a table """
+        summary = self.summary()
+        msg = "%-24s %6s %10s %10s %10s\n" % ("phase", "calls", "wall (s)", "cpu (s)", "rclone cpu")
+        for name, measures in summary["phases"].items():
+            msg += "%-24s %6d %10.3f %10.3f %10.3f\n" % (name, measures["calls"], measures["wall_time"],
+                                                         measures["cpu_time"], measures["rclone_cpu_time"])
+        msg += "%-24s %6s %10.3f %10.3f\n" % ("total", "", summary["wall_time"], summary["cpu_time"])
+        for name, value in summary["counts"].items():
+            msg += "%-31s %10d\n" % (name, value)
+        return msg
+
+    def write(self, path):
+        """ Writes the profile to path as JSON """
+        with open(path, "w") as profile_fp:
+            json.dump(self.summary(), profile_fp, indent=4)
@@ -0,0 +1,142 @@
+"""
+RCloneDaemon class, a persistent rclone process
+controlled through the rclone remote control API
+"""
+
+import os
+import json
+import time
+import queue
+import base64
+import socket
+import secrets
+import logging
+import tempfile
+import subprocess
+import http.client
+
+class RCloneDaemon(object):
+    """ An rclone rcd process listening on a loopback port.
+        Commands are sent as HTTP POST requests over pooled
+        keep-alive connections, so that the rclone configuration
+        is read and backends authenticate only once per run.
+        Failed commands raise subprocess.CalledProcessError as
+        failed rclone invocations do
+    """
+    START_TIMEOUT = 30
+    STOP_TIMEOUT = 10
+    USER = "upback"
+
+    def __init__(self, rclone_file):
+        self.rclone_file = rclone_file
+        self.process = None
+        self.port = None
+        self.authorization = None
+        self.stderr_fp = None
+        # idle connections, the most recently used first
+        self.connections = queue.LifoQueue()
+
+    def start(self):
+        """ Starts rclone rcd and waits until it answers """
+        self.port = free_port()
+        password = secrets.token_urlsafe(24)
+        self.authorization = "Basic "+base64.b64encode(
+            bytes(self.USER+":"+password, encoding="UTF-8")).decode("ascii")
+        # credentials are passed in the environment, not visible in the process list
+        environment = dict(os.environ, RCLONE_RC_USER=self.USER, RCLONE_RC_PASS=password)
+        args = [self.rclone_file, "rcd", "--rc-addr", "127.0.0.1:"+str(self.port)]
+        logging.info("Running "+str(args))
+        self.stderr_fp = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                        stderr=self.stderr_fp, env=environment)
+        deadline = time.monotonic()+self.START_TIMEOUT
+        while True:
+            try:
+                self.call("rc/noop", {})
+                return
+            except (OSError, http.client.HTTPException):
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    error = self.error_output()
+                    self.stop()
+                    raise subprocess.CalledProcessError(self.process.returncode or 1, args, error)
+                time.sleep(0.05)
+
+    def stop(self):
+        """ Closes the connections and terminates rclone rcd """
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except queue.Empty:
+                break
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(self.STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self.stderr_fp is not None:
+            self.stderr_fp.close()
+            self.stderr_fp = None
+
+    def error_output(self):
+        """ What rclone rcd wrote to stderr """
+        self.stderr_fp.seek(0)
+        return self.stderr_fp.read().decode('UTF-8', 'replace')
+
+    def call(self, command, params):
+        """ Sends command (e.g. operations/copyfile) with
+            params (a dictionary), returns the decoded output.
+            A pooled connection closed by rclone is retried
+            once with a new one
+        """
+        logging.info("Calling "+command+" "+str(params))
+        body = json.dumps(params)
+        headers = {"Content-Type": "application/json", "Authorization": self.authorization}
+        try:
+            connection = self.connections.get_nowait()
+            reused = True
+        except queue.Empty:
+            connection = http.client.HTTPConnection("127.0.0.1", self.port)
+            reused = False
+        while True:
+            try:
+                connection.request("POST", "/"+command, body, headers)
+                response = connection.getresponse()
+                output = response.read()
+                break
+            except (ConnectionError, http.client.HTTPException):
+                connection.close()
+                if not reused:
+                    raise
+                connection = http.client.HTTPConnection("127.0.0.1", self.port)
+                reused = False
+        self.connections.put(connection)
+        try:
+            output = json.loads(output.decode("UTF-8")) if output.strip() else {}
+        except ValueError:
+            output = {"error": output.decode("UTF-8", "replace")}
+        if response.status != 200:
+            raise subprocess.CalledProcessError(response.status, [command],
+                                                str(output.get("error", response.reason)))
+        logging.log(logging.INFO-1, "Output: "+str(output))
+        return output
+
+def free_port():
+    """ Returns a loopback port nobody is listening on """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as port_socket:
+        port_socket.bind(("127.0.0.1", 0))
+        return port_socket.getsockname()[1]
+
+def split_path(path):
+    """ Splits an rclone path into the (fs, remote) pair
+        the remote control API expects: the parent
+        directory and the name of the last element
+    """
+    parent, separator, name = path.rpartition("/")
+    if not separator:
+        fs_name, colon, name = path.rpartition(":")
+        return (fs_name+colon if colon else ".", name)
+    if parent == "" or parent.endswith(":"):
+        parent += "/"
+    return (parent, name)
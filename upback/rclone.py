@@ -3,15 +3,28 @@
 import os
 import logging
 import json
+import threading
+import collections
+import contextlib
+import contextvars
 import subprocess
 import tempfile
-import re
 
-from .util import parse_rfc3339
+from .path_element import PathElement
+from .rc import RCloneDaemon, split_path
+from .util import parse_rfc3339, is_path_local
+
+JSON_READ_SIZE = 65536
 
 class RClone(object):
     """ Wrapper class around the rclone executable """
+    # instance bound to the current context (see bind), overrides the singleton
+    context = contextvars.ContextVar("rclone", default=None)
+
     def __new__(cls, *args, **kwds):
+        singleton = cls.context.get()
+        if singleton is not None:
+            return singleton
         singleton = cls.__dict__.get("__it__")
         if singleton is not None:
             return singleton
@@ -19,13 +32,106 @@ class RClone(object):
         singleton.setup(*args, **kwds)
         return singleton
 
-    def setup(self, rclone_path="", rclone_executable="rclone"):
-        """ Setup the rclone path and executable """
+    @classmethod
+    def bind(cls, *args, **kwds):
+        """ Creates a new instance returned, instead of the singleton,
+            to the code running in the current context (e.g. the
+            branch synchronized by a run_all worker)
+        """
+        instance = object.__new__(cls)
+        instance.setup(*args, **kwds)
+        cls.context.set(instance)
+        return instance
+
+    def setup(self, rclone_path="", rclone_executable="rclone", cwd=None, process_slots=None):
+        """ Setup the rclone path and executable.
+            Relative local paths are relative to cwd (default: the
+            current directory); process_slots is a semaphore shared
+            by instances limiting the rclone processes (and remote
+            control calls) running at the same time
+        """
         if not rclone_path:
             self.rclone_file = rclone_executable
         else:
             self.rclone_file = os.path.join(rclone_path, rclone_executable)
         self.harmonize_timestamp_precision = True #TODO: set this depending on rclone version
+        self.cwd = cwd
+        self.process_slots = process_slots
+        # when an rclone rcd process is running operations are sent to it
+        self.daemon = None
+        # rclone commands (or remote control commands) run so far
+        self.invocations = collections.Counter()
+        self.invocations_lock = threading.Lock()
+
+    def count_invocation(self, command):
+        """ Counts an invocation of command """
+        with self.invocations_lock:
+            self.invocations[command] += 1
+
+    def process_slot(self):
+        """ Context manager holding one of process_slots, if any """
+        if self.process_slots is None:
+            return contextlib.nullcontext()
+        return self.process_slots
+
+    def rc_fs(self, fs_name):
+        """ fs_name for the daemon, that does not share cwd:
+            relative local paths are made absolute
+        """
+        if self.cwd is not None and is_path_local(fs_name) and not os.path.isabs(fs_name):
+            return os.path.normpath(os.path.join(self.cwd, fs_name))
+        return fs_name
+
+    def start_daemon(self):
+        """ Starts an rclone rcd process, the following operations
+            (but sync and run) are performed by it instead of
+            invoking rclone each time
+        """
+        if self.daemon is None:
+            self.count_invocation("rcd")
+            daemon = RCloneDaemon(self.rclone_file)
+            daemon.start()
+            self.daemon = daemon
+
+    def stop_daemon(self):
+        """ Stops the rclone rcd process, if any """
+        if self.daemon is not None:
+            self.daemon.stop()
+            self.daemon = None
+
+    @staticmethod
+    def backup_config(no_backup=False, remote_backup=None, remote_suffix=None):
+        """ Backup settings as _config overrides of a remote control call """
+        config = {}
+        if not no_backup:
+            if remote_backup:
+                config["BackupDir"] = remote_backup
+                if remote_suffix:
+                    config["Suffix"] = remote_suffix
+        return config
+
+    def call(self, command, params):
+        """ Sends a remote control command to the daemon """
+        self.count_invocation(command)
+        with self.process_slot():
+            return self.daemon.call(command, params)
+
+    def call_file_operation(self, command, source, dest, no_backup=False, remote_backup=None,
+                            remote_suffix=None):
+        """ Remote control operation from source to dest (single files) """
+        source_fs, source_remote = split_path(source)
+        dest_fs, dest_remote = split_path(dest)
+        return self.call(command, {"srcFs": self.rc_fs(source_fs), "srcRemote": source_remote,
+                                   "dstFs": self.rc_fs(dest_fs), "dstRemote": dest_remote,
+                                   "_config": self.backup_config(no_backup, remote_backup,
+                                                                 remote_suffix)})
+
+    def call_path_operation(self, command, path, no_backup=False, remote_backup=None, remote_suffix=None):
+        """ Remote control operation on path """
+        fs_name, remote = split_path(path)
+        return self.call(command, {"fs": self.rc_fs(fs_name), "remote": remote,
+                                   "_config": self.backup_config(no_backup, remote_backup,
+                                                                 remote_suffix)})
 
     def backup_operation(self, args, no_backup=False, remote_backup=None, remote_suffix=None):
         """ Backup-aware operation """
@@ -38,26 +144,40 @@ class RClone(object):
 
     def mkdir(self, path):
         """ mkdir """
+        if self.daemon is not None:
+            return self.call_path_operation("operations/mkdir", path)
         args = ["mkdir", path]
         return self.run(args)
 
     def delete(self, path, no_backup=False, remote_backup=None, remote_suffix=None):
-        """ delete """
+        """ delete (paths are files when using rclone rcd) """
+        if self.daemon is not None:
+            return self.call_path_operation("operations/deletefile", path, no_backup, remote_backup,
+                                            remote_suffix)
         args = ["delete", path]
         return self.backup_operation(args, no_backup, remote_backup, remote_suffix)
 
     def purge(self, path, no_backup=False, remote_backup=None, remote_suffix=None):
         """ purge: delete a path and its contents """
+        if self.daemon is not None:
+            return self.call_path_operation("operations/purge", path, no_backup, remote_backup,
+                                            remote_suffix)
         args = ["purge", path]
         return self.backup_operation(args, no_backup, remote_backup, remote_suffix)
 
     def copy(self, source, dest, no_backup=False, remote_backup=None, remote_suffix=None):
         """ copy """
+        if self.daemon is not None:
+            return self.call_file_operation("operations/copyfile", source, dest, no_backup,
+                                            remote_backup, remote_suffix)
         args = ["copyto", source, dest]
         return self.backup_operation(args, no_backup, remote_backup, remote_suffix)
 
     def move(self, source, dest, no_backup=False, remote_backup=None, remote_suffix=None):
         """ move """
+        if self.daemon is not None:
+            return self.call_file_operation("operations/movefile", source, dest, no_backup,
+                                            remote_backup, remote_suffix)
         args = ["moveto", source, dest]
         return self.backup_operation(args, no_backup, remote_backup, remote_suffix)
 
@@ -66,30 +186,201 @@ class RClone(object):
         args = ["sync", source, dest]
         return self.backup_operation(args, no_backup, remote_backup, remote_suffix)
 
-    def lsjson(self, path):
+    def copy_files(self, source, dest, files, no_backup=False, remote_backup=None, remote_suffix=None):
+        """ copy: copies a list of files (relative to source) with a single invocation.
+            Returns a dictionary of the files that could not be copied
+            with the corresponding error messages
+        """
+        if self.daemon is not None:
+            return self.call_files_operation(
+                lambda path: self.call("operations/copyfile", {
+                    "srcFs": self.rc_fs(source), "srcRemote": path,
+                    "dstFs": self.rc_fs(dest), "dstRemote": path,
+                    "_config": self.backup_config(no_backup, remote_backup, remote_suffix)}), files)
+        args = ["copy", "--no-traverse", source, dest]
+        return self.files_from_operation(args, files, lambda paths: self.existing_files(dest, paths),
+                                         no_backup, remote_backup, remote_suffix)
+
+    def delete_files(self, path, files, no_backup=False, remote_backup=None, remote_suffix=None):
+        """ delete: deletes a list of files (relative to path) with a single invocation.
+            Returns a dictionary of the files that could not be deleted
+            with the corresponding error messages
+        """
+        if self.daemon is not None:
+            return self.call_files_operation(
+                lambda file_path: self.call("operations/deletefile", {
+                    "fs": self.rc_fs(path), "remote": file_path,
+                    "_config": self.backup_config(no_backup, remote_backup, remote_suffix)}), files)
+        args = ["delete", path]
+        return self.files_from_operation(args, files, lambda paths: set(paths)-self.existing_files(path, paths),
+                                         no_backup, remote_backup, remote_suffix)
+
+    def files_from_operation(self, args, files, check, no_backup=False, remote_backup=None,
+                             remote_suffix=None):
+        """ Backup-aware operation on a list of files passed with --files-from.
+            Per-file outcomes are parsed from the rclone json log,
+            check is used for the files the log does not report (see
+            parse_failures)
+        """
+        files_filename = self.write_files_from(files)
+        try:
+            args += ["--files-from", files_filename, "--use-json-log", "-v"]
+            try:
+                self.backup_operation(args, no_backup, remote_backup, remote_suffix)
+                return {}
+            except subprocess.CalledProcessError as error:
+                return self.parse_failures(error.output, files, check)
+        finally:
+            os.remove(files_filename)
+
+    def existing_files(self, path, files):
+        """ The files (relative to path) that exist in path, listed
+            with a single invocation
+        """
+        return set(path_json["Path"] for path_json in self.lsjson_entries(path, files)
+                   if not path_json.get("IsDir"))
+
+    @staticmethod
+    def call_files_operation(call, files):
+        """ Performs call on each of files over the rclone rcd connection,
+            returns the failures as files_from_operation does
+        """
+        failures = {}
+        for path in files:
+            try:
+                call(path)
+            except subprocess.CalledProcessError as error:
+                failures[path] = error.output
+        return failures
+
+    @staticmethod
+    def write_files_from(files):
+        """ Writes files to a temporary file to be passed with --files-from,
+            returns its name. The caller must remove it
+        """
+        files_fp, files_filename = tempfile.mkstemp()
+        os.write(files_fp, bytes("\n".join(files)+"\n", encoding='UTF-8'))
+        os.close(files_fp)
+        return files_filename
+
+    @staticmethod
+    def parse_failures(output, files, check=None):
+        """ Parses the json log of a failed rclone invocation
+            operating on files.
+            Files with an error entry are failed, files reported as
+            done are not. The others may have been skipped (e.g.
+            unchanged files) or logged only at debug level: check,
+            a callable returning the files among the ones it is given
+            that are in the state the operation produces, tells them
+            apart. Without check, or if it fails, they are failed
+        """
+        done = set()
+        errors = {}
+        last_error = "rclone failed"
+        for line in output.splitlines():
+            try:
+                log_entry = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(log_entry, dict):
+                continue
+            message = log_entry.get("msg", "").strip()
+            path = log_entry.get("object")
+            if log_entry.get("level") == "error":
+                if path:
+                    errors[path] = message
+                else:
+                    last_error = message
+            elif path and (message.startswith("Copied") or message.startswith("Deleted")):
+                done.add(path)
+        failures = {}
+        unreported = []
+        for path in files:
+            if path in errors:
+                failures[path] = errors[path]
+            elif path not in done:
+                unreported.append(path)
+        if unreported:
+            completed = set()
+            if check is not None:
+                try:
+                    completed = check(unreported)
+                except (subprocess.CalledProcessError, ValueError) as error:
+                    logging.warning("Cannot check the outcome of the operations: "+str(error))
+            for path in unreported:
+                if path not in completed:
+                    failures[path] = last_error
+        return failures
+
+    def lsjson_entries(self, path, files=None, hashes=False):
+        """ lsjson: lists path recursively, yields the entries
+            (dictionaries) as rclone outputs them.
+            If files (relative to path) is given only those files are listed,
+            if hashes is set the entries include the hashes of files
+        """
+        if self.daemon is not None and not is_path_local(path):
+            #local paths are still listed by rclone lsjson, for --skip-links
+            for path_json in self.call_list(path, files, hashes):
+                yield path_json
+            return
         args = ["lsjson", "-R", "--skip-links", path]
-        output = self.run(args)
-        if self.harmonize_timestamp_precision:
-            top_precision = 0
-            paths_list = json.loads(output)
-            for path_json in paths_list:
-                datetime = path_json["ModTime"]
-                (_, time_precision) = parse_rfc3339(datetime, report_precision=True)
-                if time_precision > top_precision:
-                    top_precision = time_precision
-            #now make all timestamps use the same number of decimal digits
-            #TODO: use it only with older version of rclone
-            def replacer(matchobj):
-                time = matchobj.group(1)
-                decimal = matchobj.group(2)
-                if not decimal:
-                    decimal = "."
-                return time+(decimal+("0"*top_precision))[0:top_precision+1]
-            for path_json in paths_list:
-                path_json["ModTime"] = re.sub(r'(\d\d?:\d\d?:\d\d?)(\.\d+)?', replacer, path_json["ModTime"])
-            return json.dumps(paths_list)
+        if hashes:
+            args.append("--hash")
+        if files is None:
+            for path_json in self.run_json_list(args):
+                yield path_json
         else:
-            return output
+            files_filename = self.write_files_from(files)
+            try:
+                for path_json in self.run_json_list(args+["--files-from", files_filename]):
+                    yield path_json
+            finally:
+                os.remove(files_filename)
+
+    def call_list(self, path, files=None, hashes=False):
+        """ operations/list over the rclone rcd connection,
+            returns the entries as lsjson_entries does
+        """
+        params = {"fs": path, "remote": "", "opt": {"recurse": True, "noMimeType": True, "showHash": hashes}}
+        if files is None:
+            return self.call("operations/list", params)["list"]
+        files_filename = self.write_files_from(files)
+        try:
+            params["_filter"] = {"FilesFrom": [files_filename]}
+            return self.call("operations/list", params)["list"]
+        finally:
+            os.remove(files_filename)
+
+    def listing(self, path, files=None, hashes=False):
+        """ Lists path recursively in a single pass over the rclone output.
+            Returns a list of PathElements with parsed timestamps; if
+            harmonize_timestamp_precision is set all of them get the
+            highest precision found.
+            If files (relative to path) is given only those files are listed,
+            if hashes is set files get the checksums the remote provides
+        """
+        path_elements = []
+        top_precision = 0
+        for path_json in self.lsjson_entries(path, files, hashes):
+            path_element = PathElement.from_json(path_json, False)
+            if path_element.time_precision > top_precision:
+                top_precision = path_element.time_precision
+            path_elements.append(path_element)
+        if self.harmonize_timestamp_precision:
+            #same as padding all timestamps to the same number of decimal digits
+            for path_element in path_elements:
+                path_element.time_precision = top_precision
+        return path_elements
+
+    def cat(self, path):
+        """ cat: returns the content of a file. Only the standard output
+            is returned, rclone messages are discarded
+        """
+        self.count_invocation("cat")
+        args = [self.rclone_file, "cat", path]
+        logging.info("Running "+str(args))
+        with self.process_slot():
+            return subprocess.check_output(args, stderr=subprocess.DEVNULL, encoding='UTF-8', cwd=self.cwd)
 
     def write_file(self, path, content):
         """ Writes content to a file. Operates by creating a tempfile and moving
@@ -100,10 +391,55 @@ class RClone(object):
         os.close(tmp_fp)
         self.move(tmp_filename, path)
 
+    def run_json_list(self, args):
+        """ Invoke rclone with the given arguments, yields the elements
+            of the JSON list it writes as they are read from its output,
+            so that the whole output is never held in memory
+        """
+        self.count_invocation(args[0])
+        args = [self.rclone_file] + args
+        logging.info("Running "+str(args))
+        decoder = json.JSONDecoder()
+        count = 0
+        with self.process_slot(), tempfile.TemporaryFile() as stderr_fp:
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr_fp, encoding='UTF-8',
+                                       cwd=self.cwd)
+            try:
+                buffer = ""
+                position = 0
+                for chunk in iter(lambda: process.stdout.read(JSON_READ_SIZE), ""):
+                    buffer = buffer[position:]+chunk
+                    position = 0
+                    while True:
+                        #skip list delimiters and separators
+                        while position < len(buffer) and buffer[position] in " \t\r\n,[]":
+                            position += 1
+                        if position == len(buffer):
+                            break
+                        try:
+                            element, position = decoder.raw_decode(buffer, position)
+                        except ValueError:
+                            #incomplete element, read more
+                            break
+                        count += 1
+                        yield element
+                if buffer[position:].strip():
+                    raise ValueError("Invalid rclone output: "+buffer[position:position+80])
+            finally:
+                process.stdout.close()
+                return_code = process.wait()
+            if return_code:
+                stderr_fp.seek(0)
+                raise subprocess.CalledProcessError(return_code, args,
+                                                    stderr_fp.read().decode('UTF-8', 'replace'))
+        logging.log(logging.INFO-1, "Output: "+str(count)+" elements")
+
     def run(self, args):
         """ Invoke rclone with the given arguments """
+        self.count_invocation(args[0])
         args = [self.rclone_file] + args
         logging.info("Running "+str(args))
-        output = subprocess.check_output(args, stderr=subprocess.STDOUT, encoding='UTF-8')
+        with self.process_slot():
+            output = subprocess.check_output(args, stderr=subprocess.STDOUT, encoding='UTF-8', cwd=self.cwd)
         logging.log(logging.INFO-1, "Output: "+output)
         return output
@@ -0,0 +1,139 @@
+"""
+Run-all mode: synchronizes the branches listed in a manifest
+concurrently, in a single process
+"""
+
+import os
+import time
+import threading
+import contextvars
+import concurrent.futures
+
+from .rclone import RClone
+from .configuration import Configuration
+from .profiling import Profiler
+from .metrics import OPERATIONS
+from .upback import UpBackException, open_branch, synchronize, cleanup
+from .util import is_path_local
+from .const import * # pylint: disable=unused-wildcard-import
+
+class BranchResult(object):
+    """ Outcome of the synchronization of a branch """
+    def __init__(self, directory):
+        self.directory = directory
+        self.status = STATUS_OK
+        self.message = ""
+        self.operations = None
+        self.wall_time = 0.0
+        # Profiler summary and rclone invocations of the branch
+        self.profile = None
+        self.invocations = {}
+
+    def state(self):
+        """ ok, conflicts or error """
+        if self.status != STATUS_OK:
+            return "error"
+        if self.operations is not None and self.operations.conflicts:
+            return "conflicts"
+        return "ok"
+
+    def operations_count(self):
+        """ Number of synchronization operations computed """
+        if self.operations is None:
+            return 0
+        return sum(len(getattr(self.operations, name)) for name in OPERATIONS)
+
+def read_manifest(manifest_path):
+    """ Returns the branch directories listed in a manifest:
+        one per line, relative to the directory of the manifest;
+        empty lines and lines starting with # are skipped
+    """
+    try:
+        with open(manifest_path, "r") as manifest_fp:
+            lines = manifest_fp.read().splitlines()
+    except IOError as error:
+        raise UpBackException("Cannot read the manifest: "+str(error))
+    base_path = os.path.dirname(os.path.abspath(manifest_path))
+    directories = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            directories.append(os.path.normpath(os.path.join(base_path, os.path.expanduser(line))))
+    return directories
+
+def sync_branch(arguments, directory, daemon=None, process_slots=None):
+    """ Synchronizes the branch directory belongs to, as upback does,
+        with its own Configuration, RClone and Profiler instances.
+        Must run in a new context (one per branch).
+        Returns a BranchResult
+    """
+    result = BranchResult(directory)
+    start = time.perf_counter()
+    profiler = Profiler.bind(Profiler().enabled)
+    configuration = Configuration.bind(arguments)
+    configuration.working_directory = directory
+    #operations are performed unattended
+    configuration.interactive = False
+    rclone = RClone.bind(configuration.rclone_path, configuration.rclone_executable, directory, process_slots)
+    rclone.daemon = daemon
+    try:
+        backup_config_path, rel_path = open_branch()
+        #rclone runs in directory, the local scanner in the working
+        #directory of the process: relative local remotes are resolved here
+        if is_path_local(configuration.remote):
+            configuration.remote = os.path.join(directory, configuration.remote)
+        result.operations = synchronize(backup_config_path, rel_path)
+    except Exception as exception: # pylint: disable=broad-except
+        #a failed branch does not stop the others
+        result.status = STATUS_ERROR
+        result.message = str(exception)
+    finally:
+        cleanup()
+        result.wall_time = time.perf_counter()-start
+        result.profile = profiler.summary()
+        result.invocations = dict(rclone.invocations)
+    return result
+
+def pretty_format_results(results):
+    """ Summary of the synchronized branches as a table,
+        followed by the errors
+    """
+    msg = "%-48s %-9s %10s %10s\n" % ("branch", "status", "time (s)", "operations")
+    for result in results:
+        msg += "%-48s %-9s %10.3f %10d\n" % (result.directory, result.state(), result.wall_time,
+                                             result.operations_count())
+    for result in results:
+        if result.message:
+            msg += result.directory+": "+result.message+"\n"
+    return msg
+
+def run_all(arguments):
+    """ Run-all mode entry point: synchronizes the branches in
+        the manifest by up to configuration.branches workers,
+        sharing the rclone rcd process if any and up to
+        configuration.rclone_processes rclone processes.
+        Profiles and rclone invocations of the branches are
+        accumulated in the process instances
+    """
+    configuration = Configuration()
+    try:
+        directories = read_manifest(configuration.manifest)
+    except UpBackException as exception:
+        print(str(exception))
+        return STATUS_ERROR
+    rclone = RClone(configuration.rclone_path, configuration.rclone_executable)
+    process_slots = threading.BoundedSemaphore(configuration.rclone_processes)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=configuration.branches) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, sync_branch, arguments, directory,
+                                   rclone.daemon, process_slots)
+                   for directory in directories]
+        results = [future.result() for future in futures]
+    profiler = Profiler()
+    for result in results:
+        profiler.merge(result.profile)
+        rclone.invocations.update(result.invocations)
+    profiler.count("branches", len(results))
+    print(pretty_format_results(results), end="")
+    if any(result.status != STATUS_OK for result in results):
+        return STATUS_ERROR
+    return STATUS_OK
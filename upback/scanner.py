@@ -0,0 +1,170 @@
+"""
+LocalScanner class, an in-process replacement for rclone lsjson -R
+used to list local filesystem branches
+"""
+
+import os
+import stat
+import logging
+import concurrent.futures
+
+from .path_element import PathElement
+from .util import ns_precision
+from .const import * # pylint: disable=unused-wildcard-import
+
+class LocalScanner(object):
+    """ Lists a local directory tree building PathElements
+        equivalent to the ones obtained from rclone lsjson -R --skip-links
+    """
+    def __init__(self, threads=0, harmonize_timestamp_precision=True, excludes=None, state=None):
+        # threads > 1 scans directories in parallel, useful on network
+        # mounts (NFS, CIFS) where stat latency dominates
+        self.threads = threads
+        self.harmonize_timestamp_precision = harmonize_timestamp_precision
+        # when a LocalExcludes is given excluded elements are skipped
+        # and excluded directories are not descended into
+        self.excludes = excludes
+        # when a LocalState is given directories that did not change
+        # since the previous run are not listed again
+        self.state = state
+
+    def scan(self, root, directory=""):
+        """ Returns a dictionary of paths relative to root,
+            pathnames are the keys, PathElements the values.
+            If directory (relative to root) is given only the
+            contents of directory are listed
+        """
+        logging.info("Scanning "+os.path.join(root, directory))
+        inherited_patterns = ()
+        if directory != "" and self.excludes is not None:
+            _, inherited_patterns = self.excludes.matcher_for(root, directory.rpartition("/")[0])
+        if self.state is not None:
+            self.state.add_scanned_root(os.path.join(root, directory))
+        if self.threads > 1:
+            entries = self.scan_parallel(root, directory, inherited_patterns)
+        else:
+            entries = self.scan_sequential(root, directory, inherited_patterns)
+        return self.build_path_elements(entries)
+
+    def scan_sequential(self, root, directory="", inherited_patterns=()):
+        """ Walks the tree from root/directory, returns a list of
+            (path, is_directory, size, mtime_ns) tuples
+        """
+        entries = []
+        directories = [(directory, inherited_patterns)]
+        while directories:
+            directory, inherited_patterns = directories.pop()
+            directory_entries, subdirectories = self.scan_directory(root, directory,
+                                                                    inherited_patterns)
+            entries += directory_entries
+            directories += subdirectories
+        return entries
+
+    def scan_parallel(self, root, directory="", inherited_patterns=()):
+        """ Same as scan_sequential but directories are
+            listed by a pool of threads
+        """
+        entries = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+            pending = {executor.submit(self.scan_directory, root, directory, inherited_patterns)}
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    directory_entries, subdirectories = future.result()
+                    entries += directory_entries
+                    for subdirectory, inherited_patterns in subdirectories:
+                        pending.add(executor.submit(self.scan_directory, root, subdirectory,
+                                                    inherited_patterns))
+        return entries
+
+    def scan_directory(self, root, directory, inherited_patterns):
+        """ Lists a single directory (relative to root)
+            Returns the directory entries and the relative paths
+            of its subdirectories along with the exclude patterns
+            they inherit
+        """
+        entries = []
+        subdirectories = []
+        directory_path = os.path.join(root, directory)
+        directory_entries = None
+        try:
+            if self.state is not None:
+                directory_stat = os.stat(directory_path)
+                directory_entries = self.state.listing(directory_path, directory_stat)
+            if directory_entries is None:
+                directory_entries = self.list_directory(directory_path)
+        except OSError as error:
+            # an unreadable directory must not look empty: the elements
+            # below it would be deleted from the other side
+            logging.error("Cannot list "+directory_path+": "+str(error))
+            raise
+        if self.state is not None:
+            self.state.update(directory_path, directory_stat, directory_entries)
+        matcher = None
+        if self.excludes is not None:
+            exclude_stat = None
+            for (name, is_directory, _, _) in directory_entries:
+                if name == UPBACK_EXCLUDE_FILE and not is_directory:
+                    exclude_stat = os.stat(os.path.join(directory_path, name))
+            matcher, inherited_patterns = self.excludes.directory_matcher(directory_path, exclude_stat,
+                                                                          inherited_patterns)
+        for (name, is_directory, size, mtime_ns) in directory_entries:
+            if matcher is not None and matcher.match(name):
+                continue
+            path = name if directory == "" else directory+"/"+name
+            entries.append((path, is_directory, size, mtime_ns))
+            if is_directory:
+                subdirectories.append((path, inherited_patterns))
+        return (entries, subdirectories)
+
+    @staticmethod
+    def list_directory(directory_path):
+        """ Returns the entries of directory_path as
+            (name, is_directory, size, mtime_ns) tuples
+        """
+        entries = []
+        with os.scandir(directory_path) as directory_iterator:
+            for entry in directory_iterator:
+                if entry.is_symlink():
+                    # symlinks are skipped, as with rclone --skip-links
+                    continue
+                entry_stat = entry.stat(follow_symlinks=False)
+                if entry.is_dir(follow_symlinks=False):
+                    entries.append((entry.name, True, -1, entry_stat.st_mtime_ns))
+                elif entry.is_file(follow_symlinks=False):
+                    entries.append((entry.name, False, entry_stat.st_size, entry_stat.st_mtime_ns))
+        return entries
+
+    def scan_path(self, root, path):
+        """ Returns a PathElement for a single path (relative to root),
+            None if path does not exist or is not a regular file or a directory.
+            Other errors (e.g. an unreadable parent) are raised
+        """
+        try:
+            path_stat = os.lstat(os.path.join(root, path))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        if stat.S_ISDIR(path_stat.st_mode):
+            entry = (path, True, -1, path_stat.st_mtime_ns)
+        elif stat.S_ISREG(path_stat.st_mode):
+            entry = (path, False, path_stat.st_size, path_stat.st_mtime_ns)
+        else:
+            return None
+        return self.build_path_elements([entry])[path]
+
+    def build_path_elements(self, entries):
+        """ Converts scanned entries to PathElements
+            applying the same timestamp precision rclone would use
+        """
+        paths = {}
+        top_precision = 0
+        for (path, is_directory, size, mtime_ns) in entries:
+            time_precision = ns_precision(mtime_ns)
+            if time_precision > top_precision:
+                top_precision = time_precision
+            paths[path] = PathElement(path, mtime_ns, time_precision, size, is_directory, True)
+        if self.harmonize_timestamp_precision:
+            for path_element in paths.values():
+                path_element.time_precision = top_precision
+        return paths
@@ -0,0 +1,255 @@
+"""
+Compact binary format of the remote backup file (.upback.remote)
+
+The file starts with a fixed header followed by the entries, sorted
+in tree order (path_sort_key). Each entry is a fixed size record
+followed by the part of its path not shared with the previous entry:
+    shared     uint16  length of the prefix shared with the previous path
+    suffix     uint32  length of the rest of the path (UTF-8 bytes)
+    flags      uint8   bit 0: directory, bits 1-4: timestamp precision,
+                       bit 5: the entry has a checksum
+    time_stamp int64   nanoseconds since the epoch
+    size       int64   size in bytes, -1 for directories
+Entries with a checksum have it after their path: its length (uint8)
+followed by the "type:hex digest" string (ASCII).
+Every RESTART_INTERVAL entries the whole path is stored (shared is 0),
+the offsets of these restart entries are stored after the entries and
+allow lookups without decoding the whole file.
+The restart offsets are followed by a directory index:
+one record per directory, in tree order, with the offset and length
+of its path (in a pool of paths following the records), the position
+of the directory among the entries and the number of entries below it.
+The elements below a directory are contiguous: the directory index
+allows decoding just them.
+"""
+
+import os
+import json
+import mmap
+import struct
+
+from .path_element import PathElement
+from .util import path_sort_key
+
+MAGIC = b"UPBKSNAP"
+VERSION = 1
+RESTART_INTERVAL = 16
+# magic, version, restart interval, number of entries, offset of the restart index,
+# offset of the directory index, number of directories
+HEADER = struct.Struct("<8sIIQQQQ")
+ENTRY = struct.Struct("<HIBqq")
+# offset and length of the path in the pool, entry index, number of entries below
+DIRECTORY = struct.Struct("<QIQQ")
+OFFSET = struct.Struct("<Q")
+FLAG_DIRECTORY = 0x01
+FLAG_CHECKSUM = 0x20
+PRECISION_MASK = 0x1e
+
+class SnapshotReader(object):
+    """ Memory mapped snapshot, entries are decoded as they are read
+    """
+    def __init__(self, snapshot_path):
+        self.snapshot_path = snapshot_path
+        with open(snapshot_path, "rb") as snapshot_fp:
+            self.map = mmap.mmap(snapshot_fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.restart_interval, self.count, self.index_offset, \
+                self.directory_offset, self.directory_count = HEADER.unpack_from(self.map, 0)
+        except struct.error:
+            self.close()
+            raise ValueError("Truncated snapshot "+snapshot_path)
+        self.entries_offset = HEADER.size
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("Unsupported snapshot format in "+snapshot_path)
+        self.restart_count = (self.count+self.restart_interval-1)//self.restart_interval
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.elements(self.entries_offset, self.count)
+
+    def close(self):
+        """ Releases the mapping """
+        self.map.close()
+
+    def restart_offset(self, restart):
+        """ Offset of the restart-th restart entry """
+        return OFFSET.unpack_from(self.map, self.index_offset+restart*OFFSET.size)[0]
+
+    def elements(self, offset, count, skip=0):
+        """ Decodes skip+count entries starting from offset (a restart entry),
+            yields PathElements for the last count ones
+        """
+        snapshot_map = self.map
+        unpack_from = ENTRY.unpack_from
+        entry_size = ENTRY.size
+        path_bytes = b""
+        for _ in range(skip):
+            shared, suffix_length, flags, _, _ = unpack_from(snapshot_map, offset)
+            offset += entry_size
+            path_bytes = path_bytes[:shared]+snapshot_map[offset:offset+suffix_length]
+            offset += suffix_length
+            if flags & FLAG_CHECKSUM:
+                offset += 1+snapshot_map[offset]
+        for _ in range(count):
+            shared, suffix_length, flags, time_stamp, size = unpack_from(snapshot_map, offset)
+            offset += entry_size
+            path_bytes = path_bytes[:shared]+snapshot_map[offset:offset+suffix_length]
+            offset += suffix_length
+            checksum = None
+            if flags & FLAG_CHECKSUM:
+                checksum_length = snapshot_map[offset]
+                checksum = snapshot_map[offset+1:offset+1+checksum_length].decode("ascii")
+                offset += 1+checksum_length
+            yield PathElement(path_bytes.decode("utf-8"), time_stamp,
+                              (flags & PRECISION_MASK) >> 1, size, bool(flags & FLAG_DIRECTORY), False, checksum)
+
+    def entries(self, index, count):
+        """ Yields PathElements for count entries starting from the index-th one
+        """
+        restart = index//self.restart_interval
+        return self.elements(self.restart_offset(restart), count, index-restart*self.restart_interval)
+
+    def restart_path(self, restart):
+        """ Path of the restart-th restart entry """
+        offset = self.restart_offset(restart)
+        _, suffix_length, _, _, _ = ENTRY.unpack_from(self.map, offset)
+        offset += ENTRY.size
+        return self.map[offset:offset+suffix_length].decode("utf-8")
+
+    def get(self, path):
+        """ Returns the PathElement for path, None if not found.
+            Only the entries following the closest restart entry are decoded
+        """
+        key = path_sort_key(path)
+        low, high = 0, self.restart_count
+        while low < high:
+            middle = (low+high)//2
+            if path_sort_key(self.restart_path(middle)) <= key:
+                low = middle+1
+            else:
+                high = middle
+        if low == 0:
+            return None
+        restart = low-1
+        count = min(self.restart_interval, self.count-restart*self.restart_interval)
+        for path_element in self.elements(self.restart_offset(restart), count):
+            if path_element.path == path:
+                return path_element
+        return None
+
+    def directory(self, directory_index):
+        """ Returns (path, entry index, number of entries below)
+            for the directory_index-th directory
+        """
+        path_offset, path_length, index, count = DIRECTORY.unpack_from(
+            self.map, self.directory_offset+directory_index*DIRECTORY.size)
+        return (self.map[path_offset:path_offset+path_length].decode("utf-8"), index, count)
+
+    def subtree(self, path):
+        """ Yields the PathElements below the directory path
+            ("" for all of them) decoding only those entries
+        """
+        if path == "":
+            return iter(self)
+        key = path_sort_key(path)
+        low, high = 0, self.directory_count
+        while low < high:
+            middle = (low+high)//2
+            if path_sort_key(self.directory(middle)[0]) < key:
+                low = middle+1
+            else:
+                high = middle
+        if low == self.directory_count:
+            return iter(())
+        directory_path, index, count = self.directory(low)
+        if directory_path != path:
+            return iter(())
+        return self.entries(index+1, count)
+
+def write_snapshot(snapshot_path, path_elements, restart_interval=RESTART_INTERVAL):
+    """ Writes path_elements (an iterable of PathElements)
+        to snapshot_path, replacing it atomically
+    """
+    sorted_elements = sorted(path_elements, key=lambda path_element: path_sort_key(path_element.path))
+    temporary_path = snapshot_path+".tmp"
+    restarts = []
+    # [path, entry index, number of entries below] for each directory, in
+    # tree order; open_directories are the ancestors of the current entry
+    directories = []
+    open_directories = []
+    with open(temporary_path, "wb") as snapshot_fp:
+        snapshot_fp.write(HEADER.pack(MAGIC, VERSION, restart_interval, len(sorted_elements), 0, 0, 0))
+        offset = HEADER.size
+        previous_path = b""
+        for index, path_element in enumerate(sorted_elements):
+            path_bytes = path_element.path.encode("utf-8")
+            while open_directories and not path_bytes.startswith(open_directories[-1][0]+b"/"):
+                directory = open_directories.pop()
+                directory[2] = index-directory[1]-1
+            if path_element.is_directory:
+                directories.append([path_bytes, index, 0])
+                open_directories.append(directories[-1])
+            if index % restart_interval == 0:
+                restarts.append(offset)
+                shared = 0
+            else:
+                shared = min(len(os.path.commonprefix([previous_path, path_bytes])), 0xffff)
+            flags = (path_element.time_precision << 1) | (FLAG_DIRECTORY if path_element.is_directory else 0)
+            checksum_bytes = b""
+            if path_element.checksum is not None:
+                flags |= FLAG_CHECKSUM
+                checksum = path_element.checksum.encode("ascii")
+                checksum_bytes = bytes([len(checksum)])+checksum
+            record = ENTRY.pack(shared, len(path_bytes)-shared, flags,
+                                path_element.time_stamp, path_element.size)
+            snapshot_fp.write(record)
+            snapshot_fp.write(path_bytes[shared:])
+            snapshot_fp.write(checksum_bytes)
+            offset += len(record)+len(path_bytes)-shared+len(checksum_bytes)
+            previous_path = path_bytes
+        for directory in open_directories:
+            directory[2] = len(sorted_elements)-directory[1]-1
+        snapshot_fp.write(struct.pack("<%dQ" % len(restarts), *restarts))
+        directory_offset = offset+len(restarts)*OFFSET.size
+        path_offset = directory_offset+len(directories)*DIRECTORY.size
+        for path_bytes, index, count in directories:
+            snapshot_fp.write(DIRECTORY.pack(path_offset, len(path_bytes), index, count))
+            path_offset += len(path_bytes)
+        for path_bytes, _, _ in directories:
+            snapshot_fp.write(path_bytes)
+        snapshot_fp.seek(0)
+        snapshot_fp.write(HEADER.pack(MAGIC, VERSION, restart_interval, len(sorted_elements), offset,
+                                      directory_offset, len(directories)))
+    os.replace(temporary_path, snapshot_path)
+
+def is_snapshot(snapshot_path):
+    """ Returns True if snapshot_path is in the binary format """
+    with open(snapshot_path, "rb") as snapshot_fp:
+        return snapshot_fp.read(len(MAGIC)) == MAGIC
+
+def migrate_json_snapshot(snapshot_path):
+    """ Converts a remote backup file written by previous versions
+        (the output of rclone lsjson) to the binary format
+    """
+    with open(snapshot_path, "r") as snapshot_fp:
+        paths_json = json.load(snapshot_fp)
+    write_snapshot(snapshot_path, [PathElement.from_json(path_json, False) for path_json in paths_json])
+
+def open_snapshot(snapshot_path):
+    """ Returns a SnapshotReader for snapshot_path, migrating it
+        to the binary format if needed.
+        Raises IOError if the file does not exist, ValueError if
+        it cannot be read
+    """
+    if not is_snapshot(snapshot_path):
+        migrate_json_snapshot(snapshot_path)
+    return SnapshotReader(snapshot_path)
@@ -5,12 +5,38 @@
 import unittest
 import os
 import tempfile
+import shutil
 import logging
 import json
+import sys
+import subprocess
+import random
+import zlib
+import hashlib
+import contextvars
+import threading
 
+from . import rclone as rclone_module
 from .rclone import RClone
-from .upback import PathElement, upback, exclude_filter, rclone_ls
+from .upback import PathElement, upback, exclude_filter, rclone_ls, retrieve_backup, update_backup, \
+    compute_operations, synchronize, checkpoint_backup, UpBackException
 from .configuration import Configuration
+from .operations import Operations, compact_deletes, detect_moves, ExecutionResult
+from .executor import OperationsExecutor, BatchOperationsExecutor
+from .excludes import GlobalExcludes, LocalExcludes
+from .scanner import LocalScanner
+from .local_state import LocalState
+from .watch import BranchWatcher
+from .path_listing import PathListing
+from .diff import diff_operations
+from .snapshot import SnapshotReader, write_snapshot, is_snapshot
+from .util import parse_rfc3339, ns_precision
+from .profiling import Profiler
+from .hashing import HashCache, hash_files, checksum_type
+from .metrics import format_metrics, write_metrics
+from .run_all import read_manifest, sync_branch, run_all
+from .journal import Journal
+from .change_token import remote_unchanged, update_token, read_local_token
 from .const import * # pylint: disable=unused-wildcard-import
 
 # This is a very bad example of test set, the main reason is that tests are not independent.
@@ -174,7 +200,7 @@ class UpbackTestCase(unittest.TestCase):
         output = self.rclone.run(args)
         paths_list = json.loads(output)
         paths = {}
-        excluded_paths = [ UPBACK_REMOTE_BACKUP ]
+        excluded_paths = UPBACK_INTERNAL_FILES
         for path_json in paths_list:
             if not path_json["Path"] in excluded_paths and not (obeysExcludes and exclude_filter(path, path_json["Path"])): #TODO: what about simplify this?
                 path_entry = PathElement.from_json(path_json)
@@ -470,6 +496,30 @@ class UpbackTestCase(unittest.TestCase):
         self.assertTrue(local_matches)
         self.assertTrue(remote_matches)
 
+    def test_move_dir_local(self):
+        """ rename local dir, files are moved in remote """
+        os.rename(self.local+"/a/b", self.local+"/a/f")
+        self.run_upback_from(self.local)
+        path_element_b = self.path_contents.pop("a/b")
+        path_element_b1_txt = self.path_contents.pop("a/b/b1.txt")
+        self.path_contents["a/f"] = PathElement("a/f", is_directory=True)
+        self.path_contents["a/f/b1.txt"] = PathElement("a/f/b1.txt", is_directory=False,
+                                                       size=path_element_b1_txt.size)
+        contents = self.path_contents.items()
+        local_matches = self.path_contains(self.local, contents)
+        remote_matches = self.path_contains(self.remote, contents)
+        #restore
+        os.rename(self.local+"/a/f", self.local+"/a/b")
+        self.run_upback_from(self.local)
+        del self.path_contents["a/f"]
+        del self.path_contents["a/f/b1.txt"]
+        self.path_contents["a/b"] = path_element_b
+        self.path_contents["a/b/b1.txt"] = path_element_b1_txt
+        #assert
+        self.assertTrue(local_matches)
+        self.assertTrue(remote_matches)
+        self.assertTrue(self.path_contains(self.remote, self.path_contents.items()))
+
     def test_delete_empty_dir_local(self):
         """ delete empty local dir """
         self.rclone.purge(self.local+"/a/d")
@@ -761,6 +811,1393 @@ class UpbackTestCase(unittest.TestCase):
         os.remove(long_path)
         self.assertTrue(paths["short"].time_precision == (paths["long"].time_precision))
 
+    def test_local_scanner_matches_rclone(self):
+        """ check that the local scanner lists the same elements as rclone lsjson """
+        paths = rclone_ls(self.local)
+        path_elements = self.rclone.listing(self.local)
+        self.assertEqual(len(paths), len(path_elements))
+        for path_element in path_elements:
+            self.assertTrue(path_element.path in paths)
+            self.assertTrue(path_element.is_effectively_equal_to(paths[path_element.path]))
+
+class CompactDeletesTestCase(unittest.TestCase):
+    """ compact_deletes test case, does not require rclone """
+
+    def test_compact_deletes(self):
+        """ deletes of elements contained in deleted directories are removed """
+        path_elements = {
+            "a": PathElement("a", is_directory=True),
+            "a/a1.txt": PathElement("a/a1.txt"),
+            "a/b": PathElement("a/b", is_directory=True),
+            "a/b/b1.txt": PathElement("a/b/b1.txt"),
+            "a-b": PathElement("a-b", is_directory=True),
+            "a-b/c.txt": PathElement("a-b/c.txt"),
+            "ab.txt": PathElement("ab.txt"),
+            "c/c1.txt": PathElement("c/c1.txt")
+        }
+        delete_ops = [("c/c1.txt", False), ("a/b/b1.txt", True), ("ab.txt", False),
+                      ("a-b/c.txt", False), ("a/b", False), ("a/a1.txt", False), ("a", False)]
+        self.assertEqual(compact_deletes(delete_ops, path_elements),
+                         [("c/c1.txt", False), ("ab.txt", False), ("a-b/c.txt", False), ("a", False)])
+class OperationsExecutorTestCase(unittest.TestCase):
+    """ Operations executor test case, does not require rclone
+        (tasks are replaced by stub actions)
+    """
+
+    def test_plan(self):
+        """ directories are created by depth, then files are copied or moved, then deleted, then purged """
+        operations = Operations()
+        for path in ["a", "a/b", "a/b/c", "a/b/c/f.txt", "x"]:
+            operations.add_copy_a_to_b(path)
+        operations.add_copy_b_to_a("y")
+        operations.add_copy_b_to_a("g.txt")
+        operations.add_delete_from_b("old")
+        operations.add_delete_from_b("old/h.txt")
+        operations.add_delete_from_a("i.txt")
+        operations.add_move_in_b("j.txt", "a/j.txt")
+        paths_a = dict((path, PathElement(path, 0, 9, -1 if is_directory else 1, is_directory, True))
+                       for path, is_directory in [("a", True), ("a/b", True), ("a/b/c", True),
+                                                  ("a/b/c/f.txt", False), ("x", True), ("i.txt", False)])
+        paths_b = dict((path, PathElement(path, 0, 9, -1 if is_directory else 1, is_directory, False))
+                       for path, is_directory in [("y", True), ("g.txt", False), ("old", True),
+                                                  ("old/h.txt", False)])
+        phases = OperationsExecutor("remote:", "", True).plan(operations, paths_a, paths_b)
+        phase_paths = [sorted((operation, paths[0]) for operation, paths, _ in phase) for phase in phases]
+        self.assertEqual(phase_paths, [
+            [(OPERATION_COPY_A_TO_B, "a"), (OPERATION_COPY_A_TO_B, "x"), (OPERATION_COPY_B_TO_A, "y")],
+            [(OPERATION_COPY_A_TO_B, "a/b")],
+            [(OPERATION_COPY_A_TO_B, "a/b/c")],
+            [(OPERATION_COPY_A_TO_B, "a/b/c/f.txt"), (OPERATION_COPY_B_TO_A, "g.txt"),
+             (OPERATION_MOVE_IN_B, "a/j.txt")],
+            [],
+            [(OPERATION_DELETE_FROM_A, "i.txt")],
+            [(OPERATION_DELETE_FROM_B, "old")]])
+
+    def test_execute(self):
+        """ phases are run in order, each one after the previous one completed """
+        calls = []
+        def stub(path, failure=None):
+            def action():
+                calls.append(path)
+                return {path: failure} if failure else {}
+            return action
+        def fail():
+            calls.append("d/b")
+            raise subprocess.CalledProcessError(1, ["rclone"], "failed\n")
+        executor = OperationsExecutor("remote:", "", True, jobs=4)
+        phases = [[(OPERATION_COPY_A_TO_B, ["d"], stub("d"))],
+                  [(OPERATION_COPY_A_TO_B, ["d/a"], stub("d/a")), (OPERATION_COPY_A_TO_B, ["d/b"], fail)],
+                  [(OPERATION_DELETE_FROM_B, ["e", "f"], stub("e", "not found"))]]
+        executor.plan = lambda operations, paths_a, paths_b: phases
+        result = executor.execute(Operations(), {}, {})
+        self.assertEqual(calls[0], "d")
+        self.assertEqual(sorted(calls[1:3]), ["d/a", "d/b"])
+        self.assertEqual(calls[3:], ["e"])
+        self.assertEqual(sorted(result.completed), [(OPERATION_COPY_A_TO_B, "d"), (OPERATION_COPY_A_TO_B, "d/a"),
+                                                    (OPERATION_DELETE_FROM_B, "f")])
+        self.assertEqual(sorted(result.failed), [(OPERATION_COPY_A_TO_B, "d/b", "failed"),
+                                                 (OPERATION_DELETE_FROM_B, "e", "not found")])
+
+    def test_concurrency(self):
+        """ with jobs > 1 the tasks of a phase run concurrently and all their outcomes are recorded """
+        jobs = 4
+        barrier = threading.Barrier(jobs, timeout=10)
+        threads = set()
+        lock = threading.Lock()
+        def action():
+            with lock:
+                threads.add(threading.get_ident())
+            #returns only when jobs tasks are running at the same time
+            barrier.wait()
+            return {}
+        tasks = [(OPERATION_COPY_A_TO_B, ["f%d" % index], action) for index in range(jobs*10)]
+        result = ExecutionResult()
+        OperationsExecutor("remote:", "", True, jobs=jobs).run_phase(tasks, result)
+        self.assertEqual(len(threads), jobs)
+        self.assertEqual(sorted(path for _, path in result.completed),
+                         sorted("f%d" % index for index in range(jobs*10)))
+        self.assertTrue(result.is_successful())
+
+    def test_task_errors(self):
+        """ unexpected errors fail the paths of their task, interruptions drop the tasks not started yet """
+        def broken():
+            raise OSError(28, "No space left on device")
+        result = ExecutionResult()
+        OperationsExecutor("remote:", "", True).run_task((OPERATION_COPY_A_TO_B, ["a", "b"], broken), result)
+        self.assertEqual(sorted(result.failed), [(OPERATION_COPY_A_TO_B, "a", "[Errno 28] No space left on device"),
+                                                 (OPERATION_COPY_A_TO_B, "b", "[Errno 28] No space left on device")])
+        calls = []
+        def interrupt():
+            raise KeyboardInterrupt()
+        def slow():
+            calls.append(threading.get_ident())
+            threading.Event().wait(0.05)
+            return {}
+        tasks = [(OPERATION_COPY_A_TO_B, ["i"], interrupt)]
+        tasks += [(OPERATION_COPY_A_TO_B, ["f%d" % index], slow) for index in range(20)]
+        executor = OperationsExecutor("remote:", "", True, jobs=2)
+        self.assertRaises(KeyboardInterrupt, executor.run_phase, tasks, ExecutionResult())
+        self.assertTrue(len(calls) < 20)
+
+class BatchOperationsTestCase(unittest.TestCase):
+    """ Batched operations test case, rclone is replaced by a script """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="upback_batch")
+        self.calls_path = os.path.join(self.root, "calls.log")
+        self.rclone = RClone()
+        self.rclone_file = self.rclone.rclone_file
+
+    def tearDown(self):
+        self.rclone.rclone_file = self.rclone_file
+        shutil.rmtree(self.root)
+
+    def fake_rclone(self, outputs):
+        """ replaces rclone with a script logging its arguments and the
+            files passed with --files-from, then writing the output and
+            exiting with the status outputs gives for the command
+            (a dictionary of (output, status) tuples)
+        """
+        script_path = os.path.join(self.root, "rclone")
+        with open(script_path, "w") as script_fp:
+            script_fp.write("#!"+sys.executable+"\nimport sys, json\n"
+                            "args = sys.argv[1:]\n"
+                            "files = []\n"
+                            "if '--files-from' in args:\n"
+                            "    with open(args[args.index('--files-from')+1]) as files_fp:\n"
+                            "        files = files_fp.read().splitlines()\n"
+                            "with open("+repr(self.calls_path)+", 'a') as calls_fp:\n"
+                            "    calls_fp.write(json.dumps([args, files])+'\\n')\n"
+                            "output, status = "+repr(outputs)+".get(args[0], ('', 0))\n"
+                            "sys.stdout.write(output)\n"
+                            "sys.exit(status)\n")
+        os.chmod(script_path, 0o755)
+        self.rclone.rclone_file = script_path
+
+    def calls(self):
+        """ The (arguments, files) of the rclone invocations """
+        if not os.path.exists(self.calls_path):
+            return []
+        with open(self.calls_path) as calls_fp:
+            return [tuple(json.loads(line)) for line in calls_fp]
+
+    @staticmethod
+    def log(entries):
+        """ rclone json log of (level, object, message) entries """
+        return "".join(json.dumps({"level": level, "object": path, "msg": message})+"\n"
+                       for level, path, message in entries)
+
+    @staticmethod
+    def listing(elements):
+        """ Listing of (path, is_directory) elements """
+        return dict((path, PathElement(path, 0, 9, -1 if is_directory else 1, is_directory, True))
+                    for path, is_directory in elements)
+
+    def test_grouping(self):
+        """ files are copied and deleted in chunks of batch_size, grouped by backup flag """
+        self.fake_rclone({})
+        operations = Operations()
+        for path in ["a.txt", "b.txt", "c.txt"]:
+            operations.add_copy_a_to_b(path)
+        operations.add_copy_a_to_b("d.txt", True)
+        operations.add_delete_from_b("e.txt", True)
+        operations.add_delete_from_b("f.txt", True)
+        paths_a = self.listing([("a.txt", False), ("b.txt", False), ("c.txt", False), ("d.txt", False)])
+        paths_b = self.listing([("e.txt", False), ("f.txt", False)])
+        executor = BatchOperationsExecutor("remote:", "", False, "remote:old", batch_size=2)
+        result = executor.execute(operations, paths_a, paths_b)
+        self.assertTrue(result.is_successful())
+        self.assertEqual(len(result.completed), 6)
+        #the backup flag of operations is passed as the no_backup argument, as in the single path executor
+        calls = [(args[0], "--backup-dir" in args, files) for args, files in self.calls()]
+        self.assertEqual(calls, [("copy", True, ["a.txt", "b.txt"]), ("copy", True, ["c.txt"]),
+                                 ("copy", False, ["d.txt"]), ("delete", False, ["e.txt", "f.txt"])])
+        self.assertEqual(self.calls()[0][0][:4], ["copy", "--no-traverse", ".", "remote:"])
+
+    def test_implicit_directories(self):
+        """ directories with copied contents are not created, unless all their copies fail """
+        operations = Operations()
+        for path in ["d", "d/e", "d/e/a.txt", "f", "g", "g/b.txt"]:
+            operations.add_copy_a_to_b(path)
+        paths_a = self.listing([("d", True), ("d/e", True), ("d/e/a.txt", False), ("f", True),
+                                ("g", True), ("g/b.txt", False)])
+        executor = BatchOperationsExecutor("remote:", "", True)
+        phases = executor.plan(operations, paths_a, {})
+        self.assertEqual([paths for _, paths, _ in phases[0]], [["f"]])
+        self.assertEqual([paths for _, paths, _ in phases[2]], [["d", "d/e", "g"]])
+        listing = json.dumps([{"Path": "d/e/a.txt", "Name": "a.txt", "Size": 1,
+                               "ModTime": "2017-11-02T10:23:41Z", "IsDir": False}])
+        self.fake_rclone({"copy": (self.log([("error", "g/b.txt", "permission denied")]), 1),
+                          "lsjson": (listing, 0)})
+        result = BatchOperationsExecutor("remote:", "", True).execute(operations, paths_a, {})
+        self.assertEqual(sorted(result.completed),
+                         [(OPERATION_COPY_A_TO_B, path) for path in ["d", "d/e", "d/e/a.txt", "f"]])
+        self.assertEqual(sorted((path, message) for _, path, message in result.failed),
+                         [("g", "no element was created in the directory"), ("g/b.txt", "permission denied")])
+        self.assertEqual([args[0] for args, _ in self.calls()], ["mkdir", "copy", "lsjson"])
+
+    def test_parse_failures(self):
+        """ files with errors are failed, unreported ones are checked """
+        output = "NOTICE: not json\n"+self.log([("info", "a", "Copied (new)"), ("error", "b", "not found"),
+                                                  ("debug", "c", "Unchanged skipping"),
+                                                  ("error", None, "Attempt 1/1 failed")])
+        files = ["a", "b", "c", "d"]
+        self.assertEqual(RClone.parse_failures(output, files, lambda paths: {"c"}),
+                         {"b": "not found", "d": "Attempt 1/1 failed"})
+        self.assertEqual(RClone.parse_failures(output, files),
+                         {"b": "not found", "c": "Attempt 1/1 failed", "d": "Attempt 1/1 failed"})
+        def failing_check(paths):
+            raise subprocess.CalledProcessError(1, ["lsjson"], "directory not found")
+        self.assertEqual(set(RClone.parse_failures(output, files, failing_check)), {"b", "c", "d"})
+        self.assertEqual(RClone.parse_failures("", ["a"]), {"a": "rclone failed"})
+
+    def test_partial_failures(self):
+        """ files skipped by a failed invocation are completed if they are in the expected state """
+        listing = json.dumps([{"Path": "c", "Name": "c", "Size": 1, "ModTime": "2017-11-02T10:23:41Z",
+                               "IsDir": False}])
+        self.fake_rclone({"copy": (self.log([("info", "a", "Copied (new)"), ("error", "b", "failed")]), 1),
+                          "delete": (self.log([("error", "b", "failed")]), 1),
+                          "lsjson": (listing, 0)})
+        self.assertEqual(self.rclone.copy_files(".", "remote:dir", ["a", "b", "c", "d"]),
+                         {"b": "failed", "d": "rclone failed"})
+        self.assertEqual(self.rclone.delete_files("remote:dir", ["b", "c", "d"]),
+                         {"b": "failed", "c": "rclone failed"})
+        calls = self.calls()
+        self.assertEqual(calls[1], (["lsjson", "-R", "--skip-links", "remote:dir", "--files-from", calls[1][0][5]],
+                                    ["c", "d"]))
+        self.assertEqual(calls[3][1], ["c", "d"])
+        self.assertEqual(calls[2][0][:2], ["delete", "remote:dir"])
+
+class DetectMovesTestCase(unittest.TestCase):
+    """ detect_moves test case, does not require rclone """
+
+    @staticmethod
+    def listing(elements, is_local):
+        """ A PathListing of (path, time stamp, size) tuples, size -1 for directories """
+        return PathListing(PathElement(path, time_stamp, 9, size, size < 0, is_local)
+                           for path, time_stamp, size in elements)
+
+    def operations(self, backup, a, b):
+        """ Computes operations between a and b (lists of elements),
+            b is also the remote backup unless backup is given
+        """
+        paths_b_backup = self.listing(b if backup is None else backup, False)
+        paths_a, paths_b = self.listing(a, True), self.listing(b, False)
+        operations = diff_operations(set(paths_a) | set(paths_b), paths_a, paths_b_backup, paths_b)
+        return detect_moves(operations, paths_a, paths_b), paths_a, paths_b
+
+    def test_renamed_directory(self):
+        """ files in a renamed local directory are moved in remote """
+        old = [("big", 1, -1), ("big/x.bin", 2, 10), ("big/y", 3, -1), ("big/y/z.bin", 4, 20),
+               ("big/y/w.bin", 4, 20), ("big/e.txt", 5, 0)]
+        new = [("new"+path[3:], time_stamp, size) for path, time_stamp, size in old]
+        operations, paths_a, paths_b = self.operations(None, new, old)
+        self.assertEqual(operations.move_in_b, [("big/x.bin", "new/x.bin", False),
+                                                ("big/y/w.bin", "new/y/w.bin", False),
+                                                ("big/y/z.bin", "new/y/z.bin", False)])
+        self.assertEqual(sorted(operations.copy_a_to_b), [("new", False), ("new/e.txt", False), ("new/y", False)])
+        self.assertEqual(sorted(operations.delete_from_b), [("big", False), ("big/e.txt", False), ("big/y", False)])
+        self.assertEqual(operations.move_in_a, [])
+        RClone()
+        phases = OperationsExecutor("remote:", "", True).plan(operations, paths_a, paths_b)
+        moves = [index for index, phase in enumerate(phases)
+                 for operation, _, _ in phase if operation == OPERATION_MOVE_IN_B]
+        purges = [index for index, phase in enumerate(phases)
+                  for operation, paths, _ in phase if paths == ["big"]]
+        self.assertEqual(len(moves), 3)
+        self.assertLess(max(moves), min(purges))
+
+    def test_renamed_remote_file(self):
+        """ a file renamed in remote is moved in local, the copy backup flag is kept """
+        operations, _, _ = self.operations([("a.txt", 1, 10)], [("a.txt", 1, 10)], [("b.txt", 1, 10)])
+        self.assertEqual(operations.move_in_a, [("a.txt", "b.txt", False)])
+        self.assertTrue(operations.delete_from_a == operations.copy_b_to_a == [])
+
+    def test_ambiguous_moves(self):
+        """ ambiguous, empty, different and overwriting files are not moved """
+        old = [("a.txt", 1, 10), ("b.txt", 1, 10), ("c.txt", 1, 0), ("d.txt", 1, 30), ("e.txt", 1, 40),
+               ("f.txt", 1, 40)]
+        new = [("g.txt", 1, 10), ("h.txt", 1, 10), ("i.txt", 1, 0), ("j.txt", 10**9, 30), ("f.txt", 10**9, 40)]
+        operations, _, _ = self.operations(old, new, old)
+        self.assertEqual(operations.move_in_b, [])
+        self.assertEqual(len(operations.delete_from_b), 5)
+        self.assertEqual(len(operations.copy_a_to_b), 5)
+
+class GlobalExcludesTestCase(unittest.TestCase):
+    """ GlobalExcludes test case, does not require rclone """
+
+    paths = ["a", "a/a1.txt", "a/a2.txt", "a/b", "a/b/b1.txt", "a/b/b1.csv", "c", "c/local2",
+             "c/local2/a", "c/local2/a/a1.txt", "c/local2/x.csv", UPBACK_REMOTE_BACKUP]
+
+    def test_basename_excludes(self):
+        """ patterns without a / are matched against basenames """
+        excludes = GlobalExcludes(["a?.txt", "*.csv", UPBACK_REMOTE_BACKUP])
+        self.assertEqual(excludes.filter(self.paths),
+                         set(["a", "a/b", "a/b/b1.txt", "c", "c/local2", "c/local2/a"]))
+
+    def test_path_excludes(self):
+        """ patterns with a / are matched against the whole path """
+        excludes = GlobalExcludes(["a/b/*", "c/*/x.*"])
+        self.assertEqual(excludes.filter(self.paths),
+                         set(self.paths) - set(["a/b/b1.txt", "a/b/b1.csv", "c/local2/x.csv"]))
+
+    def test_path_excludes_from_subdir(self):
+        """ patterns with a / are relative to the root of the branch """
+        excludes = GlobalExcludes(["c/local2/a/b/*", "a/a1.txt"], "c/local2")
+        self.assertEqual(excludes.filter(["a", "a/a1.txt", "a/b", "a/b/b1.txt"]),
+                         set(["a", "a/a1.txt", "a/b"]))
+
+class LocalScannerTestCase(unittest.TestCase):
+    """ LocalScanner test case, does not require rclone """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="upback_scanner")
+        for path in ["a/a1.txt", "a/b/b1.txt", "c.txt"]:
+            os.makedirs(os.path.join(self.root, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(self.root, path), "w") as path_fp:
+                path_fp.write(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_unreadable_directory(self):
+        """ a directory that cannot be listed fails the scan instead of looking empty """
+        unreadable = os.path.join(self.root, "a", "b")
+        class UnreadableScanner(LocalScanner):
+            """ LocalScanner failing to list unreadable """
+            @staticmethod
+            def list_directory(directory_path):
+                if os.path.normpath(directory_path) == unreadable:
+                    raise PermissionError(13, "Permission denied", directory_path)
+                return LocalScanner.list_directory(directory_path)
+        self.assertEqual(set(LocalScanner().scan(self.root)), {"a", "a/a1.txt", "a/b", "a/b/b1.txt", "c.txt"})
+        for threads in [0, 4]:
+            with self.assertLogs(level=logging.ERROR):
+                self.assertRaises(PermissionError, UnreadableScanner(threads).scan, self.root)
+        self.assertEqual(LocalScanner().scan_path(self.root, "a/x.txt"), None)
+        self.assertEqual(LocalScanner().scan_path(self.root, "c.txt/x.txt"), None)
+
+class LocalExcludesTestCase(unittest.TestCase):
+    """ LocalExcludes test case, does not require rclone """
+
+    excludes = {
+        "": "*.log\n**/cache",
+        "a": "b",
+        "a/e": "**/exclude.me\nx?",
+        "c/cache": "nothing"
+    }
+    paths = ["a/a1.txt", "a/b/b1.txt", "a/e/exclude/exclude.me", "a/e/x1/f.txt", "a/e/x12/f.txt",
+             "a/e/f.log", "c/cache/c1.txt", "c/d/cache/c2.txt", "c/d/cache.txt", "top.log"]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="upback_excludes")
+        for path in self.paths:
+            os.makedirs(os.path.join(self.root, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(self.root, path), "w") as path_fp:
+                path_fp.write(path)
+        for directory, exclude_contents in self.excludes.items():
+            with open(os.path.join(self.root, directory, UPBACK_EXCLUDE_FILE), "w") as exclude_fp:
+                exclude_fp.write(exclude_contents)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_scan_matches_exclude_filter(self):
+        """ scanning with excludes lists the same paths exclude_filter does not filter """
+        expected = set(path for path in LocalScanner().scan(self.root)
+                       if not exclude_filter(self.root, path))
+        self.assertEqual(set(LocalScanner(excludes=LocalExcludes()).scan(self.root)), expected)
+        self.assertEqual(set(LocalScanner(4, excludes=LocalExcludes()).scan(self.root)), expected)
+        local_excludes = LocalExcludes()
+        self.assertEqual(set(path for path in LocalScanner().scan(self.root)
+                             if not local_excludes.is_excluded(self.root, path)), expected)
+
+    def test_cache(self):
+        """ compiled patterns are cached until the exclude file changes """
+        cache_path = os.path.join(self.root, UPBACK_EXCLUDE_CACHE)
+        local_excludes = LocalExcludes(cache_path)
+        LocalScanner(excludes=local_excludes).scan(self.root)
+        local_excludes.save()
+        local_excludes = LocalExcludes(cache_path)
+        #c/cache is excluded, its exclude file is never read
+        self.assertEqual(len(local_excludes.cache), len(self.excludes)-1)
+        with open(os.path.join(self.root, "a", UPBACK_EXCLUDE_FILE), "w") as exclude_fp:
+            exclude_fp.write("nothing here")
+        paths = LocalScanner(excludes=local_excludes).scan(self.root)
+        self.assertTrue("a/b/b1.txt" in paths)
+        self.assertTrue(local_excludes.cache_changed)
+
+class LocalStateTestCase(unittest.TestCase):
+    """ LocalState test case, does not require rclone """
+
+    paths = ["a/a1.txt", "a/a2.txt", "a/b/b1.txt", "c/c1.txt"]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="upback_state")
+        self.state_path = os.path.join(tempfile.mkdtemp(prefix="upback_state_file"), UPBACK_LOCAL_STATE)
+        for path in self.paths:
+            os.makedirs(os.path.join(self.root, os.path.dirname(path)), exist_ok=True)
+            self.write(path, path)
+        self.age_directories()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(os.path.dirname(self.state_path))
+
+    def write(self, path, contents):
+        """ writes a file keeping the modification time of its directory """
+        with open(os.path.join(self.root, path), "w") as path_fp:
+            path_fp.write(contents)
+
+    def age_directories(self):
+        """ sets the modification time of directories in the past
+            (a different one on each call) so that they are indexed
+        """
+        self.age = getattr(self, "age", 1000000000000000000) + 1000000000
+        for directory, _, _ in os.walk(self.root):
+            os.utime(directory, ns=(self.age, self.age))
+
+    def scan(self, trust_directory_mtime=False):
+        """ scans root using and updating the state file """
+        local_state = LocalState(self.state_path, trust_directory_mtime)
+        paths = LocalScanner(state=local_state).scan(self.root)
+        local_state.save()
+        return paths
+
+    def test_unchanged_scan(self):
+        """ scanning with an index gives the same result as a full scan """
+        first_paths = self.scan()
+        self.assertEqual(len(LocalState(self.state_path).directories), 4)
+        second_paths = self.scan()
+        self.assertEqual(second_paths, LocalScanner().scan(self.root))
+        self.assertEqual(first_paths, second_paths)
+
+    def test_changes(self):
+        """ files modified in place are detected unless directory modification times are trusted,
+            new and deleted files are always detected
+        """
+        self.scan()
+        self.write("a/a1.txt", "modified in place")
+        os.utime(os.path.join(self.root, "a"), ns=(self.age, self.age))
+        self.assertEqual(self.scan(True)["a/a1.txt"].size, len("a/a1.txt"))
+        self.assertEqual(self.scan()["a/a1.txt"].size, len("modified in place"))
+        os.remove(os.path.join(self.root, "a/a2.txt"))
+        self.write("a/b/b2.txt", "new")
+        self.age_directories()
+        paths = self.scan(True)
+        self.assertFalse("a/a2.txt" in paths)
+        self.assertTrue("a/b/b2.txt" in paths)
+        shutil.rmtree(os.path.join(self.root, "c"))
+        self.age_directories()
+        self.scan()
+        self.assertEqual(len(LocalState(self.state_path).directories), 3)
+
+class BranchWatcherTestCase(unittest.TestCase):
+    """ BranchWatcher local change tracking test case, does not require rclone """
+
+    paths = ["a/a1.txt", "a/a2.txt", "a/b/b1.txt", "c/c1.txt"]
+
+    def setUp(self):
+        if UpbackTestCase.configuration is None:
+            args = lambda: None
+            UpbackTestCase.configuration = Configuration(args)
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp(prefix="upback_watch")
+        for path in self.paths:
+            self.write(path, path)
+        self.write(UPBACK_EXCLUDE_FILE, "**/*.log")
+        os.chdir(self.root)
+        self.watcher = BranchWatcher(self.root, "", debounce=0.1)
+        self.watcher.load_local()
+
+    def tearDown(self):
+        self.watcher.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def write(self, path, contents):
+        """ writes a file creating its directory """
+        os.makedirs(os.path.join(self.root, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(self.root, path), "w") as path_fp:
+            path_fp.write(contents)
+
+    def collect_changes(self):
+        """ handles the pending events and returns the changed paths """
+        events = self.watcher.inotify.read_events(0.2)
+        while events:
+            self.watcher.handle_events(events)
+            events = self.watcher.inotify.read_events(0.2)
+        return self.watcher.collect_changes()
+
+    def assert_listing(self):
+        """ the tracked listing matches a fresh scan
+            (directory timestamps are not relevant and not tracked)
+        """
+        paths = LocalScanner(excludes=LocalExcludes()).scan(".")
+        self.assertEqual(set(self.watcher.paths_a), set(paths))
+        for path, path_element in paths.items():
+            if not path_element.is_directory:
+                self.assertEqual(self.watcher.paths_a[path], path_element)
+
+    def test_changes(self):
+        """ changed paths are reported and the listing is kept up to date """
+        self.write("a/a1.txt", "modified")
+        os.remove(os.path.join(self.root, "a/a2.txt"))
+        self.write("d/e/e1.txt", "new")
+        self.write("a/ignored.log", "excluded")
+        shutil.rmtree(os.path.join(self.root, "c"))
+        changed = self.collect_changes()
+        self.assertEqual(changed & set(self.paths+["d", "d/e", "d/e/e1.txt", "a/ignored.log", "c"]),
+                         {"a/a1.txt", "a/a2.txt", "c", "c/c1.txt", "d", "d/e", "d/e/e1.txt"})
+        self.assert_listing()
+        self.write("d/e/e2.txt", "new in a new directory")
+        os.rename(os.path.join(self.root, "a/b"), os.path.join(self.root, "d/b"))
+        changed = self.collect_changes()
+        self.assertTrue({"d/e/e2.txt", "a/b/b1.txt", "d/b/b1.txt"} <= changed)
+        self.assert_listing()
+        self.write("d/b/b2.txt", "new in a moved directory")
+        self.assertTrue("d/b/b2.txt" in self.collect_changes())
+        self.assert_listing()
+
+class PathListingTestCase(unittest.TestCase):
+    """ Array backed listing test case, does not require rclone """
+
+    def test_dictionary(self):
+        """ a PathListing behaves as a dictionary of PathElements """
+        rng = random.Random(0)
+        listing = PathListing()
+        listing.COMPACT_MIN = 8
+        paths = {}
+        for _ in range(2000):
+            path = "d%d/f%d" % (rng.randrange(5), rng.randrange(40))
+            if rng.random() < 0.4:
+                self.assertEqual(listing.pop(path, None), paths.pop(path, None))
+            else:
+                path_element = PathElement(path, rng.randrange(-2**62, 2**62), rng.randrange(10),
+                                           rng.randrange(-1, 2**40), rng.random() < 0.5, rng.random() < 0.5,
+                                           "md5:%d" % rng.randrange(3) if rng.random() < 0.01 else None)
+                listing[path] = path_element
+                paths[path] = path_element
+            self.assertEqual(len(listing), len(paths))
+        self.assertEqual(listing, paths)
+        self.assertEqual(list(listing.items()), list(paths.items()))
+        self.assertEqual(list(listing.values()), list(paths.values()))
+        self.assertTrue(all(path in listing for path in paths))
+        self.assertEqual(listing.get("d0"), None)
+        with self.assertRaises(KeyError):
+            del listing["d0"]
+        with self.assertRaises(ValueError):
+            listing["d0"] = PathElement("d1")
+
+class DiffTestCase(unittest.TestCase):
+    """ Diff engine test case, compute_operations is the reference
+        implementation. Does not require rclone
+    """
+
+    @staticmethod
+    def random_element(rng, path, element=None):
+        """ Returns a random PathElement for path, close
+            to element (if given) so that they are often
+            effectively equal
+        """
+        if element is None or rng.random() < 0.2:
+            return PathElement(path, rng.randrange(10**18), rng.randrange(10), rng.randrange(3),
+                               rng.random() < 0.2, rng.random() < 0.5, rng.choice([None, "md5:0", "md5:1"]))
+        return PathElement(path, element.time_stamp+rng.choice([0, 1, 9999, 10000, 99999999, 10**9]),
+                           rng.choice([element.time_precision, rng.randrange(10)]),
+                           element.size if rng.random() < 0.9 else element.size+1,
+                           element.is_directory if rng.random() < 0.9 else not element.is_directory,
+                           not element.is_local, rng.choice([element.checksum, element.checksum, None, "md5:1"]))
+
+    def test_same_operations(self):
+        """ diff_operations computes the same operations as compute_operations """
+        rng = random.Random(0)
+        for _ in range(20):
+            paths_a, paths_b_backup, paths_b = {}, {}, {}
+            for index in range(500):
+                path = "d%d/f%d" % (index % 7, index)
+                backup_element = None
+                if rng.random() < 0.7:
+                    backup_element = self.random_element(rng, path)
+                    paths_b_backup[path] = backup_element
+                for paths in [paths_a, paths_b]:
+                    if rng.random() < 0.8:
+                        paths[path] = self.random_element(rng, path, backup_element)
+            paths_all = set(paths_a) | set(paths_b)
+            expected = compute_operations(paths_all, paths_a, paths_b_backup, paths_b)
+            for listing_a, listing_b in [(paths_a, paths_b),
+                                         (PathListing(paths_a.values()), PathListing(paths_b.values()))]:
+                operations = diff_operations(paths_all, listing_a, PathListing(paths_b_backup.values()),
+                                             listing_b)
+                # operations are computed in a different order
+                for name in ["copy_a_to_b", "copy_b_to_a", "delete_from_a", "delete_from_b", "conflicts"]:
+                    self.assertEqual(sorted(getattr(operations, name)), sorted(getattr(expected, name)))
+            self.assertTrue(expected.copy_a_to_b and expected.copy_b_to_a and expected.delete_from_a and
+                            expected.delete_from_b and expected.conflicts)
+
+class SnapshotTestCase(unittest.TestCase):
+    """ Binary remote backup test case, does not require rclone """
+
+    paths_json = [
+        {"Path": "a", "Name": "a", "Size": -1, "ModTime": "2017-11-02T10:23:41.123456789Z", "IsDir": True},
+        {"Path": "a/a1.txt", "Name": "a1.txt", "Size": 2, "ModTime": "2017-11-02T10:23:41.1Z", "IsDir": False,
+         "Hashes": {"md5": "c20ad4d76fe97759aa27a0c99bff6710"}},
+        {"Path": "a/b", "Name": "b", "Size": -1, "ModTime": "2017-11-02T10:23:41Z", "IsDir": True},
+        {"Path": "a/b/b1.txt", "Name": "b1.txt", "Size": 4, "ModTime": "2017-11-02T11:23:41.5+01:00", "IsDir": False},
+        {"Path": "a.txt", "Name": "a.txt", "Size": 0, "ModTime": "1969-12-31T23:59:59.999Z", "IsDir": False},
+        {"Path": "c/èè.txt", "Name": "èè.txt", "Size": 123456789012, "ModTime": "2017-11-02T10:23:41.569Z",
+         "IsDir": False, "Hashes": {"sha1": "7b52009b64fd0a2a49e6d8a939753077792b0554", "md5": "",
+                                    "quickxor": "abc"}},
+        {"Path": "c", "Name": "c", "Size": -1, "ModTime": "2017-11-02T10:23:41.000000001Z", "IsDir": True}
+    ]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="upback_snapshot")
+        self.snapshot_path = os.path.join(self.root, UPBACK_REMOTE_BACKUP)
+        self.paths = dict((path_json["Path"], PathElement.from_json(path_json, False))
+                          for path_json in self.paths_json)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_round_trip(self):
+        """ snapshots contain the elements they were written from """
+        for restart_interval in [1, 2, 16]:
+            write_snapshot(self.snapshot_path, self.paths.values(), restart_interval)
+            with SnapshotReader(self.snapshot_path) as snapshot:
+                self.assertEqual(len(snapshot), len(self.paths))
+                self.assertEqual(dict((path_element.path, path_element) for path_element in snapshot),
+                                 self.paths)
+                for path, path_element in self.paths.items():
+                    self.assertEqual(snapshot.get(path), path_element)
+                for path in ["", "0", "a/a", "a/b/b2.txt", "d"]:
+                    self.assertEqual(snapshot.get(path), None)
+                for path in ["a", "a/b", "c", "a.txt", "d"]:
+                    self.assertEqual(list(snapshot.subtree(path)),
+                                     [path_element for path_element in snapshot
+                                      if path_element.path.startswith(path+"/")])
+        write_snapshot(self.snapshot_path, [])
+        with SnapshotReader(self.snapshot_path) as snapshot:
+            self.assertEqual(list(snapshot), [])
+            self.assertEqual(snapshot.get("a"), None)
+
+    def test_json_migration(self):
+        """ remote backups written by previous versions are converted """
+        with open(self.snapshot_path, "w") as snapshot_fp:
+            json.dump(self.paths_json, snapshot_fp)
+        paths = retrieve_backup(self.root, "a")
+        self.assertTrue(is_snapshot(self.snapshot_path))
+        self.assertEqual(set(paths), {"a1.txt", "b", "b/b1.txt"})
+        self.assertEqual(paths["b/b1.txt"].time_stamp, self.paths["a/b/b1.txt"].time_stamp)
+        self.assertEqual(retrieve_backup(self.root, ""), self.paths)
+
+    def test_update(self):
+        """ updating a subtree leaves the rest of the backup untouched """
+        write_snapshot(self.snapshot_path, self.paths.values())
+        b1_element = retrieve_backup(self.root, "a/b")["b1.txt"]
+        update_backup(self.root, "a", {"b": self.paths["a/b"], "b/b1.txt": b1_element})
+        paths = retrieve_backup(self.root, "")
+        self.assertEqual(set(paths), set(self.paths)-{"a/a1.txt"})
+        self.assertEqual(paths["a/b/b1.txt"], self.paths["a/b/b1.txt"])
+        update_backup(self.root, "d/e", {"e1.txt": b1_element})
+        self.assertEqual(set(retrieve_backup(self.root, "d")), {"e", "e/e1.txt"})
+
+    def test_checksums(self):
+        """ the preferred checksum among the listed hashes is kept """
+        self.assertEqual(self.paths["a/a1.txt"].checksum, "md5:c20ad4d76fe97759aa27a0c99bff6710")
+        self.assertEqual(self.paths["c/èè.txt"].checksum, "sha1:7b52009b64fd0a2a49e6d8a939753077792b0554")
+        self.assertEqual(self.paths["a.txt"].checksum, None)
+        touched = PathElement("a/a1.txt", 0, 9, 2, False, True, self.paths["a/a1.txt"].checksum)
+        self.assertTrue(touched.is_effectively_equal_to(self.paths["a/a1.txt"]))
+        touched.checksum = "md5:0"
+        self.assertFalse(touched.is_effectively_equal_to(self.paths["a/a1.txt"]))
+        touched.checksum = None
+        self.assertFalse(touched.is_effectively_equal_to(self.paths["a/a1.txt"]))
+
+    def test_time_stamps(self):
+        """ timestamps are nanoseconds since the epoch, time zones are applied """
+        self.assertEqual((self.paths["a"].time_stamp, self.paths["a"].time_precision),
+                         (1509618221123456789, 9))
+        self.assertEqual((self.paths["a/b"].time_stamp, self.paths["a/b"].time_precision),
+                         (1509618221000000000, 0))
+        self.assertEqual(self.paths["a/b/b1.txt"].time_stamp, 1509618221500000000)
+        self.assertEqual(self.paths["a.txt"].time_stamp, -1000000)
+        self.assertEqual(parse_rfc3339("2017-11-02T08:53:41.5-0130"), (1509618221500000000, 1))
+        self.assertEqual(ns_precision(1509618221120000000), 2)
+
+class HashingTestCase(unittest.TestCase):
+    """ Local file hashing test case, does not require rclone """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="upback_hashing")
+        self.cache_path = os.path.join(self.root, UPBACK_HASH_CACHE)
+        os.mkdir(os.path.join(self.root, "d"))
+        self.contents = {}
+        for index in range(40):
+            path = "d/f%d.txt" % index
+            self.contents[path] = bytes("contents %d" % (index % 30), encoding="UTF-8")
+            with open(os.path.join(self.root, path), "wb") as file_fp:
+                file_fp.write(self.contents[path])
+            # older than the racy interval, so that checksums are cached
+            os.utime(os.path.join(self.root, path), (1500000000, 1500000000))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def listing(self):
+        """ Lists the files to hash """
+        return PathListing(LocalScanner().scan(self.root, "d").values())
+
+    def test_hash_files(self):
+        """ files are hashed once, then their checksums are cached """
+        paths = self.listing()
+        cache = HashCache(self.cache_path)
+        self.assertEqual(hash_files(self.root, paths, "md5", cache, 2), 40)
+        cache.save()
+        for path, contents in self.contents.items():
+            self.assertEqual(paths[path].checksum, "md5:"+hashlib.md5(contents).hexdigest())
+        self.assertEqual(checksum_type(paths), "md5")
+        paths = self.listing()
+        cache = HashCache(self.cache_path)
+        self.assertEqual(hash_files(self.root, paths, "md5", cache), 0)
+        cache.save()
+        os.rename(os.path.join(self.root, "d/f0.txt"), os.path.join(self.root, "d/g0.txt"))
+        with open(os.path.join(self.root, "d/f1.txt"), "ab") as file_fp:
+            file_fp.write(b"1")
+        os.utime(os.path.join(self.root, "d/f1.txt"), (1500000000, 1500000000))
+        paths = self.listing()
+        self.assertEqual(hash_files(self.root, paths, "md5", HashCache(self.cache_path)), 1)
+        self.assertEqual(paths["d/g0.txt"].checksum, "md5:"+hashlib.md5(self.contents["d/f0.txt"]).hexdigest())
+        self.assertEqual(paths["d/f1.txt"].checksum,
+                         "md5:"+hashlib.md5(self.contents["d/f1.txt"]+b"1").hexdigest())
+        paths = self.listing()
+        self.assertEqual(hash_files(self.root, paths, "crc32"), 40)
+        self.assertEqual(paths["d/f2.txt"].checksum, "crc32:%08x" % zlib.crc32(self.contents["d/f2.txt"]))
+
+    def test_checksum_diff(self):
+        """ touched files are not copied, changed files with the same time stamp are """
+        paths_b_backup = self.listing()
+        hash_files(self.root, paths_b_backup, "md5")
+        paths_a = self.listing()
+        paths_b = PathListing(paths_b_backup.values())
+        touched = paths_a["d/f0.txt"]
+        touched.time_stamp += 10**9
+        paths_a["d/f0.txt"] = touched
+        changed = paths_b["d/f1.txt"]
+        changed.checksum = "md5:0"
+        paths_b["d/f1.txt"] = changed
+        hash_files(self.root, paths_a, "md5")
+        self.assertEqual(paths_a["d/f0.txt"].checksum, None)
+        touched.checksum = paths_b_backup["d/f0.txt"].checksum
+        paths_a["d/f0.txt"] = touched
+        paths_all = set(paths_a) | set(paths_b)
+        for compute in [compute_operations, diff_operations]:
+            operations = compute(paths_all, paths_a, paths_b_backup, paths_b)
+            self.assertEqual(operations.copy_a_to_b, [])
+            self.assertEqual(operations.copy_b_to_a, [("d/f1.txt", True)])
+
+class JournalTestCase(unittest.TestCase):
+    """ Operation journal test case, does not require rclone
+        (the remote is local and the journal is resumed when
+        all its operations have been performed)
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="upback_journal")
+        self.local = os.path.join(self.root, "local")
+        self.remote = os.path.join(self.root, "remote")
+        self.journal_path = os.path.join(self.local, UPBACK_JOURNAL)
+        for path in ["local/a.txt", "remote/a.txt", "local/new.txt", "remote/new.txt", "remote/old.txt",
+                     "remote/d/d1.txt"]:
+            self.write(path)
+        for side in [self.local, self.remote]:
+            with open(os.path.join(side, UPBACK_CONF_FILE), "w") as conf_fp:
+                json.dump({"remote": self.remote, "no_backup": True}, conf_fp)
+            os.utime(os.path.join(side, UPBACK_CONF_FILE), (1500000000, 1500000000))
+        self.arguments = lambda: None
+        self.operations = Operations()
+        self.operations.add_copy_a_to_b("new.txt")
+        self.operations.add_delete_from_b("old.txt", True)
+        self.operations.add_delete_from_b("d")
+        self.operations.add_delete_from_b("d/d1.txt")
+        self.operations.add_copy_b_to_a("a.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, path):
+        """ Writes a file in the test directory """
+        os.makedirs(os.path.dirname(os.path.join(self.root, path)), exist_ok=True)
+        with open(os.path.join(self.root, path), "w") as file_fp:
+            file_fp.write(os.path.basename(path))
+        os.utime(os.path.join(self.root, path), (1500000000, 1500000000))
+
+    def create(self, checkpoint=None):
+        """ Creates the journal of the test operations """
+        paths_a = PathListing(LocalScanner().scan(self.local).values())
+        paths_b = PathListing(LocalScanner().scan(self.remote).values())
+        backup = PathListing(path_element for path_element in paths_b.values() if path_element.path != "a.txt")
+        journal = Journal(self.journal_path, checkpoint, 0)
+        journal.create("", self.remote, self.operations, paths_a, paths_b, backup)
+        return journal
+
+    def test_pending_operations(self):
+        """ completed operations (and contents of deleted directories) are not pending """
+        journal = self.create()
+        journal.record(OPERATION_DELETE_FROM_B, "d")
+        journal.record(OPERATION_COPY_A_TO_B, "new.txt")
+        journal.close()
+        with open(self.journal_path, "a") as journal_fp:
+            journal_fp.write("[4, \"old")
+        journal = Journal(self.journal_path)
+        self.assertTrue(journal.load())
+        self.assertEqual(journal.completed, [(OPERATION_DELETE_FROM_B, "d"), (OPERATION_COPY_A_TO_B, "new.txt")])
+        self.assertEqual(journal.operations.delete_from_b, [("old.txt", True), ("d", False), ("d/d1.txt", False)])
+        path_element = journal.remote_elements["d/d1.txt"]
+        self.assertEqual((path_element.time_stamp, path_element.size), (1500000000*10**9, 6))
+        pending = journal.pending_operations()
+        self.assertEqual((pending.copy_a_to_b, pending.delete_from_b, pending.copy_b_to_a),
+                         ([], [("old.txt", True)], [("a.txt", False)]))
+        self.assertEqual(journal.pending_paths(), {"old.txt", "a.txt"})
+        #the incomplete record is dropped, new records follow the last complete one
+        journal.record(OPERATION_COPY_B_TO_A, "a.txt")
+        journal.close()
+        journal = Journal(self.journal_path)
+        journal.load()
+        self.assertEqual(journal.completed[-1], (OPERATION_COPY_B_TO_A, "a.txt"))
+        journal.remove()
+        self.assertFalse(Journal(self.journal_path).load())
+        with open(self.journal_path, "w") as journal_fp:
+            journal_fp.write("{\"version\": 1, ")
+        self.assertFalse(Journal(self.journal_path).load())
+        self.assertFalse(os.path.exists(self.journal_path))
+
+    def test_checkpoint_concurrency(self):
+        """ operations are recorded while a checkpoint is saved, which includes only the ones synced before it """
+        checkpoints = []
+        def checkpoint(journal, completed):
+            #another worker records an operation meanwhile
+            worker = threading.Thread(target=journal.record, args=(OPERATION_COPY_A_TO_B, "new.txt"))
+            worker.start()
+            worker.join(10)
+            self.assertFalse(worker.is_alive())
+            checkpoints.append((completed, len(journal.completed), journal.pending_paths(completed)))
+        journal = self.create(checkpoint)
+        journal.checkpoint_interval = 3600
+        journal.record(OPERATION_DELETE_FROM_B, "d")
+        journal.save_checkpoint()
+        self.assertEqual(checkpoints, [(1, 2, {"new.txt", "old.txt", "a.txt"})])
+        journal.remove()
+
+    def test_resume(self):
+        """ checkpoints keep pending paths as they were, an interrupted synchronization is completed """
+        def run():
+            configuration = Configuration.bind(self.arguments)
+            configuration.working_directory = self.local
+            RClone.bind()
+            Profiler.bind()
+            configuration.read_file(os.path.join(self.local, UPBACK_CONF_FILE))
+            paths_b = PathListing(LocalScanner().scan(self.remote).values())
+            write_snapshot(os.path.join(self.local, UPBACK_REMOTE_BACKUP),
+                           [path_element for path_element in paths_b.values() if path_element.path != "a.txt"])
+            paths_a = PathListing(LocalScanner().scan(self.local).values())
+            journal = self.create(lambda journal, completed: checkpoint_backup(journal, completed, self.local,
+                                                                               paths_a, paths_b, self.remote))
+            #operations performed before the interruption
+            os.remove(os.path.join(self.remote, "d/d1.txt"))
+            os.rmdir(os.path.join(self.remote, "d"))
+            journal.record(OPERATION_DELETE_FROM_B, "d")
+            journal.close()
+            backup = retrieve_backup(self.local, "")
+            self.assertEqual(sorted(backup), [UPBACK_CONF_FILE, "new.txt", "old.txt"])
+            #the remaining ones
+            os.remove(os.path.join(self.remote, "old.txt"))
+            journal = Journal(self.journal_path)
+            journal.load()
+            journal.record(OPERATION_DELETE_FROM_B, "old.txt")
+            journal.record(OPERATION_COPY_A_TO_B, "new.txt")
+            journal.record(OPERATION_COPY_B_TO_A, "a.txt")
+            journal.close()
+            operations = synchronize(self.local, "")
+            self.assertTrue(operations.is_empty())
+            self.assertFalse(os.path.exists(self.journal_path))
+            self.assertEqual(sorted(retrieve_backup(self.local, "")), [UPBACK_CONF_FILE, "a.txt", "new.txt"])
+            return synchronize(self.local, "")
+        operations = contextvars.Context().run(run)
+        self.assertTrue(operations.is_empty(), str(operations))
+
+    def interrupt(self):
+        """ Binds a context whose rclone always fails, leaves the journal of
+            a synchronization interrupted before copying new.txt
+        """
+        script_path = os.path.join(self.root, "rclone")
+        with open(script_path, "w") as script_fp:
+            script_fp.write("#!"+sys.executable+"\nimport sys\nsys.stdout.write('not found')\nsys.exit(1)\n")
+        os.chmod(script_path, 0o755)
+        os.remove(os.path.join(self.remote, "new.txt"))
+        configuration = Configuration.bind(self.arguments)
+        configuration.working_directory = self.local
+        RClone.bind(self.root, "rclone")
+        Profiler.bind()
+        configuration.read_file(os.path.join(self.local, UPBACK_CONF_FILE))
+        paths_b = PathListing(LocalScanner().scan(self.remote).values())
+        write_snapshot(os.path.join(self.local, UPBACK_REMOTE_BACKUP),
+                       [path_element for path_element in paths_b.values() if path_element.path != "a.txt"])
+        journal = self.create()
+        #all the operations but the copy of new.txt were performed before the interruption
+        os.remove(os.path.join(self.remote, "d/d1.txt"))
+        os.rmdir(os.path.join(self.remote, "d"))
+        os.remove(os.path.join(self.remote, "old.txt"))
+        journal.record(OPERATION_DELETE_FROM_B, "d")
+        journal.record(OPERATION_DELETE_FROM_B, "old.txt")
+        journal.record(OPERATION_COPY_B_TO_A, "a.txt")
+        journal.close()
+
+    def test_failed_resume(self):
+        """ a resumed operation failing again drops the journal, the next run plans from fresh listings """
+        def run():
+            self.interrupt()
+            #the copy of new.txt fails again
+            with self.assertRaises(UpBackException):
+                synchronize(self.local, "")
+            self.assertFalse(os.path.exists(self.journal_path))
+            self.assertEqual(sorted(retrieve_backup(self.local, "")), [UPBACK_CONF_FILE, "a.txt"])
+            os.remove(os.path.join(self.local, "new.txt"))
+            return synchronize(self.local, "")
+        operations = contextvars.Context().run(run)
+        self.assertTrue(operations.is_empty(), str(operations))
+
+    def test_outdated_resume(self):
+        """ a journal whose pending paths changed is dropped, the branch is synchronized from fresh listings """
+        def run():
+            self.interrupt()
+            #new.txt is deleted before the synchronization is resumed
+            os.remove(os.path.join(self.local, "new.txt"))
+            operations = synchronize(self.local, "")
+            self.assertFalse(os.path.exists(self.journal_path))
+            self.assertEqual(sorted(retrieve_backup(self.local, "")), [UPBACK_CONF_FILE, "a.txt"])
+            return operations
+        operations = contextvars.Context().run(run)
+        self.assertTrue(operations.is_empty(), str(operations))
+
+class ChangeTokenTestCase(unittest.TestCase):
+    """ Change token test case, does not require rclone
+        (the remote is local and has nothing to transfer)
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="upback_token")
+        self.local = os.path.join(self.root, "local")
+        self.remote = os.path.join(self.root, "remote")
+        for side in [self.local, self.remote]:
+            os.makedirs(side)
+            with open(os.path.join(side, "a.txt"), "w") as file_fp:
+                file_fp.write("a")
+            with open(os.path.join(side, UPBACK_CONF_FILE), "w") as conf_fp:
+                json.dump({"remote": self.remote, "no_backup": True}, conf_fp)
+            for path in ["a.txt", UPBACK_CONF_FILE]:
+                os.utime(os.path.join(side, path), (1500000000, 1500000000))
+        write_snapshot(os.path.join(self.local, UPBACK_REMOTE_BACKUP), LocalScanner().scan(self.remote).values())
+        self.arguments = lambda: None
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def bind(self):
+        """ Binds the singletons for a run in the test branch """
+        configuration = Configuration.bind(self.arguments)
+        configuration.working_directory = self.local
+        configuration.read_file(os.path.join(self.local, UPBACK_CONF_FILE))
+        RClone.bind()
+        return Profiler.bind(True)
+
+    def test_remote_unchanged(self):
+        """ the remote is unchanged while it has the token of the branch and the backup did not change """
+        def run():
+            self.bind()
+            self.assertFalse(remote_unchanged(self.local, self.remote))
+            update_token(self.local, self.remote)
+            token = read_local_token(os.path.join(self.local, UPBACK_TOKEN))
+            self.assertEqual(read_local_token(os.path.join(self.remote, UPBACK_TOKEN)), token)
+            self.assertTrue(remote_unchanged(self.local, self.remote))
+            #another client synchronized
+            update_token(self.root, self.remote)
+            self.assertFalse(remote_unchanged(self.local, self.remote))
+            update_token(self.local, self.remote)
+            self.assertNotEqual(read_local_token(os.path.join(self.local, UPBACK_TOKEN))["sync_id"], token["sync_id"])
+            #the backup was updated without writing a token
+            update_backup(self.local, "", LocalScanner().scan(self.local))
+            self.assertFalse(remote_unchanged(self.local, self.remote))
+        contextvars.Context().run(run)
+
+    def test_synchronize(self):
+        """ the remote is not listed when nothing changed, unless a full synchronization is requested """
+        def run(full=False):
+            self.arguments.full = full
+            profiler = self.bind()
+            operations = synchronize(self.local, "")
+            self.assertTrue(operations.is_empty(), str(operations))
+            return "remote_listing" in profiler.phases
+        self.assertTrue(contextvars.Context().run(run))
+        self.assertFalse(contextvars.Context().run(run))
+        self.assertTrue(contextvars.Context().run(run, True))
+        os.remove(os.path.join(self.remote, UPBACK_TOKEN))
+        self.assertTrue(contextvars.Context().run(run))
+        self.assertFalse(contextvars.Context().run(run))
+
+    def test_watch(self):
+        """ watch synchronizations replace the token of the remote: other branches list it again """
+        script_path = os.path.join(self.root, "rclone")
+        with open(script_path, "w") as script_fp:
+            script_fp.write("#!"+sys.executable+"\nimport sys\nsys.exit(0)\n")
+        os.chmod(script_path, 0o755)
+        other = os.path.join(self.root, "other")
+        cwd = os.getcwd()
+        def run():
+            self.bind()
+            RClone.bind(self.root, "rclone")
+            synchronize(self.local, "")
+            #another branch of the same remote, synchronized along with the first one
+            shutil.copytree(self.local, other)
+            self.assertTrue(remote_unchanged(other, self.remote))
+            os.chdir(self.local)
+            watcher = BranchWatcher(self.local, "", debounce=0.1)
+            try:
+                watcher.synchronize_all()
+                with open(os.path.join(self.local, "b.txt"), "w") as file_fp:
+                    file_fp.write("b")
+                events = watcher.inotify.read_events(0.2)
+                while events:
+                    watcher.handle_events(events)
+                    events = watcher.inotify.read_events(0.2)
+                watcher.synchronize_changes()
+            finally:
+                watcher.close()
+                os.chdir(cwd)
+            self.assertFalse(remote_unchanged(other, self.remote))
+            self.assertTrue(remote_unchanged(self.local, self.remote))
+        contextvars.Context().run(run)
+
+class RunAllTestCase(unittest.TestCase):
+    """ Run-all mode test case, does not require rclone
+        (branches have local remotes and nothing to transfer)
+    """
+
+    branches = ["b1", "b2", "b3"]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="upback_run_all")
+        for branch in self.branches:
+            for side in ["local", "remote"]:
+                os.makedirs(os.path.join(self.root, side, branch, "d"))
+                with open(os.path.join(self.root, side, branch, "d", "f.txt"), "w") as file_fp:
+                    file_fp.write(branch)
+                os.utime(os.path.join(self.root, side, branch, "d", "f.txt"), (1500000000, 1500000000))
+            local = os.path.join(self.root, "local", branch)
+            remote = os.path.join(self.root, "remote", branch)
+            for conf_path in [os.path.join(local, UPBACK_CONF_FILE), os.path.join(remote, UPBACK_CONF_FILE)]:
+                with open(conf_path, "w") as conf_fp:
+                    json.dump({"remote": remote, "no_backup": True}, conf_fp)
+                os.utime(conf_path, (1500000000, 1500000000))
+            write_snapshot(os.path.join(local, UPBACK_REMOTE_BACKUP), LocalScanner().scan(remote).values())
+        self.manifest = os.path.join(self.root, "manifest")
+        with open(self.manifest, "w") as manifest_fp:
+            manifest_fp.write("# branches\n\n"+"\n".join("local/"+branch for branch in self.branches)+"\n")
+        self.arguments = lambda: None
+        self.arguments.run_all = True
+        self.arguments.manifest = self.manifest
+        self.arguments.branches = 2
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_read_manifest(self):
+        """ directories are relative to the manifest, comments are skipped """
+        self.assertEqual(read_manifest(self.manifest),
+                         [os.path.join(self.root, "local", branch) for branch in self.branches])
+
+    def test_sync_branch(self):
+        """ branches are synchronized in their own context, locks are per branch """
+        directory = os.path.join(self.root, "local", "b1", "d")
+        result = contextvars.Context().run(sync_branch, self.arguments, directory)
+        self.assertEqual((result.state(), result.operations_count()), ("ok", 0), result.message)
+        self.assertEqual(Configuration.context.get(), None)
+        self.assertFalse(os.path.exists(os.path.join(self.root, "local", "b1", UPBACK_CONF_FILE+".lock")))
+        lock = os.path.join(self.root, "local", "b2", UPBACK_CONF_FILE+".lock")
+        open(lock, "w").close()
+        result = contextvars.Context().run(sync_branch, self.arguments, os.path.join(self.root, "local", "b2"))
+        self.assertEqual(result.state(), "error")
+        self.assertIn("Another instance", result.message)
+        self.assertTrue(os.path.exists(lock))
+
+    def test_relative_remote(self):
+        """ relative local remotes are resolved from the branch directory, not from the process one """
+        local = os.path.join(self.root, "local", "b1")
+        for conf_path in [os.path.join(local, UPBACK_CONF_FILE),
+                          os.path.join(self.root, "remote", "b1", UPBACK_CONF_FILE)]:
+            with open(conf_path, "w") as conf_fp:
+                json.dump({"remote": os.path.join("..", "..", "remote", "b1"), "no_backup": True}, conf_fp)
+            os.utime(conf_path, (1500000000, 1500000000))
+        result = contextvars.Context().run(sync_branch, self.arguments, local)
+        self.assertEqual((result.state(), result.operations_count()), ("ok", 0), result.message)
+
+    def test_run_all(self):
+        """ all the branches are synchronized, a failed branch does not stop the others """
+        with open(self.manifest, "a") as manifest_fp:
+            manifest_fp.write("missing\n")
+        def run():
+            Configuration.bind(self.arguments)
+            RClone.bind()
+            profiler = Profiler.bind(True)
+            status = run_all(self.arguments)
+            return status, profiler.summary()
+        status, summary = contextvars.Context().run(run)
+        self.assertEqual(status, STATUS_ERROR)
+        self.assertEqual(summary["counts"]["branches"], 4)
+        self.assertEqual(summary["counts"]["synchronized paths"], 9)
+        self.assertEqual(summary["phases"]["local_listing"]["calls"], 3)
+        for branch in self.branches:
+            self.assertFalse(os.path.exists(os.path.join(self.root, "local", branch, UPBACK_CONF_FILE+".lock")))
+
+class ProfilerTestCase(unittest.TestCase):
+    """ Profiler test case """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="upback_profile")
+        self.profiler = Profiler()
+        self.profiler.setup(True)
+
+    def tearDown(self):
+        self.profiler.setup(False)
+        shutil.rmtree(self.root)
+
+    def test_phases(self):
+        """ phases are accumulated, counts set or added """
+        for _ in range(2):
+            with self.profiler.phase("listing"):
+                sum(range(10000))
+        with self.assertRaises(ValueError):
+            with self.profiler.phase("failing"):
+                raise ValueError()
+        self.profiler.count("paths", 3)
+        self.profiler.count("paths", 4)
+        self.profiler.add("copy_a_to_b", 2)
+        self.profiler.add("copy_a_to_b", 3)
+        profile_path = os.path.join(self.root, "profile.json")
+        self.profiler.write(profile_path)
+        with open(profile_path) as profile_fp:
+            summary = json.load(profile_fp)
+        self.assertEqual(list(summary["phases"]), ["listing", "failing"])
+        self.assertEqual(summary["phases"]["listing"]["calls"], 2)
+        self.assertEqual(summary["phases"]["failing"]["calls"], 1)
+        self.assertGreater(summary["phases"]["listing"]["wall_time"], 0)
+        self.assertEqual(summary["counts"], {"paths": 4, "copy_a_to_b": 5})
+        self.assertIn("listing", self.profiler.pretty_format())
+
+    def test_disabled(self):
+        """ a disabled profiler records nothing """
+        self.profiler.setup(False)
+        with self.profiler.phase("listing"):
+            self.profiler.count("paths", 3)
+        self.assertEqual(self.profiler.summary()["phases"], {})
+        self.assertEqual(self.profiler.summary()["counts"], {})
+
+class MetricsTestCase(unittest.TestCase):
+    """ Prometheus metrics test case """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="upback_metrics")
+        self.summary = {"wall_time": 2.5, "cpu_time": 1.25,
+                        "phases": {"local_listing": {"calls": 1, "wall_time": 0.5, "cpu_time": 0.25,
+                                                     "rclone_cpu_time": 0.0}},
+                        "counts": {"local paths": 10, "remote paths": 9, "copy_a_to_b": 1,
+                                   "conflicts": 2, "bytes copy_a_to_b": 4096}}
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_format(self):
+        """ samples of each metric follow its HELP and TYPE lines """
+        lines = format_metrics(self.summary, {"lsjson": 2, "copy": 1}, STATUS_ERROR, 1500000000).splitlines()
+        self.assertIn("upback_last_run_timestamp_seconds 1500000000", lines)
+        self.assertIn("upback_exit_status 1", lines)
+        self.assertIn("upback_run_duration_seconds 2.5", lines)
+        self.assertIn("upback_phase_duration_seconds{phase=\"local_listing\"} 0.5", lines)
+        self.assertIn("upback_paths{side=\"remote\"} 9", lines)
+        self.assertIn("upback_operations{type=\"copy_a_to_b\"} 1", lines)
+        self.assertIn("upback_operations{type=\"delete_from_b\"} 0", lines)
+        self.assertIn("upback_conflicts 2", lines)
+        self.assertIn("upback_transferred_bytes{direction=\"local_to_remote\"} 4096", lines)
+        self.assertIn("upback_rclone_invocations{command=\"lsjson\"} 2", lines)
+        for index, line in enumerate(lines):
+            if line.startswith("# HELP "):
+                name = line.split()[2]
+                self.assertEqual(lines[index+1].split()[:3], ["#", "TYPE", name])
+                self.assertTrue(lines[index+2].startswith(name))
+        self.assertNotIn("upback_rclone_invocations",
+                         format_metrics(self.summary, {}, STATUS_OK))
+
+    def test_write(self):
+        """ metrics are replaced, no temporary file is left """
+        metrics_path = os.path.join(self.root, "upback.prom")
+        write_metrics(metrics_path, self.summary, {}, STATUS_ERROR)
+        write_metrics(metrics_path, self.summary, {}, STATUS_OK)
+        self.assertEqual(os.listdir(self.root), ["upback.prom"])
+        with open(metrics_path) as metrics_fp:
+            self.assertIn("upback_exit_status 0\n", metrics_fp.read())
+
+class RCloneOutputTestCase(unittest.TestCase):
+    """ rclone output parsing test case, rclone is replaced by a script """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="upback_rclone")
+        self.rclone = RClone()
+        self.rclone_file = self.rclone.rclone_file
+        self.read_size = rclone_module.JSON_READ_SIZE
+
+    def tearDown(self):
+        self.rclone.stop_daemon()
+        self.rclone.rclone_file = self.rclone_file
+        rclone_module.JSON_READ_SIZE = self.read_size
+        shutil.rmtree(self.root)
+
+    def fake_rclone(self, output, status=0, error=""):
+        """ replaces rclone with a script writing output to stdout
+            and error to stderr, then exiting with status
+        """
+        script_path = os.path.join(self.root, "rclone")
+        with open(script_path, "w") as script_fp:
+            script_fp.write("#!"+sys.executable+"\nimport sys\n"
+                            "sys.stdout.write("+repr(output)+")\n"
+                            "sys.stderr.write("+repr(error)+")\n"
+                            "sys.exit("+str(status)+")\n")
+        os.chmod(script_path, 0o755)
+        self.rclone.rclone_file = script_path
+
+    def test_streaming_list(self):
+        """ listings are parsed whatever the size of the chunks read """
+        paths_json = [{"Path": "a%d/b \"[,]\"" % index, "Name": "b", "Size": index,
+                       "ModTime": "2017-11-02T10:23:41.%dZ" % index, "IsDir": False}
+                      for index in range(100)]
+        self.fake_rclone(json.dumps(paths_json, indent=1)+"\n", error="NOTICE: not json\n")
+        for read_size in [1, 7, 65536]:
+            rclone_module.JSON_READ_SIZE = read_size
+            self.assertEqual(list(self.rclone.lsjson_entries("remote:")), paths_json)
+        self.fake_rclone("[\n]\n")
+        self.assertEqual(list(self.rclone.lsjson_entries("remote:")), [])
+
+    def test_listing(self):
+        """ listing gives the same elements as parsing the lsjson output """
+        precisions = ["", ".1", ".12", ".123", ".1234567", ".123456789", ".5", ".000000001"]
+        paths_json = [{"Path": "a%d" % index, "Name": "a%d" % index, "Size": index,
+                       "ModTime": "2017-11-02T10:23:41"+precision+"Z", "IsDir": index == 3}
+                      for index, precision in enumerate(precisions)]
+        self.fake_rclone(json.dumps(paths_json))
+        expected = [PathElement.from_json(path_json, False) for path_json in paths_json]
+        self.assertEqual(set(path_element.time_precision for path_element in expected), {0, 1, 2, 3, 7, 9})
+        #timestamps get the highest precision found
+        for path_element in expected:
+            path_element.time_precision = 9
+        self.assertEqual(self.rclone.listing("remote:"), expected)
+
+    def test_errors(self):
+        """ rclone failures and invalid outputs are reported """
+        self.fake_rclone("[\n", 3, "directory not found")
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            list(self.rclone.lsjson_entries("remote:"))
+        self.assertEqual(context.exception.output, "directory not found")
+        self.fake_rclone("[{\"Path\": \"a\"},\n{\"Path\": ")
+        with self.assertRaises(ValueError):
+            list(self.rclone.lsjson_entries("remote:"))
+
+    def test_bound_instance(self):
+        """ instances bound to a context run rclone in their working directory """
+        script_path = os.path.join(self.root, "rclone")
+        with open(script_path, "w") as script_fp:
+            script_fp.write("#!"+sys.executable+"\nimport os, json\n"
+                            "print(json.dumps([{'Path': os.getcwd()}]))\n")
+        os.chmod(script_path, 0o755)
+        def run():
+            rclone = RClone.bind(self.root, "rclone", self.root, threading.BoundedSemaphore(1))
+            self.assertIs(RClone(), rclone)
+            self.assertEqual(rclone.rc_fs("a/b"), os.path.join(self.root, "a/b"))
+            self.assertEqual(rclone.rc_fs("remote:a"), "remote:a")
+            self.assertEqual(rclone.rc_fs("/a"), "/a")
+            return list(rclone.lsjson_entries("remote:"))
+        self.assertEqual(contextvars.Context().run(run), [{"Path": os.path.realpath(self.root)}])
+        self.assertIs(RClone(), self.rclone)
+        self.assertEqual(self.rclone.rc_fs("a/b"), "a/b")
+
+    def fake_rcd(self, entries):
+        """ replaces rclone with a script serving the remote control API:
+            calls are logged, operations/list returns entries and
+            operations on paths containing "fail" fail
+        """
+        script_path = os.path.join(self.root, "rclone")
+        log_path = os.path.join(self.root, "calls.log")
+        with open(script_path, "w") as script_fp:
+            script_fp.write("#!"+sys.executable+"\n"
+                            "import os, sys, json, base64, http.server\n"
+                            "credentials = os.environ['RCLONE_RC_USER']+':'+os.environ['RCLONE_RC_PASS']\n"
+                            "class Handler(http.server.BaseHTTPRequestHandler):\n"
+                            "    protocol_version = 'HTTP/1.1'\n"
+                            "    def do_POST(self):\n"
+                            "        params = json.loads(self.rfile.read(int(self.headers['Content-Length'])))\n"
+                            "        status, output = 200, {}\n"
+                            "        if self.headers['Authorization'] != 'Basic '+base64.b64encode(credentials.encode()).decode():\n"
+                            "            status, output = 401, {'error': 'unauthorized'}\n"
+                            "        elif 'fail' in json.dumps(params):\n"
+                            "            status, output = 500, {'error': 'failed '+self.path}\n"
+                            "        elif self.path == '/operations/list':\n"
+                            "            output = {'list': "+repr(entries)+"}\n"
+                            "        with open("+repr(log_path)+", 'a') as log_fp:\n"
+                            "            log_fp.write(json.dumps([self.path, params])+'\\n')\n"
+                            "        body = json.dumps(output).encode()\n"
+                            "        self.send_response(status)\n"
+                            "        self.send_header('Content-Length', str(len(body)))\n"
+                            "        self.end_headers()\n"
+                            "        self.wfile.write(body)\n"
+                            "    def log_message(self, *args):\n"
+                            "        pass\n"
+                            "host, port = sys.argv[sys.argv.index('--rc-addr')+1].split(':')\n"
+                            "http.server.HTTPServer((host, int(port)), Handler).serve_forever()\n")
+        os.chmod(script_path, 0o755)
+        self.rclone.rclone_file = script_path
+        return log_path
+
+    def test_daemon(self):
+        """ with rclone rcd operations are remote control calls """
+        paths_json = [{"Path": "a", "Name": "a", "Size": -1, "ModTime": "2017-11-02T10:23:41.1Z", "IsDir": True},
+                      {"Path": "a/b", "Name": "b", "Size": 3, "ModTime": "2017-11-02T10:23:41.2Z", "IsDir": False}]
+        log_path = self.fake_rcd(paths_json)
+        self.rclone.invocations.clear()
+        self.rclone.start_daemon()
+        self.assertEqual(self.rclone.listing("remote:dir"),
+                         [PathElement.from_json(path_json, False) for path_json in paths_json])
+        self.rclone.copy("a/b", "remote:dir/a/b", remote_backup="remote:old", remote_suffix=".1")
+        self.rclone.mkdir("remote:dir")
+        self.rclone.purge("remote:dir/a", no_backup=True, remote_backup="remote:old")
+        self.assertEqual(self.rclone.copy_files("remote:dir", ".", ["a/b", "a/fail"]),
+                         {"a/fail": "failed /operations/copyfile"})
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.rclone.delete("remote:fail")
+        with open(log_path) as log_fp:
+            calls = [json.loads(line) for line in log_fp]
+        self.assertEqual([path for path, _ in calls],
+                         ["/rc/noop", "/operations/list", "/operations/copyfile", "/operations/mkdir",
+                          "/operations/purge", "/operations/copyfile", "/operations/copyfile",
+                          "/operations/deletefile"])
+        self.assertEqual(calls[2][1], {"srcFs": "a", "srcRemote": "b", "dstFs": "remote:dir/a", "dstRemote": "b",
+                                       "_config": {"BackupDir": "remote:old", "Suffix": ".1"}})
+        self.assertEqual(calls[3][1], {"fs": "remote:", "remote": "dir", "_config": {}})
+        self.assertEqual(calls[4][1], {"fs": "remote:dir", "remote": "a", "_config": {}})
+        self.assertEqual(calls[7][1], {"fs": "remote:", "remote": "fail", "_config": {}})
+        self.assertEqual(self.rclone.invocations, {"rcd": 1, "operations/list": 1, "operations/copyfile": 3,
+                                                   "operations/mkdir": 1, "operations/purge": 1,
+                                                   "operations/deletefile": 1})
+        self.rclone.stop_daemon()
+        self.assertEqual(self.rclone.daemon, None)
+
 # thanks Python for this awesome class attribute initialization!
 UpbackTestCase.remote = None
 UpbackTestCase.subdir = None
@@ -775,6 +2212,13 @@ if __name__ == '__main__':
     suite = loader.loadTestsFromTestCase(UpbackTestCase)
     UpbackTestCase.setUpSubdir("c/local2")
     unittest.TextTestRunner(verbosity=2).run(suite)
+    for unit_test_case in [CompactDeletesTestCase, DetectMovesTestCase, GlobalExcludesTestCase, LocalScannerTestCase,
+                           LocalExcludesTestCase, LocalStateTestCase, BranchWatcherTestCase, PathListingTestCase,
+                           DiffTestCase, SnapshotTestCase, HashingTestCase, JournalTestCase, ChangeTokenTestCase,
+                           RunAllTestCase, ProfilerTestCase, MetricsTestCase, RCloneOutputTestCase,
+                           OperationsExecutorTestCase, BatchOperationsTestCase]:
+        suite = loader.loadTestsFromTestCase(unit_test_case)
+        unittest.TextTestRunner(verbosity=2).run(suite)
 # uncomment this to perform the tests on a "real" remote branch
 #    UpbackTestCase.setUpRemoteRoot("gdrive:Back")
 #    UpbackTestCase.setUpSubdir(None)
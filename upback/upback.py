@@ -9,49 +9,68 @@ import os
 import json
 import logging
 import collections
-import fnmatch
+import bisect
 
 from .rclone import RClone
 from .configuration import Configuration
 from .path_element import PathElement
-from .operations import Operations
-from .util import lock_file, remove_lock_file, is_path_local, wildcard_match
+from .path_listing import PathListing
+from .operations import Operations, ExecutionResult, detect_moves
+from .diff import diff_operations
+from .scanner import LocalScanner
+from .excludes import GlobalExcludes, LocalExcludes, read_exclude_file
+from .local_state import LocalState
+from .snapshot import open_snapshot, write_snapshot
+from .profiling import Profiler
+from .hashing import HashCache, hash_files, checksum_type
+from .executor import OperationsExecutor, BatchOperationsExecutor
+from .journal import Journal
+from .change_token import remote_unchanged, invalidate_token, update_token
+from .util import lock_file, remove_lock_file, is_path_local, wildcard_match, rebase, path_sort_key, \
+    format_ns
 from .const import * # pylint: disable=unused-wildcard-import
 
 class UpBackException(Exception):
     """ Application exception """
     pass
 
-def rclone_ls(path):
+def rclone_ls(path, local_excludes=None, local_state=None, files=None):
     """ Returns a dictionary of paths
         as retrieved by rclone lsjson
         Pathnames are the keys of the dictionary,
-        each entry is another dictionary with
-        path details
+        each entry is a PathElement (the dictionary
+        is a PathListing, to keep large listings small).
+        Local paths are listed in-process by LocalScanner,
+        if local_excludes is given excluded paths are skipped,
+        if local_state is given unchanged directories are not listed.
+        If files is given only those files are listed
     """
     is_local = is_path_local(path)
     rclone = RClone()
-    output = rclone.lsjson(path)
-    paths_list = json.loads(output)
-    paths = {}
-    for path in paths_list:
-        path_entry = PathElement.from_json(path)
-        path_entry.is_local = is_local
-        paths[path_entry.path] = path_entry
-    return paths
-
-#TODO use some kind of caching
+    if is_local:
+        scanner = LocalScanner(Configuration().scan_threads, rclone.harmonize_timestamp_precision,
+                               local_excludes, local_state)
+        try:
+            if files is not None:
+                paths = PathListing()
+                for file_path in files:
+                    path_entry = scanner.scan_path(path, file_path)
+                    if path_entry is not None:
+                        paths[file_path] = path_entry
+                return paths
+            return PathListing(scanner.scan(path).values())
+        except OSError as error:
+            raise UpBackException("Cannot list "+path+": "+str(error))
+    return PathListing(rclone.listing(path, files, Configuration().checksum))
+
 def exclude(directory_path):
     """ Returns a list of paths included in an
         upback exclude file.
+        LocalExcludes provides compiled and cached
+        access to exclude files
     """
-    lines = []
     #TODO was lines = [UPBACK_EXCLUDE_FILE, UPBACK_CONF_FILE]
-    exclude_path = os.path.join(directory_path, UPBACK_EXCLUDE_FILE)
-    if os.path.exists(exclude_path):
-        with open(exclude_path, "r") as exclude_fp:
-            lines += exclude_fp.read().splitlines()
-    return lines
+    return read_exclude_file(directory_path)
 
 def exclude_filter(directory_path, path, exclude_cache=None, basename=None):
     """ Starting from directory_path evaluates all
@@ -82,14 +101,17 @@ def exclude_filter(directory_path, path, exclude_cache=None, basename=None):
             return True
     return exclude_filter(directory_path, head, exclude_cache, basename)
 
-def filter_exclude_paths(base_path, paths):
-    """ Apply exclude_filter to a set of paths relative
+def filter_exclude_paths(base_path, paths, local_excludes=None):
+    """ Apply local excludes to a set of paths relative
         to a base_path
     """
+    if not is_path_local(base_path):
+        return paths
+    if local_excludes is None:
+        local_excludes = LocalExcludes()
     retval = {}
-    exclude_cache = {}
     for path in paths.keys():
-        if not exclude_filter(base_path, path, exclude_cache):
+        if not local_excludes.is_excluded(base_path, path):
             retval[path] = paths[path]
     return retval
 
@@ -138,6 +160,9 @@ def compute_operations(paths_all, paths_a, paths_b_backup, paths_b):
             - delete_from_a
             - delete_from_b
             - conflict
+        This is the reference implementation of the
+        decision table, diff_operations is used instead
+        since it is much faster on large listings
     """
     operations = Operations()
     for path in paths_all:
@@ -220,6 +245,46 @@ def compute_operations(paths_all, paths_a, paths_b_backup, paths_b):
             raise UpBackException("Unsupported synchronization case")
     return operations
 
+def refresh_local_paths(operations, paths_a):
+    """ Checks the local paths that operations would overwrite or delete
+        (including the contents of deleted directories) against the
+        local filesystem, updating paths_a with the actual elements.
+        Used when the local listing trusts directory modification
+        times and could miss files modified in place.
+        Returns True if some path changed.
+    """
+    paths_to_check = []
+    sorted_keys = None
+    for path, _ in operations.copy_b_to_a + operations.delete_from_a:
+        if not path in paths_a:
+            continue
+        paths_to_check.append(path)
+        if paths_a[path].is_directory:
+            if sorted_keys is None:
+                sorted_keys = sorted(path_sort_key(local_path) for local_path in paths_a)
+            prefix = path_sort_key(path+"/")
+            index = bisect.bisect_left(sorted_keys, prefix)
+            while index < len(sorted_keys) and sorted_keys[index].startswith(prefix):
+                paths_to_check.append(sorted_keys[index].replace("\0", "/"))
+                index += 1
+    scanner = LocalScanner(harmonize_timestamp_precision=RClone().harmonize_timestamp_precision)
+    changed = False
+    for path in paths_to_check:
+        previous_element = paths_a.get(path)
+        if previous_element is None:
+            continue
+        current_element = scanner.scan_path(Configuration().working_directory, path)
+        if current_element is not None:
+            current_element.time_precision = previous_element.time_precision
+        if current_element is None or not previous_element.is_effectively_equal_to(current_element):
+            logging.info("Local path changed since listing: "+path)
+            changed = True
+            if current_element is None:
+                del paths_a[path]
+            else:
+                paths_a[path] = current_element
+    return changed
+
 def cleanup():
     """ Performs cleanup before program termination
     """
@@ -229,93 +294,186 @@ def save_backup(backup_path, remote):
     """ Saves a backup by storing the result of rclone lsjson into the backup file
     """
     try:
-        rclone = RClone()
-        output = rclone.lsjson(remote)
-        json.loads(output) #raises ValueError if not json
-        with open(os.path.join(backup_path, UPBACK_REMOTE_BACKUP), "w") as backup_fp:
-            backup_fp.write(output)
+        paths = rclone_ls(remote)
     except ValueError:
-        print(output)
         raise UpBackException("Invalid backup file format")
+    write_snapshot(os.path.join(backup_path, UPBACK_REMOTE_BACKUP), paths.values())
 
 def retrieve_backup(backup_path, rel_path):
     """ Retrieves the backup for remote
         filtering out upper paths.
     """
     try:
-        with open(os.path.join(backup_path, UPBACK_REMOTE_BACKUP), "r") as backup_fp:
-            paths_json = json.load(backup_fp)
-            paths = {}
-            for path in paths_json:
-                path_entry = PathElement.from_json(path)
-                prefix = rel_path
-                if prefix != "":
-                    prefix += "/"
-                if path_entry.path != prefix and path_entry.path.startswith(prefix):
-                    new_path = path_entry.path[len(prefix):]
-                    path_entry.path = new_path
-                    paths[path_entry.path] = path_entry
-            return paths
+        snapshot = open_snapshot(os.path.join(backup_path, UPBACK_REMOTE_BACKUP))
     except IOError:
         return None
+    except ValueError:
+        raise UpBackException("Invalid backup file format")
+    with snapshot:
+        paths = PathListing()
+        prefix = rel_path
+        if prefix != "":
+            prefix += "/"
+        #only the entries below rel_path are read
+        for path_entry in snapshot.subtree(rel_path):
+            path_entry.path = path_entry.path[len(prefix):]
+            paths[path_entry.path] = path_entry
+        return paths
+
+def update_backup(backup_path, rel_path, paths):
+    """ Replaces the entries below rel_path in the backup file
+        with paths (relative to rel_path), leaving the others untouched
+    """
+    prefix = rel_path+"/" if rel_path != "" else ""
+    backup_file = os.path.join(backup_path, UPBACK_REMOTE_BACKUP)
+    try:
+        snapshot = open_snapshot(backup_file)
+    except IOError:
+        raise UpBackException("No remote backup file found. Run with an init option")
+    except ValueError:
+        raise UpBackException("Invalid backup file format")
+    with snapshot:
+        path_elements = [path_element for path_element in snapshot
+                         if path_element.path == rel_path or not path_element.path.startswith(prefix)]
+    #rel_path and its parents must be in the backup for retrieve_backup to find its contents
+    missing_directories = set()
+    directory = rel_path
+    while directory != "":
+        missing_directories.add(directory)
+        directory = directory.rpartition("/")[0]
+    for path_element in path_elements:
+        missing_directories.discard(path_element.path)
+    for directory in missing_directories:
+        path_elements.append(PathElement(directory, 0, 0, -1, True, False))
+    for path, path_element in paths.items():
+        path_elements.append(PathElement(prefix+path, path_element.time_stamp,
+                                         path_element.time_precision, path_element.size,
+                                         path_element.is_directory, False, path_element.checksum))
+    write_snapshot(backup_file, path_elements)
+
+def apply_operations(paths_b, paths_a, result, remote_path):
+    """ Updates paths_b (the listing of remote_path) with the
+        operations completed in result: copied (or moved) elements are
+        added (files with the metadata they got on the remote, listed
+        again with a single rclone invocation), deleted (or moved)
+        ones are removed
+    """
+    copied_files = []
+    deleted_directories = []
+    for (operation, path) in result.completed:
+        if operation == OPERATION_COPY_A_TO_B:
+            path_element = paths_a[path]
+            if path_element.is_directory:
+                paths_b[path] = PathElement(path, path_element.time_stamp, path_element.time_precision,
+                                            path_element.size, True, False)
+            else:
+                copied_files.append(path)
+        elif operation == OPERATION_MOVE_IN_B:
+            paths_b.pop(result.sources[path], None)
+            copied_files.append(path)
+        elif operation == OPERATION_DELETE_FROM_B:
+            path_element = paths_b.pop(path, None)
+            if path_element is not None and path_element.is_directory:
+                deleted_directories.append(path+"/")
+    if deleted_directories:
+        prefixes = tuple(deleted_directories)
+        for path in [path for path in paths_b if path.startswith(prefixes)]:
+            del paths_b[path]
+    if copied_files:
+        copied_paths = rclone_ls(remote_path, files=copied_files)
+        for path in copied_files:
+            if path in copied_paths:
+                paths_b[path] = copied_paths[path]
+            else:
+                logging.warning("Copied file not found in remote: "+path)
+
+def store_backup(backup_path, rel_path, paths_b):
+    """ Updates the remote backup at the end of a synchronization
+        with paths_b (the remote listing, updated with the operations
+        performed) or listing the remote again if verify_snapshot is set
+    """
+    configuration = Configuration()
+    if configuration.verify_snapshot:
+        save_backup(backup_path, configuration.remote)
+    else:
+        update_backup(backup_path, rel_path, paths_b)
+
+def apply_journal(journal, paths_a, paths_b, remote_path, completed=None):
+    """ Updates paths_b (see apply_operations) with the operations
+        recorded in journal since the last call (up to the completed-th
+        one, if given)
+    """
+    result = ExecutionResult()
+    with journal.lock:
+        if completed is None:
+            completed = len(journal.completed)
+        result.completed = journal.completed[journal.applied:completed]
+        journal.applied = completed
+    result.sources = journal.sources()
+    apply_operations(paths_b, paths_a, result, remote_path)
+
+def checkpoint_backup(journal, completed, backup_path, paths_a, paths_b, remote_path):
+    """ Saves in the backup the state reached by the synchronization
+        recorded in journal after its first completed operations: paths_b
+        updated with them, while the paths of the pending ones are left
+        as they were in the backup, so that they are found changed again
+        if the journal is lost. Other operations may be recorded meanwhile
+    """
+    apply_journal(journal, paths_a, paths_b, remote_path, completed)
+    paths = PathListing(paths_b.values())
+    for path in journal.pending_paths(completed):
+        path_element = journal.backup_elements.get(path)
+        if path_element is not None:
+            paths[path] = path_element
+        elif path in paths:
+            del paths[path]
+    update_backup(backup_path, journal.rel_path, paths)
 
-def compact_deletes(delete_ops, path_elements):
-    """ Compacts delete operations so that if a directory is to be deleted
-        deletion of contained elements is ignored
+def count_transferred_bytes(result, paths_a, paths_b):
+    """ Adds the size of the files copied in result to the profile """
+    bytes_a_to_b = 0
+    bytes_b_to_a = 0
+    for (operation, path) in result.completed:
+        if operation == OPERATION_COPY_A_TO_B and not paths_a[path].is_directory:
+            bytes_a_to_b += paths_a[path].size
+        elif operation == OPERATION_COPY_B_TO_A and not paths_b[path].is_directory:
+            bytes_b_to_a += paths_b[path].size
+    profiler = Profiler()
+    profiler.add("bytes copy_a_to_b", bytes_a_to_b)
+    profiler.add("bytes copy_b_to_a", bytes_b_to_a)
+
+def create_executor(remote, rel_path, no_backup, remote_backup=None, backup_suffix=None):
+    """ Returns the operations executor selected by the configuration
     """
-    dir_elements = []
-    for del_op in delete_ops:
-        path, _ = del_op
-        path_element = path_elements[path]
-        if path_element.is_directory:
-            dir_elements.append(path_element)
-    paths_to_ignore = []
-    for del_op in delete_ops:
-        path, _ = del_op
-        path_element = path_elements[path]
-        for dir_element in dir_elements:
-            if dir_element.contains(path_element):
-                paths_to_ignore.append(path)
-    compacted_ops = []
-    for del_op in delete_ops:
-        path, _ = del_op
-        if not path in paths_to_ignore:
-            compacted_ops.append(del_op)
-    return compacted_ops
-
-def perform_operations(operations, paths_a, paths_b, remote, rel_path, no_backup, remote_backup=None, backup_suffix=None):
+    configuration = Configuration()
+    if configuration.batch_size > 1:
+        return BatchOperationsExecutor(remote, rel_path, no_backup, remote_backup, backup_suffix,
+                                       configuration.jobs, configuration.batch_size)
+    return OperationsExecutor(remote, rel_path, no_backup, remote_backup, backup_suffix,
+                              configuration.jobs)
+
+def perform_operations(operations, paths_a, paths_b, remote, rel_path, no_backup, remote_backup=None, backup_suffix=None,
+                       journal=None):
     """ Performs the operations as computed
+        Returns an ExecutionResult, raises UpBackException
+        if some operation failed.
+        Completed operations are recorded in journal, if given,
+        and a checkpoint is saved if some operation fails or
+        the execution is interrupted
     """
-    rclone = RClone()
-    for copy_op in operations.copy_a_to_b:
-        path, backup = copy_op
-        remote_path = rebase(rebase(path, rel_path), remote)
-        if paths_a[path].is_directory:
-            rclone.mkdir(remote_path)
-        else:
-            rclone.copy(path, remote_path, backup and not no_backup, remote_backup, backup_suffix)
-    for copy_op in operations.copy_b_to_a:
-        path, backup = copy_op
-        remote_path = rebase(rebase(path, rel_path), remote)
-        if paths_b[path].is_directory:
-            rclone.mkdir(path)
-        else:
-            rclone.copy(remote_path, path)
-    deletes = compact_deletes(operations.delete_from_a, paths_a)
-    for del_op in deletes:
-        path, _ = del_op
-        if paths_a[path].is_directory:
-            rclone.purge(path)
-        else:
-            rclone.delete(path)
-    deletes = compact_deletes(operations.delete_from_b, paths_b)
-    for del_op in deletes:
-        path, backup = del_op
-        remote_path = rebase(rebase(path, rel_path), remote)
-        if paths_b[path].is_directory:
-            rclone.purge(remote_path, backup and not no_backup, remote_backup, backup_suffix)
-        else:
-            rclone.delete(remote_path, backup and not no_backup, remote_backup, backup_suffix)
+    executor = create_executor(remote, rel_path, no_backup, remote_backup, backup_suffix)
+    try:
+        result = executor.execute(operations, paths_a, paths_b, journal)
+    except BaseException:
+        if journal is not None:
+            journal.save_checkpoint()
+        raise
+    if not result.is_successful():
+        if journal is not None:
+            journal.save_checkpoint()
+        raise UpBackException(str(len(result.failed))+" operations failed:\n"+
+                              result.pretty_format_failures())
+    return result
 
 def merge_and_exclude_paths(paths_a, paths_b, rel_path, local_excludes, global_excludes):
     """ Returns a set with the union of all the paths contained
@@ -332,21 +490,8 @@ def merge_and_exclude_paths(paths_a, paths_b, rel_path, local_excludes, global_e
             path_to_exclude = path_to_exclude[2:]
         if path_to_exclude in paths_all:
             paths_all.remove(path_to_exclude)
-    for global_path_to_exclude in global_excludes + [UPBACK_CONF_FILE+".lock", UPBACK_REMOTE_BACKUP]:
-        if "/" in global_path_to_exclude and rel_path is not None and rel_path != "" and rel_path != ".":
-            path_to_exclude = os.path.relpath(global_path_to_exclude, rel_path)
-        else:
-            path_to_exclude = global_path_to_exclude
-        to_exclude = set()
-        for path in paths_all:
-            if "/" in path_to_exclude:
-                if fnmatch.fnmatch(path, path_to_exclude):
-                    to_exclude.add(path)
-            else:
-                if fnmatch.fnmatch(os.path.basename(path), path_to_exclude):
-                    to_exclude.add(path)
-        if to_exclude:
-            paths_all = paths_all - to_exclude
+    excludes = GlobalExcludes(global_excludes + UPBACK_INTERNAL_FILES, rel_path)
+    paths_all = excludes.filter(paths_all)
     return paths_all
 
 def write_conflicts(conflicts, paths_a, paths_b):
@@ -354,7 +499,7 @@ def write_conflicts(conflicts, paths_a, paths_b):
         The user can edit the file and resume sync with --resume
     """
     conflicts_json = []
-    with open(UPBACK_CONFLICTS_FILE, "w") as conflicts_fp:
+    with open(os.path.join(Configuration().working_directory, UPBACK_CONFLICTS_FILE), "w") as conflicts_fp:
         for conflict in conflicts:
             (conflict_path, conflict_explaination) = conflict
             path_element_a = PathElement("", None, -1) if not conflict_path in paths_a else paths_a[conflict_path]
@@ -362,9 +507,9 @@ def write_conflicts(conflicts, paths_a, paths_b):
             entries = collections.OrderedDict([
                 ("path", conflict_path),
                 ("local_size", path_element_a.size),
-                ("local_datetime", str(path_element_a.time_stamp)),
+                ("local_datetime", format_ns(path_element_a.time_stamp)),
                 ("remote_size", path_element_b.size),
-                ("remote_datetime", str(path_element_b.time_stamp)),
+                ("remote_datetime", format_ns(path_element_b.time_stamp)),
                 ("resolution", "LRIX"),
                 ("legenda", "L: local overwrites remote; R: remote overwrites local; "
                             "X: both local and remote are deleted; "
@@ -398,8 +543,11 @@ def init_push():
         args += ["--backup-dir", configuration.remote_backup,
                  "--suffix", configuration.backup_suffix]
     rclone = RClone()
-    rclone.run(args)
-    save_backup(".", configuration.remote)
+    profiler = Profiler()
+    with profiler.phase("perform_operations"):
+        rclone.run(args)
+    with profiler.phase("save_backup"):
+        save_backup(".", configuration.remote)
 
 def init_pull():
     """ Initialize an UpBack branch by synchronizing
@@ -421,19 +569,11 @@ def init_pull():
     #sync remote -> local
     args = ["sync", "--create-empty-src-dirs", configuration.remote, "."]
     rclone = RClone()
-    rclone.run(args)
-    save_backup(".", configuration.remote)
-
-def rebase(path_to_rebase, base):
-    """ Rebase the parameter (a list or a single string)
-    """
-    if base is None or base == "" or base == ".":
-        return path_to_rebase
-    path_list = path_to_rebase if isinstance(path_to_rebase, list) else [path_to_rebase]
-    rebased_paths = []
-    for path in path_list:
-        rebased_paths.append(os.path.join(base, path))
-    return rebased_paths if isinstance(path_to_rebase, list) else rebased_paths[0]
+    profiler = Profiler()
+    with profiler.phase("perform_operations"):
+        rclone.run(args)
+    with profiler.phase("save_backup"):
+        save_backup(".", configuration.remote)
 
 def fix_conflicts(remote, local, remote_rel_path, remote_backup=None, backup_suffix=None):
     """ Fixes conflicts as per the conflicts file
@@ -469,53 +609,255 @@ def fix_conflicts(remote, local, remote_rel_path, remote_backup=None, backup_suf
     except IOError:
         raise UpBackException("Conflicts file not found or unreadable.")
 
-def upback():
-    """ Program entry point
+def open_branch():
+    """ Looks for the branch the working directory belongs to,
+        locks it and reads its configuration.
+        Returns (backup_config_path, rel_path) where rel_path is
+        the path from the branch root to the working directory
     """
-    try:
-        configuration = Configuration()
-        #initialize the RClone singleton
-        RClone(configuration.rclone_path, configuration.rclone_executable)
-        if configuration.init_pull:
-            init_pull()
-            return
-        if configuration.init_push:
-            init_push()
+    configuration = Configuration()
+    #look for conf file
+    with Profiler().phase("find_backup_branch"):
+        backup_config = find_backup_branch(configuration.working_directory)
+    if backup_config is None:
+        raise UpBackException("The current directory does not belong to an UpBack backup")
+    backup_config_path = os.path.dirname(backup_config)
+    #lock conf file
+    if not lock_file(backup_config+".lock"):
+        raise UpBackException("Another instance of UpBack is running on this filesystem branch")
+    #read conf file
+    configuration.read_file(backup_config)
+    #path from conf file dir to .
+    rel_path = os.path.relpath(os.path.realpath(configuration.working_directory), backup_config_path)
+    if rel_path == ".":
+        rel_path = ""
+    return (backup_config_path, rel_path)
+
+def list_local(backup_config_path, local_excludes=None):
+    """ Lists . processing local excludes (excluded directories are not scanned)
+        using the exclude cache and the local index of the branch
+    """
+    configuration = Configuration()
+    if local_excludes is None:
+        local_excludes = LocalExcludes(os.path.join(backup_config_path, UPBACK_EXCLUDE_CACHE))
+    local_state = LocalState(os.path.join(backup_config_path, UPBACK_LOCAL_STATE),
+                             configuration.trust_directory_mtime)
+    paths_a = rclone_ls(configuration.working_directory, local_excludes, local_state)
+    local_excludes.save()
+    local_state.save()
+    return paths_a
+
+def hash_local_files(backup_config_path, paths_a, paths_b, remote_path, complete=False):
+    """ Sets the checksums of the local files (and of the remote ones
+        if remote_path is local) using the hash type of the checksums
+        listed by the remote, caching them in the branch.
+        If complete is set the whole branch has been listed and
+        the files not found are dropped from the cache
+    """
+    remote_is_local = is_path_local(remote_path)
+    hash_type = checksum_type(paths_b)
+    if hash_type is None:
+        if not remote_is_local:
+            if any(not path_element.is_directory for path_element in paths_b.values()):
+                logging.warning("The remote provides no supported checksums, "
+                                "files are compared by modification time")
             return
-        #look for conf file
-        backup_config = find_backup_branch()
-        if backup_config is None:
-            raise UpBackException("The current directory does not belong to an UpBack backup")
-        backup_config_path = os.path.dirname(backup_config)
-        #lock conf file
-        if not lock_file(backup_config+".lock"):
-            raise UpBackException("Another instance of UpBack is running on this filesystem branch")
-        #read conf file
-        configuration.read_file(backup_config)
-        #path from conf file dir to .
-        rel_path = os.path.relpath(os.getcwd(), os.path.dirname(backup_config))
-        if rel_path == ".":
-            rel_path = ""
-        #fix conflicts
-        exclude_paths = []
-        if configuration.resume:
-            exclude_paths = fix_conflicts(configuration.remote, os.getcwd(), rel_path,
-                                          configuration.remote_backup, configuration.backup_suffix)
-        #list .
-        paths_a = rclone_ls(".")
-        #process local excludes (only for local branches)
-        paths_a = filter_exclude_paths(os.getcwd(), paths_a)
+        hash_type = HASH_TYPES[0]
+    cache = HashCache(os.path.join(backup_config_path, UPBACK_HASH_CACHE))
+    hashed = hash_files(Configuration().working_directory, paths_a, hash_type, cache)
+    if remote_is_local:
+        hashed += hash_files(remote_path, paths_b, hash_type, cache)
+    cache.save(complete)
+    Profiler().add("hashed files", hashed)
+
+def count_operations(operations):
+    """ Adds the number of operations of each type to the profile """
+    profiler = Profiler()
+    for name in ["copy_a_to_b", "copy_b_to_a", "delete_from_a", "delete_from_b", "move_in_a", "move_in_b",
+                 "conflicts"]:
+        profiler.add(name, len(getattr(operations, name)))
+
+def execute_journaled(journal, operations, paths_a, paths_b, backup_config_path, rel_path):
+    """ Performs operations recording them in journal (created or
+        loaded by the caller), then updates the remote backup and
+        removes the journal. The journal is also removed if some
+        operation fails, it is kept only if the execution is
+        interrupted
+    """
+    configuration = Configuration()
+    profiler = Profiler()
+    remote_path = os.path.join(configuration.remote, rel_path)
+    journal.checkpoint = lambda journal, completed: checkpoint_backup(journal, completed, backup_config_path,
+                                                                      paths_a, paths_b, remote_path)
+    #the remote is about to change: until a new token is written it must be listed
+    invalidate_token(backup_config_path)
+    with profiler.phase("perform_operations"):
+        try:
+            result = perform_operations(operations, paths_a, paths_b, configuration.remote,
+                                        rel_path, configuration.no_backup,
+                                        configuration.remote_backup, configuration.backup_suffix, journal)
+        except UpBackException:
+            #the checkpoint left the failed paths as they were in the backup: they are
+            #planned again from fresh listings, instead of retrying a stale plan
+            journal.remove()
+            raise
+        count_transferred_bytes(result, paths_a, paths_b)
+        apply_journal(journal, paths_a, paths_b, remote_path)
+    with profiler.phase("save_backup"):
+        store_backup(backup_config_path, rel_path, paths_b)
+    journal.remove()
+    if result.is_successful():
+        update_token(backup_config_path, configuration.remote)
+
+def local_operations(backup_config_path, rel_path, paths_a):
+    """ Operations needed by the local changes only, comparing
+        paths_a with the remote backup as if it were the remote
+        listing. Returns None if there is no remote backup
+    """
+    configuration = Configuration()
+    profiler = Profiler()
+    with profiler.phase("retrieve_backup"):
+        paths_b_backup = retrieve_backup(backup_config_path, rel_path)
+    if paths_b_backup is None:
+        return None
+    with profiler.phase("compute_operations"):
+        paths_all = merge_and_exclude_paths(paths_a, paths_b_backup, rel_path, [], configuration.global_excludes)
+        operations = diff_operations(paths_all, paths_a, paths_b_backup, paths_b_backup)
+    profiler.count("local paths", len(paths_a))
+    profiler.count("remote backup paths", len(paths_b_backup))
+    profiler.count("synchronized paths", len(paths_all))
+    return operations
+
+def journal_outdated(journal, remote_path):
+    """ Returns True if some path of the operations still to perform
+        is not, locally or in the remote, as it was when they were
+        planned: performing them could overwrite or delete changes
+        made meanwhile. Only those paths are listed
+    """
+    pending_paths = sorted(journal.pending_paths())
+    if not pending_paths:
+        return False
+    paths_a = rclone_ls(Configuration().working_directory, files=pending_paths)
+    #rclone lists the files in --files-from, remote directories are not checked
+    remote_files = [path for path in pending_paths
+                    if not path in journal.remote_elements or not journal.remote_elements[path].is_directory]
+    paths_b = rclone_ls(remote_path, files=remote_files) if remote_files else PathListing()
+    for planned_elements, current_elements, paths in [(journal.local_elements, paths_a, pending_paths),
+                                                      (journal.remote_elements, paths_b, remote_files)]:
+        for path in paths:
+            planned_element = planned_elements.get(path)
+            current_element = current_elements.get(path)
+            if planned_element is None and current_element is None:
+                continue
+            if planned_element is None or current_element is None or \
+               not planned_element.is_effectively_equal_to(current_element):
+                logging.info("Path changed since the synchronization was interrupted: "+path)
+                return True
+    return False
+
+def resume_synchronization(journal, backup_config_path, rel_path):
+    """ Completes the synchronization recorded in journal, interrupted
+        in a previous run: the pending operations are performed without
+        listing and comparing the branch again.
+        If some of their paths changed since they were planned the
+        journal is dropped, after saving in the backup the operations
+        it recorded.
+        Returns the pending operations, None if the journal was dropped
+    """
+    configuration = Configuration()
+    if journal.rel_path != rel_path:
+        raise UpBackException("An interrupted synchronization of "+
+                              os.path.join(backup_config_path, journal.rel_path)+
+                              " must be completed first: run UpBack from that directory")
+    if journal.remote != configuration.remote:
+        raise UpBackException("An interrupted synchronization with "+journal.remote+" was found: remove "+
+                              journal.journal_path+" to synchronize with "+configuration.remote)
+    with Profiler().phase("retrieve_backup"):
+        paths_b = retrieve_backup(backup_config_path, rel_path)
+    if paths_b is None:
+        raise UpBackException("No remote backup file found. Run with an init option")
+    #the remote as listed when the operations were planned, see checkpoint_backup
+    for path in journal.paths(journal.operations):
+        path_element = journal.remote_elements.get(path)
+        if path_element is not None:
+            paths_b[path] = path_element
+        elif path in paths_b:
+            del paths_b[path]
+    remote_path = os.path.join(configuration.remote, rel_path)
+    with Profiler().phase("check_journal"):
+        outdated = journal_outdated(journal, remote_path)
+    if outdated:
+        print("The branch changed since the synchronization was interrupted, synchronizing it again")
+        checkpoint_backup(journal, len(journal.completed), backup_config_path, journal.local_elements,
+                          paths_b, remote_path)
+        journal.remove()
+        return None
+    operations = journal.pending_operations()
+    count_operations(operations)
+    print("Resuming an interrupted synchronization ("+str(len(journal.completed))+" operations were completed)")
+    if configuration.verbose:
+        print(operations.pretty_format())
+    execute_journaled(journal, operations, journal.local_elements, paths_b, backup_config_path, rel_path)
+    return operations
+
+def synchronize(backup_config_path, rel_path, exclude_paths=None):
+    """ Synchronizes the current directory with the corresponding remote path,
+        or completes the synchronization interrupted in a previous run
+        Returns the computed operations
+    """
+    configuration = Configuration()
+    profiler = Profiler()
+    journal = Journal(os.path.join(backup_config_path, UPBACK_JOURNAL))
+    try:
+        try:
+            interrupted = journal.load()
+        except ValueError as error:
+            raise UpBackException(str(error)+": remove "+journal.journal_path+" to synchronize again")
+        if interrupted:
+            operations = resume_synchronization(journal, backup_config_path, rel_path)
+            if operations is not None:
+                return operations
+            journal = Journal(journal.journal_path)
+        with profiler.phase("local_listing"):
+            paths_a = list_local(backup_config_path)
+        if not configuration.full and not exclude_paths:
+            with profiler.phase("check_token"):
+                unchanged = remote_unchanged(backup_config_path, configuration.remote)
+            if unchanged:
+                #nobody synchronized with the remote since this branch did
+                operations = local_operations(backup_config_path, rel_path, paths_a)
+                if operations is not None and operations.is_empty():
+                    logging.info("No local changes and the remote is unchanged, skipping the remote listing")
+                    count_operations(operations)
+                    return operations
         #list remote/path from conf file
-        paths_b = rclone_ls(os.path.join(configuration.remote, rel_path))
+        with profiler.phase("remote_listing"):
+            paths_b = rclone_ls(os.path.join(configuration.remote, rel_path))
+        if configuration.checksum:
+            with profiler.phase("hashing"):
+                hash_local_files(backup_config_path, paths_a, paths_b, os.path.join(configuration.remote, rel_path),
+                                 rel_path == "")
         #compute all paths
-        paths_all = merge_and_exclude_paths(paths_a, paths_b, rel_path, exclude_paths,
-                                            configuration.global_excludes)
+        with profiler.phase("merge_and_exclude"):
+            paths_all = merge_and_exclude_paths(paths_a, paths_b, rel_path, exclude_paths or [],
+                                                configuration.global_excludes)
         #retrieve remote backup
-        paths_b_backup = retrieve_backup(backup_config_path, rel_path)
+        with profiler.phase("retrieve_backup"):
+            paths_b_backup = retrieve_backup(backup_config_path, rel_path)
         if paths_b_backup is None:
             raise UpBackException("No remote backup file found. Run with an init option")
         #compute operations
-        operations = compute_operations(paths_all, paths_a, paths_b_backup, paths_b)
+        with profiler.phase("compute_operations"):
+            operations = diff_operations(paths_all, paths_a, paths_b_backup, paths_b)
+            if configuration.trust_directory_mtime and refresh_local_paths(operations, paths_a):
+                #some local file changed in place, the listing was stale
+                operations = diff_operations(paths_all, paths_a, paths_b_backup, paths_b)
+            detect_moves(operations, paths_a, paths_b)
+        profiler.count("local paths", len(paths_a))
+        profiler.count("remote paths", len(paths_b))
+        profiler.count("remote backup paths", len(paths_b_backup))
+        profiler.count("synchronized paths", len(paths_all))
+        count_operations(operations)
         logging.info("operations: "+str(operations))
         if operations.conflicts:
             write_conflicts(operations.conflicts, paths_a, paths_b)
@@ -528,12 +870,39 @@ def upback():
                     print(operations.pretty_format())
                 if not configuration.interactive or \
                    input("Proceed with these operations ? (Y/N) ").lower() == "y":
-                    #perform operations
-                    perform_operations(operations, paths_a, paths_b, configuration.remote, rel_path,
-                                       configuration.no_backup, configuration.remote_backup,
-                                       configuration.backup_suffix)
+                    #the plan is written before performing it, the backup is updated after
+                    journal.create(rel_path, configuration.remote, operations, paths_a, paths_b, paths_b_backup)
+                    execute_journaled(journal, operations, paths_a, paths_b, backup_config_path, rel_path)
+                    return operations
             #update remote backup
-            save_backup(backup_config_path, configuration.remote)
+            with profiler.phase("save_backup"):
+                store_backup(backup_config_path, rel_path, paths_b)
+            update_token(backup_config_path, configuration.remote)
+    finally:
+        journal.close()
+    return operations
+
+def upback():
+    """ Program entry point
+    """
+    try:
+        configuration = Configuration()
+        #initialize the RClone singleton
+        RClone(configuration.rclone_path, configuration.rclone_executable)
+        if configuration.init_pull:
+            init_pull()
+            return
+        if configuration.init_push:
+            init_push()
+            return
+        backup_config_path, rel_path = open_branch()
+        #fix conflicts
+        exclude_paths = []
+        if configuration.resume:
+            with Profiler().phase("fix_conflicts"):
+                exclude_paths = fix_conflicts(configuration.remote, os.getcwd(), rel_path,
+                                              configuration.remote_backup, configuration.backup_suffix)
+        synchronize(backup_config_path, rel_path, exclude_paths)
     except UpBackException as exception:
         print(str(exception))
         return STATUS_ERROR
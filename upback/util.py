@@ -3,6 +3,7 @@ Misc utilities
 """
 
 import datetime
+import contextvars
 import os
 import fnmatch
 
@@ -22,69 +23,120 @@ def wildcard_match(item, base, wildcard):
     else:
         return fnmatch.fnmatch(item, wildcard)
 
+def rebase(path_to_rebase, base):
+    """ Rebase the parameter (a list or a single string)
+    """
+    if base is None or base == "" or base == ".":
+        return path_to_rebase
+    path_list = path_to_rebase if isinstance(path_to_rebase, list) else [path_to_rebase]
+    rebased_paths = []
+    for path in path_list:
+        rebased_paths.append(os.path.join(base, path))
+    return rebased_paths if isinstance(path_to_rebase, list) else rebased_paths[0]
+
+def path_sort_key(path):
+    """ Sort key for relative paths ordering them as a tree:
+        the elements contained in a directory immediately follow it
+    """
+    return path.replace("/", "\0")
+
 def is_path_local(path):
     return not ":" in path
 
-def parse_rfc3339(datetime_string, report_precision=False):
-    """ Returns a datetime object for
-        a RFC3339-formatted string
+def parse_rfc3339(datetime_string):
+    """ Returns (nanoseconds since the epoch, precision) for
+        a RFC3339-formatted string, precision is the number
+        of decimal digits of the seconds.
+        The layout of rclone timestamps is fixed: fields are sliced
+        instead of parsed, results are cached since listings often
+        contain the same timestamp many times
     """
-    timezone = "+0000"
-    if datetime_string.endswith("Z"):
-        datetime_string = datetime_string[0:-1]
-    _, _, datetime_time_string = datetime_string.partition("T")
-    zone_sep = ""
-    if "+" in datetime_time_string:
-        zone_sep = "+"
-    elif "-" in datetime_time_string:
-        zone_sep = "-"
-    if not zone_sep == "":
-        datetime_string, _, datetime_offset = datetime_string.partition(zone_sep)
-        timezone = zone_sep+datetime_offset.replace(":", "")
-    microseconds = 0
-    precision = 0
-    if "." in datetime_time_string:
-        datetime_string, _, datetime_ns = datetime_string.partition(".")
-        microseconds = int(float("0."+datetime_ns)*1000)
-        precision = len(datetime_ns)
-    time_3339 = datetime.datetime.strptime(datetime_string, "%Y-%m-%dT%H:%M:%S")
-    hours = int(timezone[1:3])
-    minutes = int(timezone[3:5])
-    timezone_delta = datetime.timedelta(hours=hours, minutes=minutes)
-    if timezone[0] == '+':
-        time_3339 -= timezone_delta
-    else:
-        time_3339 += timezone_delta
-    time_3339 = time_3339.replace(microsecond=microseconds)
-    if report_precision:
-        return (time_3339, precision)
-    else:
-        return time_3339
+    result = RFC3339_CACHE.get(datetime_string)
+    if result is None:
+        result = parse_rfc3339_uncached(datetime_string)
+        if len(RFC3339_CACHE) >= RFC3339_CACHE_SIZE:
+            RFC3339_CACHE.clear()
+        RFC3339_CACHE[datetime_string] = result
+    return result
+
+def parse_rfc3339_uncached(datetime_string):
+    """ parse_rfc3339 without the cache """
+    # YYYY-MM-DDTHH:MM:SS[.fraction][Z|+HH:MM|-HH:MM]
+    days = datetime.date(int(datetime_string[0:4]), int(datetime_string[5:7]),
+                         int(datetime_string[8:10])).toordinal()-EPOCH_ORDINAL
+    seconds = (days*86400+int(datetime_string[11:13])*3600+int(datetime_string[14:16])*60+
+               int(datetime_string[17:19]))
+    rest = datetime_string[19:]
+    if rest.endswith("Z"):
+        rest = rest[:-1]
+    elif len(rest) >= 5 and rest[-5] in "+-":
+        # +HHMM
+        offset = int(rest[-4:-2])*3600+int(rest[-2:])*60
+        seconds -= offset if rest[-5] == "+" else -offset
+        rest = rest[:-5]
+    elif len(rest) >= 6 and rest[-6] in "+-":
+        # +HH:MM
+        offset = int(rest[-5:-3])*3600+int(rest[-2:])*60
+        seconds -= offset if rest[-6] == "+" else -offset
+        rest = rest[:-6]
+    if rest == "":
+        return (seconds*1000000000, 0)
+    if rest[0] != "." or not rest[1:].isdigit():
+        raise ValueError("Invalid RFC3339 timestamp "+datetime_string)
+    fraction_digits = rest[1:10]
+    return (seconds*1000000000+int(fraction_digits.ljust(9, "0")), len(fraction_digits))
+
+def ns_precision(time_ns):
+    """ Returns the precision rclone reports for a timestamp
+        expressed in nanoseconds since the epoch: its RFC3339Nano
+        representation has no trailing zeros
+    """
+    fraction_ns = time_ns % 1000000000
+    if not fraction_ns:
+        return 0
+    precision = 9
+    while fraction_ns % 10 == 0:
+        fraction_ns //= 10
+        precision -= 1
+    return precision
+
+def format_ns(time_ns):
+    """ Returns a readable UTC representation of a timestamp
+        expressed in nanoseconds since the epoch
+    """
+    if time_ns is None:
+        return str(None)
+    seconds, fraction_ns = divmod(time_ns, 1000000000)
+    time_stamp = EPOCH+datetime.timedelta(seconds=seconds)
+    return time_stamp.strftime("%Y-%m-%d %H:%M:%S")+(".%09d" % fraction_ns)
 
 def lock_file(path):
     """ Creates a lockfile
         Returns True if the lockfile was absent and has been created
-        Returns False if the lockfile was already present
+        Returns False if the lockfile was already present.
+        The lockfile is recorded in the current context, so that
+        branches synchronized concurrently each remove their own
     """
     #TODO if open fails and the lockfile is present, check its creation date
     # and, if it's more than ??? remove it and retry
-    # pylint: disable=global-statement
     try:
         lock_fd = os.open(path, os.O_CREAT | os.O_WRONLY | os.O_EXCL)
     except OSError:
         return False
     else:
-        global LOCK_FILENAME
-        LOCK_FILENAME = path
+        LOCK_FILENAME.set(path)
         os.close(lock_fd)
         return True
 
 def remove_lock_file():
     """ Removes a previously created lockfile (if any) """
-    # pylint: disable=global-statement
-    global LOCK_FILENAME
-
-    if LOCK_FILENAME is not None and os.path.isfile(LOCK_FILENAME):
-        os.unlink(LOCK_FILENAME)
+    lock_filename = LOCK_FILENAME.get()
+    if lock_filename is not None and os.path.isfile(lock_filename):
+        os.unlink(lock_filename)
+    LOCK_FILENAME.set(None)
 
-LOCK_FILENAME = None
+LOCK_FILENAME = contextvars.ContextVar("lock_filename", default=None)
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+RFC3339_CACHE = {}
+RFC3339_CACHE_SIZE = 65536
@@ -0,0 +1,452 @@
+"""
+Watch mode: keeps a branch synchronized in a long running
+process driven by inotify change events
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import signal
+import struct
+import logging
+import ctypes
+import ctypes.util
+
+from .rclone import RClone
+from .configuration import Configuration
+from .scanner import LocalScanner
+from .excludes import LocalExcludes
+from .path_listing import PathListing
+from .diff import diff_operations
+from .operations import detect_moves
+from .upback import UpBackException, open_branch, list_local, synchronize, retrieve_backup, \
+    update_backup, merge_and_exclude_paths, create_executor, apply_operations, \
+    write_conflicts, cleanup
+from .change_token import invalidate_token, update_token
+from .util import path_sort_key
+from .const import * # pylint: disable=unused-wildcard-import
+
+class Inotify(object):
+    """ Minimal ctypes binding of the Linux inotify API """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o00004000
+    IN_CLOEXEC = 0o02000000
+    EVENT_HEADER = struct.Struct("iIII")
+    READ_SIZE = 65536
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if not sys.platform.startswith("linux") or libc_name is None:
+            raise OSError(errno.ENOSYS, "inotify is not available on this platform")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path, mask):
+        """ Watches path, returns the watch descriptor """
+        watch_descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if watch_descriptor < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return watch_descriptor
+
+    def rm_watch(self, watch_descriptor):
+        """ Stops watching, errors (e.g. the watched directory
+            has already been removed) are ignored
+        """
+        self.libc.inotify_rm_watch(self.fd, watch_descriptor)
+
+    def read_events(self, timeout):
+        """ Waits up to timeout seconds for events.
+            Returns a list of (watch_descriptor, mask, cookie, name) tuples
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, self.READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            watch_descriptor, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset+length].rstrip(b"\0"))
+            offset += length
+            events.append((watch_descriptor, mask, cookie, name))
+        return events
+
+    def close(self):
+        """ Releases the inotify instance """
+        os.close(self.fd)
+
+class BranchWatcher(object):
+    """ Keeps the local listing, the remote listing and the
+        remote backup of the current directory in memory and
+        synchronizes the paths inotify reports as changed.
+        Local changes are collected per directory and synchronized
+        once no event arrived for debounce seconds (or after
+        MAX_DELAY_FACTOR*debounce seconds of continuous changes).
+        The remote is not notified of changes: a full
+        synchronization is run every remote_interval seconds.
+    """
+    WATCH_MASK = (Inotify.IN_MODIFY | Inotify.IN_ATTRIB | Inotify.IN_CLOSE_WRITE |
+                  Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO | Inotify.IN_CREATE |
+                  Inotify.IN_DELETE | Inotify.IN_ONLYDIR | Inotify.IN_DONT_FOLLOW)
+    MAX_DELAY_FACTOR = 10
+
+    def __init__(self, backup_config_path, rel_path, debounce=WATCH_DEBOUNCE_DEFAULT,
+                 remote_interval=WATCH_REMOTE_INTERVAL_DEFAULT):
+        self.backup_config_path = backup_config_path
+        self.rel_path = rel_path
+        self.debounce = debounce
+        self.remote_interval = remote_interval
+        self.configuration = Configuration()
+        try:
+            self.inotify = Inotify()
+        except OSError as error:
+            raise UpBackException("Cannot watch the branch: "+str(error))
+        self.local_excludes = None
+        self.scanner = None
+        self.time_precision = 0
+        self.paths_a = {}
+        self.paths_b = {}
+        self.paths_b_backup = {}
+        # local directory -> names of its (not excluded) elements
+        self.tree = {}
+        # watch descriptor -> local directory and vice versa
+        self.watches = {}
+        self.watched = {}
+        self.dirty = set()
+        self.full_rescan = False
+        self.first_change = None
+        self.last_change = None
+
+    def run(self):
+        """ Synchronizes the branch until interrupted """
+        self.synchronize_all()
+        next_refresh = time.monotonic()+self.remote_interval
+        while True:
+            timeout = next_refresh-time.monotonic()
+            if self.last_change is not None:
+                timeout = min(timeout, self.change_deadline()-time.monotonic())
+            self.handle_events(self.inotify.read_events(max(timeout, 0)))
+            now = time.monotonic()
+            if now >= next_refresh:
+                self.synchronize_all()
+                next_refresh = time.monotonic()+self.remote_interval
+            elif self.last_change is not None and now >= self.change_deadline():
+                self.synchronize_changes()
+
+    def change_deadline(self):
+        """ Time at which pending local changes are synchronized """
+        return min(self.last_change+self.debounce,
+                   self.first_change+self.debounce*self.MAX_DELAY_FACTOR)
+
+    def close(self):
+        """ Stops watching the branch """
+        self.inotify.close()
+
+    def synchronize_all(self):
+        """ Runs a full synchronization, then reloads the state """
+        logging.info("Synchronizing local and remote")
+        operations = synchronize(self.backup_config_path, self.rel_path)
+        if operations.conflicts:
+            raise UpBackException("Watch stopped because of conflicts")
+        self.load_local()
+        self.paths_b_backup = retrieve_backup(self.backup_config_path, self.rel_path)
+        self.paths_b = PathListing(self.paths_b_backup.values())
+
+    def load_local(self):
+        """ Lists the local branch and watches all its directories """
+        self.local_excludes = LocalExcludes(os.path.join(self.backup_config_path, UPBACK_EXCLUDE_CACHE))
+        self.scanner = LocalScanner(self.configuration.scan_threads,
+                                    RClone().harmonize_timestamp_precision, self.local_excludes)
+        self.paths_a = list_local(self.backup_config_path, self.local_excludes)
+        self.time_precision = max([path_element.time_precision
+                                   for path_element in self.paths_a.values()] + [0])
+        self.build_tree()
+        for directory in list(self.watched):
+            if directory not in self.tree:
+                self.unwatch_directory(directory)
+        for directory in self.tree:
+            if directory not in self.watched:
+                self.watch_directory(directory)
+        self.dirty = set()
+        self.full_rescan = False
+        self.first_change = None
+        self.last_change = None
+
+    def build_tree(self):
+        """ Rebuilds tree from paths_a """
+        self.tree = {"": set()}
+        for path, path_element in self.paths_a.items():
+            parent, _, name = path.rpartition("/")
+            self.tree.setdefault(parent, set()).add(name)
+            if path_element.is_directory:
+                self.tree.setdefault(path, set())
+
+    def watch_directory(self, directory):
+        """ Starts watching a local directory """
+        try:
+            watch_descriptor = self.inotify.add_watch(os.path.join(".", directory), self.WATCH_MASK)
+        except OSError as error:
+            if error.errno == errno.ENOSPC:
+                raise UpBackException("Too many directories to watch, "
+                                      "increase fs.inotify.max_user_watches")
+            # the directory has been removed meanwhile, its parent reports it
+            return
+        previous_directory = self.watches.get(watch_descriptor)
+        if previous_directory is not None and self.watched.get(previous_directory) == watch_descriptor:
+            # the same directory moved elsewhere in the branch
+            del self.watched[previous_directory]
+        self.watches[watch_descriptor] = directory
+        self.watched[directory] = watch_descriptor
+
+    def unwatch_directory(self, directory):
+        """ Stops watching a local directory """
+        watch_descriptor = self.watched.pop(directory)
+        if self.watches.get(watch_descriptor) == directory:
+            del self.watches[watch_descriptor]
+            self.inotify.rm_watch(watch_descriptor)
+
+    def handle_events(self, events):
+        """ Records the directories whose contents changed """
+        for (watch_descriptor, mask, _, name) in events:
+            if mask & Inotify.IN_Q_OVERFLOW:
+                logging.warning("Too many local changes, listing the whole branch")
+                self.full_rescan = True
+            elif mask & Inotify.IN_IGNORED:
+                directory = self.watches.pop(watch_descriptor, None)
+                if directory is not None and self.watched.get(directory) == watch_descriptor:
+                    del self.watched[directory]
+                continue
+            else:
+                directory = self.watches.get(watch_descriptor)
+                if directory is None or name == "" or self.is_internal_file(name):
+                    continue
+                if name == UPBACK_EXCLUDE_FILE:
+                    # excludes changed, every directory below could be affected
+                    self.full_rescan = True
+                self.dirty.add(directory)
+            now = time.monotonic()
+            if self.last_change is None:
+                self.first_change = now
+            self.last_change = now
+
+    @staticmethod
+    def is_internal_file(name):
+        """ Returns True for the files UpBack itself writes in the branch """
+        return name in UPBACK_INTERNAL_FILES or name.startswith(UPBACK_REMOTE_BACKUP+".")
+
+    def synchronize_changes(self):
+        """ Synchronizes the paths changed since the last call """
+        changed = self.collect_changes()
+        self.local_excludes.save()
+        paths = [path for path in changed
+                 if path in self.paths_a or path in self.paths_b or path in self.paths_b_backup]
+        paths_all = merge_and_exclude_paths(paths, [], self.rel_path, [],
+                                            self.configuration.global_excludes)
+        if not paths_all:
+            return
+        operations = diff_operations(paths_all, self.paths_a, self.paths_b_backup, self.paths_b)
+        detect_moves(operations, self.paths_a, self.paths_b)
+        logging.info("operations: "+str(operations))
+        if operations.conflicts:
+            write_conflicts(operations.conflicts, self.paths_a, self.paths_b)
+            raise UpBackException("UpBack cannot perform the synchronization because of conflicts.\n"
+                                  "Please edit the "+UPBACK_CONFLICTS_FILE+" file and decide\n"
+                                  "how to manage conflicts, then run UpBack again.")
+        failed = set()
+        if not operations.is_empty():
+            if self.configuration.verbose:
+                print(operations.pretty_format())
+            executor = create_executor(self.configuration.remote, self.rel_path,
+                                       self.configuration.no_backup, self.configuration.remote_backup,
+                                       self.configuration.backup_suffix)
+            #the remote is about to change: until a new token is written it must be listed
+            invalidate_token(self.backup_config_path)
+            result = executor.execute(operations, self.paths_a, self.paths_b)
+            #local changes are not applied, the events they generate refresh paths_a
+            apply_operations(self.paths_b, self.paths_a, result,
+                             os.path.join(self.configuration.remote, self.rel_path))
+            if not result.is_successful():
+                # retried by the next full synchronization
+                logging.warning(str(len(result.failed))+" operations failed:\n"+
+                                result.pretty_format_failures())
+                failed = set(path for (_, path, _) in result.failed)
+        for path in paths_all:
+            if path in failed:
+                continue
+            if path in self.paths_b:
+                self.paths_b_backup[path] = self.paths_b[path]
+            else:
+                self.paths_b_backup.pop(path, None)
+        update_backup(self.backup_config_path, self.rel_path, self.paths_b_backup)
+        if not operations.is_empty() and not failed:
+            #other branches of the remote find a token that is not theirs
+            update_token(self.backup_config_path, self.configuration.remote)
+
+    def collect_changes(self):
+        """ Refreshes paths_a listing the changed directories.
+            Returns the set of paths that may have changed
+        """
+        dirty = self.dirty
+        full_rescan = self.full_rescan
+        self.dirty = set()
+        self.full_rescan = False
+        self.first_change = None
+        self.last_change = None
+        if full_rescan:
+            return self.rescan_all()
+        changed = set()
+        for directory in sorted(dirty, key=path_sort_key):
+            changed |= self.rescan_directory(directory)
+        return changed
+
+    def rescan_all(self):
+        """ Lists the whole branch again """
+        previous_paths = self.paths_a
+        self.load_local()
+        changed = set(previous_paths).symmetric_difference(self.paths_a)
+        for path, path_element in self.paths_a.items():
+            if path in previous_paths and previous_paths[path] != path_element:
+                changed.add(path)
+        return changed
+
+    def rescan_directory(self, directory):
+        """ Lists a single directory updating paths_a.
+            Returns the set of paths that may have changed
+        """
+        if directory not in self.tree:
+            # removed along with one of its parents
+            return set()
+        try:
+            directory_entries = LocalScanner.list_directory(os.path.join(".", directory))
+        except OSError:
+            # removed, its parent is rescanned as well
+            return set()
+        matcher, _ = self.local_excludes.matcher_for(".", directory)
+        prefix = "" if directory == "" else directory+"/"
+        current = {}
+        for entry in directory_entries:
+            if matcher is None or not matcher.match(entry[0]):
+                current[entry[0]] = entry
+        changed = set()
+        for name in list(self.tree[directory]):
+            entry = current.get(name)
+            if entry is None or entry[1] != self.paths_a[prefix+name].is_directory:
+                changed |= self.remove_local(prefix+name)
+        entries = []
+        new_directories = []
+        for (name, is_directory, size, mtime_ns) in current.values():
+            if is_directory and not prefix+name in self.paths_a:
+                new_directories.append(prefix+name)
+            entries.append((prefix+name, is_directory, size, mtime_ns))
+        for path, path_element in self.build_path_elements(entries).items():
+            if self.paths_a.get(path) != path_element:
+                changed.add(path)
+            self.add_local(path_element)
+        for path in new_directories:
+            changed |= self.add_local_tree(path)
+        return changed
+
+    def build_path_elements(self, entries):
+        """ Builds PathElements with the precision of the initial listing """
+        return self.harmonize_precision(self.scanner.build_path_elements(entries))
+
+    def harmonize_precision(self, paths):
+        """ Raises the precision of paths to the one of the initial listing """
+        if RClone().harmonize_timestamp_precision:
+            for path_element in paths.values():
+                if path_element.time_precision < self.time_precision:
+                    path_element.time_precision = self.time_precision
+        return paths
+
+    def add_local(self, path_element):
+        """ Adds a local element to paths_a and tree """
+        self.paths_a[path_element.path] = path_element
+        parent, _, name = path_element.path.rpartition("/")
+        self.tree.setdefault(parent, set()).add(name)
+        if path_element.is_directory:
+            self.tree.setdefault(path_element.path, set())
+
+    def add_local_tree(self, directory):
+        """ Watches and lists a new local directory.
+            Returns the paths found in it
+        """
+        self.watch_directory(directory)
+        paths = self.harmonize_precision(self.scanner.scan(".", directory))
+        for path, path_element in paths.items():
+            self.add_local(path_element)
+            if path_element.is_directory:
+                self.watch_directory(path)
+                # listed before being watched: list it again next time
+                self.dirty.add(path)
+        if self.dirty:
+            self.first_change = self.last_change = time.monotonic()
+        return set(paths)
+
+    def remove_local(self, path):
+        """ Removes a local element (and its contents) from paths_a and tree.
+            Returns the removed paths
+        """
+        removed = {path}
+        path_element = self.paths_a.pop(path, None)
+        parent, _, name = path.rpartition("/")
+        if parent in self.tree:
+            self.tree[parent].discard(name)
+        if path_element is not None and path_element.is_directory:
+            for child_name in self.tree.pop(path, set()):
+                removed |= self.remove_local(path+"/"+child_name)
+            if path in self.watched:
+                self.unwatch_directory(path)
+        return removed
+
+def terminate(signum, frame):
+    """ SIGTERM handler, stops the watcher as Ctrl-C does """
+    # pylint: disable=unused-argument
+    raise KeyboardInterrupt()
+
+def watch():
+    """ Watch mode entry point
+    """
+    try:
+        configuration = Configuration()
+        #initialize the RClone singleton
+        RClone(configuration.rclone_path, configuration.rclone_executable)
+        #operations are performed unattended
+        configuration.interactive = False
+        #terminate cleanly (releasing the lock) when stopped as a service
+        signal.signal(signal.SIGTERM, terminate)
+        backup_config_path, rel_path = open_branch()
+        watcher = BranchWatcher(backup_config_path, rel_path, configuration.debounce,
+                                configuration.remote_interval)
+        try:
+            watcher.run()
+        finally:
+            watcher.close()
+    except UpBackException as exception:
+        print(str(exception))
+        return STATUS_ERROR
+    finally:
+        cleanup()
+    return STATUS_OK